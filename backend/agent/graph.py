@@ -1,20 +1,50 @@
 """
 LangGraph definition for the multi-agent algebra chatbot.
-Flow: OCR (if image) -> Planner -> Executor -> Synthetic
+Flow: OCR (if image) -> Planner -> Question workers (parallel, via Send) -> Executor -> Synthetic
 """
+from functools import lru_cache, wraps
 from langgraph.graph import StateGraph, END
 from backend.agent.state import AgentState
 from backend.agent.nodes import (
     ocr_agent_node,
     planner_node,
-    parallel_executor_node,
+    question_worker_node,
+    collect_results_node,
     synthetic_agent_node,
     wolfram_tool_node,
     code_tool_node,
     route_agent,
+    dispatch_questions,
 )
 
 
+# Channels with reducers: re-submitting them in full re-runs the reducer over
+# the whole value (add_messages re-indexes every message), so only deltas go back
+_REDUCED_CHANNELS = ("messages", "_question_outputs")
+
+
+def _returns_delta(node):
+    """
+    Wrap a node that mutates and returns the full state so LangGraph only
+    receives what changed for reducer channels: an untouched list is dropped
+    and an appended-to list is reduced to its new tail.
+    Other keys are passed through (plain channels just store the value).
+    """
+    @wraps(node)
+    async def wrapper(state: AgentState) -> dict:
+        before = {key: (state.get(key), len(state.get(key) or [])) for key in _REDUCED_CHANNELS}
+        update = dict(await node(state))
+        for key, (value, length) in before.items():
+            if key not in update or update[key] is not value:
+                continue  # Not returned, or replaced wholesale
+            if len(value or []) == length:
+                del update[key]
+            else:
+                update[key] = value[length:]
+        return update
+    return wrapper
+
+
 def build_graph() -> StateGraph:
     """Build and compile the LangGraph for the multi-agent algebra chatbot."""
     
@@ -22,12 +52,13 @@ def build_graph() -> StateGraph:
     workflow = StateGraph(AgentState)
     
     # Add all nodes (NO reasoning_agent - deprecated)
-    workflow.add_node("ocr_agent", ocr_agent_node)
-    workflow.add_node("planner", planner_node)
-    workflow.add_node("executor", parallel_executor_node)
-    workflow.add_node("synthetic_agent", synthetic_agent_node)
-    workflow.add_node("wolfram_tool", wolfram_tool_node)
-    workflow.add_node("code_tool", code_tool_node)
+    workflow.add_node("ocr_agent", _returns_delta(ocr_agent_node))
+    workflow.add_node("planner", _returns_delta(planner_node))
+    workflow.add_node("question_worker", question_worker_node)
+    workflow.add_node("executor", _returns_delta(collect_results_node))
+    workflow.add_node("synthetic_agent", _returns_delta(synthetic_agent_node))
+    workflow.add_node("wolfram_tool", _returns_delta(wolfram_tool_node))
+    workflow.add_node("code_tool", _returns_delta(code_tool_node))
     
     # Set entry point - OCR first (will pass through if no images)
     workflow.set_entry_point("ocr_agent")
@@ -43,17 +74,21 @@ def build_graph() -> StateGraph:
         }
     )
     
-    # Planner -> Executor (if tools needed) OR Done (if all direct answered)
+    # Planner -> one Question worker per work unit (if tools needed) OR Done (if all direct answered)
     workflow.add_conditional_edges(
         "planner",
-        route_agent,
+        dispatch_questions,
         {
-            "executor": "executor",
+            "question_worker": "question_worker",  # Fan-out targets (Send)
+            "executor": "executor",                # Empty plan: collect directly
             "done": END,  # All-direct case: planner answered directly
             "end": END,
         }
     )
     
+    # Question workers -> Executor (fan-in once all workers finish)
+    workflow.add_edge("question_worker", "executor")
+    
     # Executor -> Synthetic (combine results)
     workflow.add_conditional_edges(
         "executor",
@@ -93,5 +128,14 @@ def build_graph() -> StateGraph:
     return workflow.compile()
 
 
-# Create the compiled graph
-agent_graph = build_graph()
+@lru_cache(maxsize=1)
+def get_agent_graph():
+    """Get the shared compiled graph, compiling it on first use."""
+    return build_graph()
+
+
+def __getattr__(name: str):
+    # Lazy `agent_graph`: importing this module no longer compiles the graph
+    if name == "agent_graph":
+        return get_agent_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
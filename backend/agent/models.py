@@ -3,15 +3,23 @@ Model configurations for the multi-agent algebra chatbot.
 Includes rate limits, model parameters, and factory functions.
 """
 import os
+import re
+import json
 import time
 import asyncio
-from typing import Optional, Dict, Any, Callable, TypeVar
+import importlib.util
+from typing import Optional, Dict, Any, Callable, TypeVar, Tuple
 from functools import wraps
 from dataclasses import dataclass, field
+import httpx
 from langchain_groq import ChatGroq
+from langchain_core.messages import HumanMessage, SystemMessage
 
+from backend.agent.prompts import build_batch_solve_prompt
+from backend.utils.memory import estimate_tokens, estimate_message_tokens
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class ModelConfig:
     """Configuration for a specific model."""
     id: str
@@ -27,6 +35,16 @@ class ModelConfig:
     tpd: int = 300000  # Tokens per day
 
 
+# Backslash escapes, consumed pairwise so an already escaped `\\frac` is not
+# split and doubled again. \b and \f count as LaTeX (\frac, \beta), not escapes
+_RE_ESCAPE = re.compile(r'\\([\\"/nrtu])?')
+
+
+def _repair_escapes(content: str) -> str:
+    """Double every backslash that does not start a valid JSON escape."""
+    return _RE_ESCAPE.sub(lambda m: m.group(0) if m.group(1) else '\\\\', content)
+
+
 # Model configurations based on rate limit table
 MODEL_CONFIGS: Dict[str, ModelConfig] = {
     "kimi-k2": ModelConfig(
@@ -75,52 +93,134 @@ MODEL_CONFIGS: Dict[str, ModelConfig] = {
 }
 
 
+# Resolved once at import so the hot path never touches os.environ
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+
+# HTTP/2 needs the optional `h2` package (httpx[http2]); fall back to HTTP/1.1 pooling
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Precomputed (config, api_key) per model for get_model / tracker creation
+_RESOLVED: Dict[str, Tuple[ModelConfig, Optional[str]]] = {
+    name: (config, GROQ_API_KEY) for name, config in MODEL_CONFIGS.items()
+}
+
+
+def get_usage_tokens(response) -> int:
+    """
+    Get total tokens billed for an LLM response.
+    Uses the provider's usage metadata; falls back to a local token estimate.
+    """
+    meta = getattr(response, "usage_metadata", None) or {}
+    return (
+        meta.get("total_tokens")
+        or (meta.get("input_tokens", 0) + meta.get("output_tokens", 0))
+        or estimate_tokens(response.content)
+    )
+
+
 @dataclass
 class ModelRateLimitTracker:
-    """Track rate limits for a specific model."""
+    """
+    Track rate limits for a specific model.
+    Per-minute limits (RPM/TPM) are token buckets that refill continuously,
+    so there is no burst at window boundaries. Per-day limits (RPD/TPD) use a
+    weighted sliding-window counter: the previous day's count is weighted by
+    how much of it still overlaps the trailing 24h.
+    """
     model_name: str
     config: ModelConfig
-    minute_requests: int = 0
-    minute_tokens: int = 0
-    day_requests: int = 0
-    day_tokens: int = 0
-    last_minute_reset: float = field(default_factory=time.time)
-    last_day_reset: float = field(default_factory=time.time)
-    
-    def _reset_if_needed(self):
-        """Reset counters if time windows have passed."""
-        now = time.time()
-        if now - self.last_minute_reset >= 60:
-            self.minute_requests = 0
-            self.minute_tokens = 0
-            self.last_minute_reset = now
-        if now - self.last_day_reset >= 86400:
-            self.day_requests = 0
-            self.day_tokens = 0
-            self.last_day_reset = now
+    request_bucket: float = field(init=False)  # Requests available right now
+    token_bucket: float = field(init=False)    # Tokens available right now
+    last_refill: float = field(default_factory=time.monotonic)
+    # Sliding day window: counts for the current and previous 24h windows
+    curr_day_requests: int = 0
+    curr_day_tokens: int = 0
+    prev_day_requests: int = 0
+    prev_day_tokens: int = 0
+    curr_day_start: float = field(default_factory=time.monotonic)
+    
+    def __post_init__(self):
+        # Buckets start full
+        self.request_bucket = float(self.config.rpm)
+        self.token_bucket = float(self.config.tpm)
+    
+    def _refill(self) -> float:
+        """
+        Refill minute buckets for elapsed time and roll the day window if needed.
+        Returns the weight (0..1) of the previous day window.
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            # Back-to-back calls (same clock tick) skip the bucket arithmetic
+            self.last_refill = now
+            self.request_bucket = min(self.config.rpm, self.request_bucket + elapsed * self.config.rpm / 60)
+            self.token_bucket = min(self.config.tpm, self.token_bucket + elapsed * self.config.tpm / 60)
+        
+        day_elapsed = now - self.curr_day_start
+        if day_elapsed >= 86400:
+            if day_elapsed >= 2 * 86400:
+                # Previous window no longer overlaps the trailing 24h
+                self.prev_day_requests = 0
+                self.prev_day_tokens = 0
+            else:
+                self.prev_day_requests = self.curr_day_requests
+                self.prev_day_tokens = self.curr_day_tokens
+            self.curr_day_requests = 0
+            self.curr_day_tokens = 0
+            self.curr_day_start = now - day_elapsed % 86400
+            day_elapsed = now - self.curr_day_start
+        return 1 - day_elapsed / 86400
     
     def can_request(self, estimated_tokens: int = 100) -> tuple[bool, str]:
         """Check if a request can be made within rate limits."""
-        self._reset_if_needed()
+        prev_weight = self._refill()
         
-        if self.minute_requests >= self.config.rpm:
+        # Ordered by how often each limit trips: TPM is the tightest bound for
+        # every Groq model here, then RPM; daily limits rarely bind.
+        if self.token_bucket < estimated_tokens:
+            return False, f"Rate limit: {self.model_name} would exceed {self.config.tpm} TPM"
+        if self.request_bucket < 1:
             return False, f"Rate limit: {self.model_name} exceeded {self.config.rpm} RPM"
-        if self.day_requests >= self.config.rpd:
+        if self.prev_day_requests * prev_weight + self.curr_day_requests >= self.config.rpd:
             return False, f"Rate limit: {self.model_name} exceeded {self.config.rpd} RPD"
-        if self.minute_tokens + estimated_tokens > self.config.tpm:
-            return False, f"Rate limit: {self.model_name} would exceed {self.config.tpm} TPM"
-        if self.day_tokens + estimated_tokens > self.config.tpd:
+        if self.prev_day_tokens * prev_weight + self.curr_day_tokens + estimated_tokens > self.config.tpd:
             return False, f"Rate limit: {self.model_name} would exceed {self.config.tpd} TPD"
         
         return True, ""
     
     def record_request(self, tokens_used: int):
-        """Record a completed request."""
-        self._reset_if_needed()
-        self.minute_requests += 1
-        self.day_requests += 1
-        self.minute_tokens += tokens_used
-        self.day_tokens += tokens_used
+        """Record a completed request (buckets may go negative to carry debt)."""
+        self._refill()
+        self.request_bucket -= 1
+        self.token_bucket -= tokens_used
+        self.curr_day_requests += 1
+        self.curr_day_tokens += tokens_used
+    
+    # Check-then-record leaves a gap across the awaited LLM call in which
+    # concurrent coroutines all pass `can_request`. Reservations close it:
+    # admission and debit happen together with no await in between, which
+    # is atomic under asyncio's cooperative scheduling.
+    
+    def try_reserve(self, estimated_tokens: int = 100) -> tuple[bool, str]:
+        """Atomically check limits and debit one request + estimated tokens."""
+        can_use, error = self.can_request(estimated_tokens)
+        if can_use:
+            self.record_request(estimated_tokens)
+        return can_use, error
+    
+    def settle(self, reserved_tokens: int, tokens_used: int):
+        """Correct a reservation with the actual tokens billed."""
+        delta = tokens_used - reserved_tokens
+        self.token_bucket -= delta
+        self.curr_day_tokens += delta
+    
+    def release(self, reserved_tokens: int):
+        """Return a reservation whose request never completed."""
+        self.request_bucket = min(self.config.rpm, self.request_bucket + 1)
+        self.token_bucket = min(self.config.tpm, self.token_bucket + reserved_tokens)
+        self.curr_day_requests = max(0, self.curr_day_requests - 1)
+        self.curr_day_tokens = max(0, self.curr_day_tokens - reserved_tokens)
 
 
 class ModelManager:
@@ -128,31 +228,82 @@ class ModelManager:
     
     def __init__(self):
         self.trackers: Dict[str, ModelRateLimitTracker] = {}
-        self._api_key = os.getenv("GROQ_API_KEY")
+        self._models: Dict[str, ChatGroq] = {}
+        # One connection pool to api.groq.com shared by every model
+        self._http: Optional[httpx.AsyncClient] = None
+        # Per-model concurrency caps sized from RPM so fan-out doesn't trip 429s
+        self._semaphores: Dict[str, asyncio.Semaphore] = {
+            name: asyncio.Semaphore(max(1, config.rpm // 10))
+            for name, config in MODEL_CONFIGS.items()
+        }
     
     def _get_tracker(self, model_name: str) -> ModelRateLimitTracker:
         """Get or create a rate limit tracker for a model."""
-        if model_name not in self.trackers:
-            config = MODEL_CONFIGS.get(model_name)
-            if not config:
-                raise ValueError(f"Unknown model: {model_name}")
-            self.trackers[model_name] = ModelRateLimitTracker(model_name, config)
-        return self.trackers[model_name]
+        tracker = self.trackers.get(model_name)
+        if tracker is None:
+            try:
+                config, _ = _RESOLVED[model_name]
+            except KeyError:
+                raise ValueError(f"Unknown model: {model_name}") from None
+            tracker = self.trackers[model_name] = ModelRateLimitTracker(model_name, config)
+        return tracker
+    
+    def _http_client(self) -> httpx.AsyncClient:
+        """Get the shared async HTTP client, creating it on first use."""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=60.0,
+                # Keep idle connections well past httpx's 5 s default so the
+                # next chat turn reuses the TLS session instead of reconnecting
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+            )
+        return self._http
+    
+    async def aclose(self):
+        """Close the shared HTTP client (cached models are rebuilt on next use)."""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._models.clear()
     
     def get_model(self, model_name: str) -> ChatGroq:
-        """Get a ChatGroq instance for the specified model."""
-        config = MODEL_CONFIGS.get(model_name)
-        if not config:
-            raise ValueError(f"Unknown model: {model_name}")
+        """
+        Get the ChatGroq instance for the specified model.
+        Instances are created once per model and reused (they are stateless
+        between calls). All instances share one async HTTP client, so
+        concurrent requests to different models reuse the same connections.
+        """
+        llm = self._models.get(model_name)
+        if llm is not None:
+            return llm
         
-        return ChatGroq(
-            api_key=self._api_key,
+        try:
+            config, api_key = _RESOLVED[model_name]
+        except KeyError:
+            raise ValueError(f"Unknown model: {model_name}") from None
+        
+        llm = ChatGroq(
+            api_key=api_key,
             model=config.id,
             temperature=config.temperature,
             max_tokens=config.max_tokens,
             streaming=config.streaming,
             max_retries=3, # Retry network errors
+            http_async_client=self._http_client(),
         )
+        self._models[model_name] = llm
+        return llm
+    
+    def concurrency(self, model_name: str) -> asyncio.Semaphore:
+        """
+        Get the semaphore bounding in-flight requests to a model.
+        Use as: `async with model_manager.concurrency(name): ...`
+        """
+        try:
+            return self._semaphores[model_name]
+        except KeyError:
+            raise ValueError(f"Unknown model: {model_name}") from None
     
     def check_rate_limit(self, model_name: str, estimated_tokens: int = 100) -> tuple[bool, str]:
         """Check if a model can handle a request."""
@@ -164,43 +315,149 @@ class ModelManager:
         tracker = self._get_tracker(model_name)
         tracker.record_request(tokens_used)
     
+    async def _ainvoke_reserved(self, model_name: str, messages: list, estimated_tokens: int, llm=None):
+        """
+        Invoke a model under a rate-limit reservation.
+        The reservation is settled with actual usage on success and released
+        if the call fails. A call cancelled after its request was sent keeps
+        the reservation: the provider has it and bills it anyway. `llm`
+        overrides the model's default client (e.g. one bound to other
+        sampling parameters).
+        Returns: the raw LLM response
+        """
+        tracker = self._get_tracker(model_name)
+        can_use, error = tracker.try_reserve(estimated_tokens)
+        if not can_use:
+            raise Exception(error)
+        
+        sent = False
+        try:
+            llm = llm or self.get_model(model_name)
+            async with self.concurrency(model_name):
+                sent = True
+                response = await llm.ainvoke(messages)
+        except asyncio.CancelledError:
+            if not sent:
+                tracker.release(estimated_tokens)
+            raise
+        except BaseException:
+            tracker.release(estimated_tokens)
+            raise
+        tracker.settle(estimated_tokens, get_usage_tokens(response))
+        return response
+    
+    async def ainvoke_reserved(self, model_name: str, messages: list, llm=None):
+        """
+        Invoke `llm` (default: the model's own client) under a rate-limit
+        reservation and the model's concurrency bound.
+        Returns: the raw LLM response
+        Raises: Exception if the model is rate limited
+        """
+        return await self._ainvoke_reserved(model_name, messages, estimate_message_tokens(messages), llm)
+    
+    async def _ainvoke(self, model_name: str, messages: list, estimated_tokens: int = 100) -> tuple[str, str, int]:
+        """Invoke a single model. Returns: (response_content, model_name, tokens_used)"""
+        response = await self._ainvoke_reserved(model_name, messages, estimated_tokens)
+        return response.content, model_name, get_usage_tokens(response)
+    
     async def invoke_with_fallback(
         self,
         primary_model: str,
         fallback_model: Optional[str],
         messages: list,
-        estimated_tokens: int = 100
+        estimated_tokens: Optional[int] = None,
+        hedge_delay: Optional[float] = None
     ) -> tuple[str, str, int]:
         """
         Invoke a model with optional fallback on rate limit or error.
+        
+        By default the fallback is only tried once the primary has failed.
+        Hedging is opt-in: with a `hedge_delay`, a primary that has not
+        answered within that many seconds gets the fallback raced against it,
+        the first successful response wins and the other request is
+        cancelled. Pick the delay from the primary's observed latency (e.g.
+        its p95): every hedge is a second billed request, and the cancelled
+        one keeps its rate-limit reservation.
+        
         Returns: (response_content, model_used, tokens_used)
         """
-        # Try primary model
-        can_use, error = self.check_rate_limit(primary_model, estimated_tokens)
-        if can_use:
-            try:
-                llm = self.get_model(primary_model)
-                response = await llm.ainvoke(messages)
-                tokens = len(response.content) // 4  # Rough estimate
-                self.record_usage(primary_model, tokens)
-                return response.content, primary_model, tokens
-            except Exception as e:
-                if fallback_model:
-                    pass  # Try fallback
-                else:
-                    raise e
+        if estimated_tokens is None:
+            estimated_tokens = estimate_message_tokens(messages)
         
-        # Try fallback if available
-        if fallback_model:
-            can_use, error = self.check_rate_limit(fallback_model, estimated_tokens)
-            if can_use:
-                llm = self.get_model(fallback_model)
-                response = await llm.ainvoke(messages)
-                tokens = len(response.content) // 4
-                self.record_usage(fallback_model, tokens)
-                return response.content, fallback_model, tokens
+        # Rate limits are checked once, by each request's reservation: a
+        # rate-limited model fails fast like any other error and hands over
+        # to the next candidate immediately.
+        candidates = [m for m in (primary_model, fallback_model) if m]
+        pending = {asyncio.create_task(self._ainvoke(candidates[0], messages, estimated_tokens))}
+        backups = candidates[1:]
+        last_exc: Optional[BaseException] = None
+        
+        try:
+            while pending:
+                # Give the current request a head start before hedging
+                timeout = hedge_delay if backups else None
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_exc = task.exception()
+                
+                # Timed out or the running request failed: launch the backup
+                if backups and (not done or not pending):
+                    pending.add(asyncio.create_task(
+                        self._ainvoke(backups.pop(0), messages, estimated_tokens)
+                    ))
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # Let cancelled requests settle their reservations
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        raise RuntimeError(f"All models unavailable: {last_exc}") from last_exc
+    
+    async def ainvoke_batched(
+        self,
+        model_name: str,
+        prompts: list[str],
+        system_prompt: str
+    ) -> list[str]:
+        """
+        Solve several independent prompts with a single request.
+        The model is asked for a JSON object keyed by problem number, so N
+        sub-questions cost one RPM slot instead of N.
+        
+        Returns: answers in the same order as `prompts`
+        Raises: ValueError if the response cannot be mapped back to every prompt
+        """
+        problems = "\n\n".join(f"Bài {i}: {p}" for i, p in enumerate(prompts, 1))
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=build_batch_solve_prompt(problems=problems)),
+        ]
+        
+        response = await self._ainvoke_reserved(
+            model_name, messages, estimate_message_tokens(messages)
+        )
+        
+        content = response.content.strip()
+        if "```json" in content:
+            content = content.split("```json")[1].split("```")[0].strip()
+        elif "```" in content:
+            content = content.split("```")[1].split("```")[0].strip()
+        # LaTeX backslashes are frequently left unescaped; the repair leaves
+        # valid escapes intact, so one parse covers both cases
+        answers = json.loads(_repair_escapes(content))
         
-        raise Exception(error or "All models rate limited")
+        if not isinstance(answers, dict):
+            raise ValueError("Batched response is not a JSON object")
+        results = [answers.get(str(i)) for i in range(1, len(prompts) + 1)]
+        if not all(results):
+            raise ValueError("Batched response is missing answers")
+        return [str(r) for r in results]
 
 
 # Global model manager instance
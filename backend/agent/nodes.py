@@ -2,14 +2,27 @@
 LangGraph node implementations for the multi-agent algebra chatbot.
 Agents: ocr_agent, planner, parallel_executor, synthetic_agent
 Tools: wolfram_tool_node, code_tool_node
+Fan-out: question_worker_node (one per work unit via Send), collect_results_node
 """
+import io
 import os
 import time
 import json
 import re
+import random
 import asyncio
+import hashlib
+from collections import OrderedDict
+from itertools import islice
+from contextlib import aclosing
 from typing import List, Dict, Any, Optional
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.types import Send
+try:
+    import orjson  # Installed with langsmith; C parser for planner plans
+except ImportError:
+    orjson = None
 
 from backend.agent.state import (
     AgentState, ToolCall, ModelCall,
@@ -18,6 +31,7 @@ from backend.agent.state import (
 from backend.agent.models import model_manager, get_model
 from backend.tools.wolfram import query_wolfram_alpha
 from backend.tools.code_executor import CodeTool
+from backend.utils.rate_limit import query_cache
 from backend.utils.memory import (
     memory_tracker, estimate_tokens, estimate_message_tokens,
     TokenOverflowError, truncate_history_to_fit
@@ -26,11 +40,15 @@ from backend.utils.memory import (
 
 from backend.agent.prompts import (
     OCR_PROMPT,
-    SYNTHETIC_PROMPT,
-    CODEGEN_PROMPT,
-    CODEGEN_FIX_PROMPT,
+    SYNTHETIC_SYSTEM_PROMPT,
     PLANNER_SYSTEM_PROMPT,
-    PLANNER_USER_PROMPT
+    DIRECT_SOLVE_SYSTEM_PROMPT,
+    build_synthetic_prompt,
+    build_codegen_prompt,
+    build_batch_codegen_prompt,
+    build_codegen_fix_prompt,
+    build_planner_user_prompt,
+    build_history_summary_prompt,
 )
 
 
@@ -38,6 +56,10 @@ from backend.agent.prompts import (
 # HELPER FUNCTIONS FOR OUTPUT FORMATTING
 # ============================================================================
 
+_RE_NL3 = re.compile(r'\n{3,}')
+_RE_MATH_BLOCK = re.compile(r'\$\$(.*?)(?:\$\$|\Z)', re.DOTALL)
+
+
 def format_latex_for_markdown(text: str) -> str:
     """
     Format LaTeX content for proper Markdown rendering.
@@ -55,37 +77,210 @@ def format_latex_for_markdown(text: str) -> str:
     """
     if not text:
         return text
-    
-    # Split by $$ to separate math blocks from text
-    parts = text.split('$$')
-    
-    formatted_parts = []
-    for i, part in enumerate(parts):
-        if i % 2 == 0:
-            # OUTSIDE math block (text content)
-            # Add paragraph spacing for better readability
-            # But be careful not to add excessive whitespace
-            formatted_parts.append(part)
-        else:
-            # INSIDE math block - preserve exactly as-is
-            # Just wrap with $$ and ensure it's on its own line
-            formatted_parts.append(f'\n$$\n{part.strip()}\n$$\n')
-    
-    # Rejoin: even parts are text, odd parts are already formatted with $$
-    result = ''
-    for i, part in enumerate(formatted_parts):
-        if i % 2 == 0:
-            result += part
-        else:
-            # This is the formatted math block, append directly
-            result += part
+    if "$$" not in text:
+        # No math blocks (plain prose, inline $...$ only): whitespace cleanup only
+        return _RE_NL3.sub('\n\n', text).strip()
+    
+    # Single scan: copy text spans as-is and re-emit each math block with
+    # $$ on its own lines (content preserved). An unclosed $$ runs to the end.
+    buf = []
+    last = 0
+    for m in _RE_MATH_BLOCK.finditer(text):
+        buf.append(text[last:m.start()])
+        buf.append(f'\n$$\n{m.group(1).strip()}\n$$\n')
+        last = m.end()
+    buf.append(text[last:])
     
     # Clean up excessive whitespace (more than 2 consecutive newlines)
-    result = re.sub(r'\n{3,}', '\n\n', result)
-    
-    return result.strip()
+    return _RE_NL3.sub('\n\n', ''.join(buf)).strip()
+
+
+# ============================================================================
+# HELPER FUNCTIONS FOR PLANNER JSON RECOVERY
+# ============================================================================
+
+# Escapes kept as-is inside JSON strings. \b and \f are left out on purpose:
+# in planner output they are always LaTeX (\frac, \beta), never control chars
+_JSON_ESCAPES = frozenset('"\\/nrtu')
+# Last-resort question extractor for plans that still fail to parse
+_RE_PLAN_QUESTION = re.compile(
+    r'"id"\s*:\s*(\d+).*?"content"\s*:\s*"([^"]*)".*?"type"\s*:\s*"(direct|wolfram|code)"',
+    re.DOTALL
+)
+
+
+def _strip_code_fence(content: str) -> str:
+    """Return the body of the first ``` fenced block, or the content unchanged."""
+    start = content.find("```")
+    if start == -1:
+        return content
+    start += 3
+    if content.startswith("json", start):
+        start += 4
+    end = content.find("```", start)
+    return content[start:end if end != -1 else len(content)].strip()
+
+
+def _loads(text: str):
+    """json.loads via orjson when available; falls back to the stdlib for
+    inputs orjson rejects (raw control characters inside strings)."""
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    # strict=False tolerates raw newlines inside strings
+    return json.loads(text, strict=False)
+
+
+def _recover_json(content: str) -> Optional[dict]:
+    """
+    Parse the first balanced JSON object in an LLM response.
+    Single pass: tracks brace depth and string state to find the object's
+    end, and doubles backslashes that are not valid JSON escapes (LaTeX
+    like `\\iint`) on the way. Returns None if no object can be parsed.
+    """
+    start = content.find("{")
+    if start == -1:
+        return None
+    
+    buf = []
+    seg = start  # Start of the pending unmodified slice
+    depth = 0
+    in_string = False
+    i, n = start, len(content)
+    while i < n:
+        ch = content[i]
+        if in_string:
+            if ch == "\\":
+                if i + 1 < n and content[i + 1] in _JSON_ESCAPES:
+                    i += 2  # Valid escape, keep both characters
+                    continue
+                buf.append(content[seg:i + 1])
+                buf.append("\\")
+                seg = i + 1
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                buf.append(content[seg:i + 1])
+                try:
+                    obj = _loads("".join(buf))
+                except ValueError:
+                    return None
+                return obj if isinstance(obj, dict) else None
+        i += 1
+    return None
+
+
+# Immutable system messages, built once and reused by every request
+_PLANNER_SYS = SystemMessage(content=PLANNER_SYSTEM_PROMPT)
+_PLANNER_SYS_TOKENS = estimate_tokens(PLANNER_SYSTEM_PROMPT)
+PLANNER_MAX_CONTEXT_TOKENS = 200000  # Leave room within 256K limit
+PLANNER_RESPONSE_RESERVE = 4096
+_SYNTH_SYS = SystemMessage(content=SYNTHETIC_SYSTEM_PROMPT)
+_DIRECT_SOLVE_SYS = SystemMessage(content=DIRECT_SOLVE_SYSTEM_PROMPT)
+
+
+async def _astream_content(llm, messages: list, stop_after_json_block: bool = False) -> str:
+    """
+    Stream a chat completion and return its text.
+    With `stop_after_json_block`, reading stops as soon as a ```json block has
+    closed: the planner ignores anything after it, so the tail is not awaited.
+    """
+    text = ""
+    fence = -1  # Start of the ```json fence, once seen
+    scan = 0  # Where the next search resumes: only new text (plus a possibly split fence) is searched
+    async with aclosing(llm.astream(messages)) as stream:
+        async for chunk in stream:
+            text += chunk.content
+            if stop_after_json_block:
+                if fence == -1:
+                    fence = text.find("```json", scan)
+                    if fence == -1:
+                        scan = max(0, len(text) - 6)
+                        continue
+                    scan = fence + 7
+                if text.find("```", scan) != -1:
+                    break
+                scan = max(fence + 7, len(text) - 2)
+    return text
+
+
+# Node-level fan-out caps (per-model semaphores in model_manager bound each
+# provider; these bound how many images/questions are in flight at all)
+_OCR_SEM = asyncio.Semaphore(int(os.getenv("OCR_CONCURRENCY", "4")))
+_EXEC_SEM = asyncio.Semaphore(int(os.getenv("EXEC_CONCURRENCY", "6")))
+
+# Stateless (each run gets its own temp file + subprocess), so one instance serves all
+_CODE_TOOL = CodeTool()
+
+
+def _elapsed_ms(start_ns: int) -> int:
+    """Milliseconds since a `time.monotonic_ns()` reading."""
+    return (time.monotonic_ns() - start_ns) // 1_000_000
+
+
+def _track_memory(state: AgentState, turn_tokens: int):
+    """
+    Add a turn's tokens to the session memory tracker and mirror its status
+    into state. Returns the new MemoryStatus.
+    """
+    memory_tracker.add_usage(state["session_id"], turn_tokens)
+    new_status = memory_tracker.check_status(state["session_id"])
+    state["session_token_count"] = new_status.used_tokens
+    # Status messages are fixed per status level: only rewrite on a change
+    if new_status.status != state.get("context_status"):
+        state["context_status"] = new_status.status
+        state["context_message"] = new_status.message
+    return new_status
 
 
+def _last_user_idx(state: AgentState) -> Optional[int]:
+    """Index of the current user message: tracked on state by the caller, else found by a backward scan."""
+    idx = state.get("last_user_idx")
+    if idx is None:
+        messages = state.get("messages", [])
+        idx = next(
+            (i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], HumanMessage)),
+            None
+        )
+    return idx
+
+
+# ============================================================================
+# OCR CACHE
+# ============================================================================
+
+# Content-addressed OCR results (BLAKE2b of the image payload -> text), LRU-bounded.
+# Re-entering the OCR node (retries, checkpoint replays) skips the vision-model call.
+OCR_CACHE_SIZE = 128
+_OCR_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _ocr_cache_key(image_data: str) -> str:
+    """Hash the base64 image payload (non-cryptographic use; BLAKE2b is faster than SHA-256)."""
+    return hashlib.blake2b(image_data.encode(), digest_size=16).hexdigest()
+
+
+def _ocr_cache_get(key: str) -> Optional[str]:
+    text = _OCR_CACHE.get(key)
+    if text is not None:
+        _OCR_CACHE.move_to_end(key)
+    return text
+
+
+def _ocr_cache_put(key: str, text: str) -> None:
+    _OCR_CACHE[key] = text
+    _OCR_CACHE.move_to_end(key)
+    while len(_OCR_CACHE) > OCR_CACHE_SIZE:
+        _OCR_CACHE.popitem(last=False)
+
 
 # ============================================================================
 # AGENT NODES
@@ -97,7 +292,6 @@ async def ocr_agent_node(state: AgentState) -> AgentState:
     Supports multiple images with parallel processing.
     Primary: llama-4-maverick, Fallback: llama-4-scout
     """
-    import asyncio
     add_agent_used(state, "ocr_agent")
     
     # Check for images (new list or legacy single image)
@@ -110,12 +304,17 @@ async def ocr_agent_node(state: AgentState) -> AgentState:
         state["current_agent"] = "planner"
         return state
     
-    start_time = time.time()
+    start_ns = time.monotonic_ns()
     primary_model = "llama-4-maverick"
     fallback_model = "llama-4-scout"
     
     async def ocr_single_image(image_data: str, index: int) -> dict:
         """Process a single image and return result dict."""
+        cache_key = _ocr_cache_key(image_data)
+        cached = _ocr_cache_get(cache_key)
+        if cached is not None:
+            return {"image_index": index + 1, "text": cached, "error": None, "cached": True}
+        
         content = [
             {"type": "text", "text": OCR_PROMPT},
             {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
@@ -133,44 +332,62 @@ async def ocr_agent_node(state: AgentState) -> AgentState:
                     return {"image_index": index + 1, "text": None, "error": error}
             
             llm = get_model(model_used)
-            response = await llm.ainvoke(messages)
-            return {"image_index": index + 1, "text": response.content, "error": None}
+            async with model_manager.concurrency(model_used):
+                text = await _astream_content(llm, messages)
+            if text:
+                _ocr_cache_put(cache_key, text)
+            return {"image_index": index + 1, "text": text, "error": None}
             
         except Exception as e:
             return {"image_index": index + 1, "text": None, "error": str(e)}
     
-    # Process all images in parallel
-    tasks = [ocr_single_image(img, i) for i, img in enumerate(image_list)]
+    async def ocr_bounded(image_data: str, index: int) -> dict:
+        async with _OCR_SEM:
+            return await ocr_single_image(image_data, index)
+    
+    # Process all images in parallel (at most OCR_CONCURRENCY at a time)
+    tasks = [ocr_bounded(img, i) for i, img in enumerate(image_list)]
     results = await asyncio.gather(*tasks)
     
-    duration_ms = int((time.time() - start_time) * 1000)
+    duration_ms = _elapsed_ms(start_ns)
     
     # Store results
     state["ocr_results"] = results
     
-    # Build combined OCR text for backward compatibility
+    # One pass over results: combined OCR text (backward compatibility),
+    # invoked-model metrics (cache hits cost no tokens) and errors
+    multi = len(image_list) > 1
     successful_texts = []
+    errors = []
+    invoked = 0
+    invoked_tokens_out = 0
+    invoked_success = False
     for r in results:
-        if r["text"]:
-            if len(image_list) > 1:
-                successful_texts.append(f"[Ảnh {r['image_index']}]:\n{r['text']}")
-            else:
-                successful_texts.append(r["text"])
-    
-    state["ocr_text"] = "\n\n".join(successful_texts) if successful_texts else None
+        text = r["text"]
+        if text:
+            successful_texts.append(f"[Ảnh {r['image_index']}]:\n{text}" if multi else text)
+        if r["error"]:
+            errors.append(f"Ảnh {r['image_index']}: {r['error']}")
+        if not r.get("cached"):
+            invoked += 1
+            if text:
+                invoked_tokens_out += estimate_tokens(text)
+                invoked_success = True
+    
+    state["ocr_text"] = "\n\n".join(successful_texts) or None
     
     # Log model calls
-    add_model_call(state, ModelCall(
-        model=primary_model,
-        agent="ocr_agent",
-        tokens_in=500 * len(image_list),
-        tokens_out=sum(len(r.get("text", "") or "") // 4 for r in results),
-        duration_ms=duration_ms,
-        success=any(r["text"] for r in results)
-    ))
+    if invoked:
+        add_model_call(state, ModelCall(
+            model=primary_model,
+            agent="ocr_agent",
+            tokens_in=500 * invoked,
+            tokens_out=invoked_tokens_out,
+            duration_ms=duration_ms,
+            success=invoked_success
+        ))
     
     # Report any errors but continue
-    errors = [f"Ảnh {r['image_index']}: {r['error']}" for r in results if r["error"]]
     if errors and not successful_texts:
         state["error_message"] = "OCR failed: " + "; ".join(errors)
     
@@ -185,23 +402,23 @@ async def planner_node(state: AgentState) -> AgentState:
     Creates an execution plan for parallel processing.
     NOW WITH FULL CONVERSATION HISTORY FOR MEMORY!
     """
-    import asyncio
     add_agent_used(state, "planner")
     
-    start_time = time.time()
+    start_ns = time.monotonic_ns()
     model_name = "kimi-k2"
     
-    # Get user text from last message
+    # Get user text from last message (index tracked on state by the caller)
+    history_messages = state.get("messages", [])
+    last_user_idx = _last_user_idx(state)
     user_text = ""
-    for msg in reversed(state["messages"]):
-        if isinstance(msg, HumanMessage):
-            user_text = msg.content if isinstance(msg.content, str) else str(msg.content)
-            break
+    if last_user_idx is not None:
+        content = history_messages[last_user_idx].content
+        user_text = content if isinstance(content, str) else str(content)
     
     ocr_text = state.get("ocr_text") or "(Không có ảnh)"
     
     # Build user prompt for current request
-    current_prompt = PLANNER_USER_PROMPT.format(
+    current_prompt = build_planner_user_prompt(
         user_text=user_text or "(Không có text)",
         ocr_text=ocr_text
     )
@@ -212,25 +429,34 @@ async def planner_node(state: AgentState) -> AgentState:
     llm_messages = []
     
     # 1. Add system prompt with memory-awareness instructions
-    llm_messages.append(SystemMessage(content=PLANNER_SYSTEM_PROMPT))
+    llm_messages.append(_PLANNER_SYS)
     
     # 2. Add truncated conversation history (smart token management)
-    history_messages = state.get("messages", [])
-    # Exclude the last message since we'll add current_prompt separately
-    if history_messages:
-        history_to_include = history_messages[:-1] if len(history_messages) > 1 else []
-    else:
-        history_to_include = []
+    # Exclude the current user message since we'll add current_prompt separately
+    history_end = last_user_idx if last_user_idx is not None else max(len(history_messages) - 1, 0)
     
-    # Truncate history to fit within token limits
-    system_tokens = estimate_tokens(PLANNER_SYSTEM_PROMPT)
+    # Truncate history to fit within token limits (only when it doesn't fit:
+    # short sessions use the history as-is)
+    system_tokens = _PLANNER_SYS_TOKENS
     current_tokens = estimate_tokens(current_prompt)
-    truncated_history = truncate_history_to_fit(
-        history_to_include,
-        system_tokens=system_tokens,
-        current_tokens=current_tokens,
-        max_context_tokens=200000  # Leave room within 256K limit
-    )
+    if history_end == 0:
+        truncated_history = []
+        history_tokens = 0
+    else:
+        history_tokens = estimate_message_tokens(islice(history_messages, history_end))
+        budget = PLANNER_MAX_CONTEXT_TOKENS - PLANNER_RESPONSE_RESERVE
+        if system_tokens + current_tokens + history_tokens <= budget:
+            truncated_history = history_messages[:history_end]
+        else:
+            truncated_history = truncate_history_to_fit(
+                history_messages,
+                system_tokens=system_tokens,
+                current_tokens=current_tokens,
+                max_context_tokens=PLANNER_MAX_CONTEXT_TOKENS,
+                reserve_for_response=PLANNER_RESPONSE_RESERVE,
+                end=history_end
+            )
+            history_tokens = estimate_message_tokens(truncated_history)
     
     # Add history messages
     for msg in truncated_history:
@@ -240,160 +466,93 @@ async def planner_node(state: AgentState) -> AgentState:
     llm_messages.append(HumanMessage(content=current_prompt))
     
     # Calculate total input tokens for tracking
-    total_input_tokens = system_tokens + estimate_message_tokens(truncated_history) + current_tokens
+    total_input_tokens = system_tokens + history_tokens + current_tokens
+    
+    # Standalone (first-turn) requests are cacheable: the plan depends only on
+    # the user and OCR text. Later turns may refer back to the history.
+    cache_context = f"planner:{ocr_text}" if history_end == 0 else None
     
     try:
-        llm = get_model(model_name)
-        response = await llm.ainvoke(llm_messages)
-        content = response.content.strip()
+        content = query_cache.get(user_text, cache_context) if cache_context else None
+        cache_hit = content is not None
+        if not cache_hit:
+            llm = get_model(model_name)
+            content = (await _astream_content(llm, llm_messages, stop_after_json_block=True)).strip()
         
-        duration_ms = int((time.time() - start_time) * 1000)
-        add_model_call(state, ModelCall(
-            model=model_name,
-            agent="planner",
-            tokens_in=total_input_tokens,
-            tokens_out=len(content) // 4,
-            duration_ms=duration_ms,
-            success=True
-        ))
+        # Counted once; every branch below reports the same output size
+        tokens_out = estimate_tokens(content)
         
-        # Parse JSON from response
-        # Handle markdown code blocks
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
+        if cache_hit:
+            add_model_call(state, ModelCall(
+                model="query-cache",
+                agent="planner",
+                tokens_in=0,
+                tokens_out=0,
+                duration_ms=_elapsed_ms(start_ns),
+                success=True
+            ))
+        else:
+            duration_ms = _elapsed_ms(start_ns)
+            add_model_call(state, ModelCall(
+                model=model_name,
+                agent="planner",
+                tokens_in=total_input_tokens,
+                tokens_out=tokens_out,
+                duration_ms=duration_ms,
+                success=True
+            ))
         
-        try:
-            # Try to parse JSON (Mixed/Tool Case)
-            plan = json.loads(content)
-        except json.JSONDecodeError:
-            try:
-                # Try repair: Fix invalid escapes for LaTeX (e.g., \frac -> \\frac)
-                # Matches backslash NOT followed by valid JSON escape chars (excluding \\ itself)
-                fixed_content = re.sub(r'\\(?![unrtbf"\/])', r'\\\\', content)
-                plan = json.loads(fixed_content)
-            except Exception:
-                # If JSON parsing fails completely, try Regex Fallback
-                # This catches cases where LLM returns valid-looking JSON but with syntax errors
-                if content.strip().startswith("{") and '"questions"' in content:
-                    # Attempt to extract answers using Regex
-                    # Pattern: "answer": "..." (handling escaped quotes is hard in regex, simplified)
-                    import re
-                    # Extract individual question blocks (simplified assumption)
-                    # Use a rough scan for "answer": "..."
-                    # Find all "answer": "(.*?)" where content is non-greedy until next quote
-                    # Note: this is fragile but better than raw JSON
-                    
-                    # Better fallback: Just treat it as raw text but tell user format error
-                    pass
-
-                # If JSON fails, it means Planner returned Direct Text Answer (All Direct Case)
-                # OR malformed JSON that looks like text.
-                
-                # Check directly if it looks like the raw JSON output
-                if content.strip().startswith('{') and '"type": "direct"' in content:
-                     # This is likely the malformed JSON case the user saw
-                     # Use Regex to extract answers
-                     answers = re.findall(r'"answer":\s*"(.*?)(?<!\\)"', content, re.DOTALL)
-                     if answers:
-                         # Unescape the extracted string somewhat
-                         final_parts = []
-                         for i, ans in enumerate(answers):
-                             # excessive backslashes might be present
-                             clean_ans = ans.replace('\\"', '"').replace('\\n', '\n')
-                             # Use helper to properly format LaTeX for Markdown
-                             formatted_answer = format_latex_for_markdown(clean_ans)
-                             final_parts.append(f"## Bài {i+1}:\n{formatted_answer}\n")
-                         
-                         final_response = "\n".join(final_parts)
-                         
-                         # Update memory & return
-                         session_id = state["session_id"]
-                         tokens_in = total_input_tokens
-                         tokens_out = len(content) // 4
-                         total_turn_tokens = tokens_in + tokens_out
-                         memory_tracker.add_usage(session_id, total_turn_tokens)
-                         new_status = memory_tracker.check_status(session_id)
-                         state["session_token_count"] = new_status.used_tokens
-                         state["context_status"] = new_status.status
-                         state["context_message"] = new_status.message
-                         
-                         state["execution_plan"] = None
-                         state["final_response"] = final_response
-                         state["messages"].append(AIMessage(content=final_response))
-                         state["current_agent"] = "done"
-                         return state
-
-                # Update memory tracking (consistent with other agents)
-                session_id = state["session_id"]
-                tokens_in = total_input_tokens
-                tokens_out = len(content) // 4
-                total_turn_tokens = tokens_in + tokens_out
-                memory_tracker.add_usage(session_id, total_turn_tokens)
-                new_status = memory_tracker.check_status(session_id)
-                state["session_token_count"] = new_status.used_tokens
-                state["context_status"] = new_status.status
-                state["context_message"] = new_status.message
-                
-                # Check for memory overflow
-                if new_status.status == "blocked":
-                    state["final_response"] = new_status.message
-                    state["current_agent"] = "done"
-                    return state
-                
-                # CRITICAL: Check if content looks like JSON with tool questions
-                # If so, try to route to executor instead of displaying raw JSON
-                if content.strip().startswith('{') and '"questions"' in content:
-                    # This is JSON that failed parsing but contains questions
-                    # Try one more time with aggressive repair
-                    try:
-                        # Remove control characters and fix common issues
-                        import re as regex_module
-                        aggressive_fix = content
-                        # Fix unescaped backslashes in LaTeX (including doubling existing ones)
-                        aggressive_fix = regex_module.sub(r'\\(?![unrtbf"\/])', r'\\\\', aggressive_fix)
-                        # Try parsing
-                        parsed_plan = json.loads(aggressive_fix)
-                        if parsed_plan.get("questions"):
-                            # Success! Route to executor
-                            state["execution_plan"] = parsed_plan
-                            state["current_agent"] = "executor"
-                            return state
-                    except:
-                        pass
-                    
-                    # If still unparseable, try manual extraction
-                    # Extract questions array manually with regex
-                    try:
-                        # Find id, content, type, tool_input for each question
-                        q_matches = re.findall(r'"id"\s*:\s*(\d+).*?"content"\s*:\s*"([^"]*)".*?"type"\s*:\s*"(direct|wolfram|code)"', content, re.DOTALL)
-                        if q_matches:
-                            manual_plan = {"questions": []}
-                            for q_id, q_content, q_type in q_matches:
-                                q_entry = {"id": int(q_id), "content": q_content, "type": q_type, "answer": None}
-                                if q_type in ["wolfram", "code"]:
-                                    q_entry["tool_input"] = q_content
-                                manual_plan["questions"].append(q_entry)
-                            
-                            state["execution_plan"] = manual_plan
-                            state["current_agent"] = "executor"
-                            return state
-                    except:
-                        pass
+        # Parse JSON from response (Mixed/Tool Case); one pass strips the
+        # markdown fence, finds the object and repairs LaTeX escapes
+        content = _strip_code_fence(content)
+        plan = _recover_json(content)
+        
+        # Cache usable responses (a plan or a text answer, not malformed JSON)
+        if cache_context and not cache_hit and (plan is not None or not content.startswith('{')):
+            query_cache.set(user_text, content, cache_context)
+        
+        if plan is None or "questions" not in plan:
+            # Not JSON: Planner returned Direct Text Answer (All Direct Case)
+            # OR malformed JSON that looks like text.
+            
+            # Update memory tracking (consistent with other agents)
+            new_status = _track_memory(state, total_input_tokens + tokens_out)
+            
+            # Check for memory overflow
+            if new_status.status == "blocked":
+                state["final_response"] = new_status.message
+                state["current_agent"] = "done"
+                return state
+            
+            # CRITICAL: Check if content looks like JSON with tool questions
+            # If so, try to route to executor instead of displaying raw JSON
+            if content.startswith('{') and '"questions"' in content:
+                # Unparseable (e.g. truncated): extract questions manually
+                q_matches = _RE_PLAN_QUESTION.findall(content)
+                if q_matches:
+                    manual_plan = {"questions": []}
+                    for q_id, q_content, q_type in q_matches:
+                        q_entry = {"id": int(q_id), "content": q_content, "type": q_type, "answer": None}
+                        if q_type in ["wolfram", "code"]:
+                            q_entry["tool_input"] = q_content
+                        manual_plan["questions"].append(q_entry)
                     
-                    # Last resort: Show error message instead of raw JSON
-                    state["execution_plan"] = None
-                    state["final_response"] = "Xin lỗi, hệ thống gặp lỗi khi phân tích câu hỏi. Vui lòng thử lại hoặc diễn đạt câu hỏi khác đi."
-                    state["current_agent"] = "done"
+                    state["execution_plan"] = manual_plan
+                    state["current_agent"] = "executor"
                     return state
                 
-                # Treat as final answer (only if NOT JSON)
+                # Last resort: Show error message instead of raw JSON
                 state["execution_plan"] = None
-                state["final_response"] = content
-                state["messages"].append(AIMessage(content=content))
+                state["final_response"] = "Xin lỗi, hệ thống gặp lỗi khi phân tích câu hỏi. Vui lòng thử lại hoặc diễn đạt câu hỏi khác đi."
                 state["current_agent"] = "done"
                 return state
+            
+            # Treat as final answer (only if NOT JSON)
+            state["execution_plan"] = None
+            state["final_response"] = content
+            state["messages"].append(AIMessage(content=content))
+            state["current_agent"] = "done"
+            return state
 
         # If JSON Valid -> Check if all questions are direct (LLM didn't follow prompt correctly)
         all_direct = all(q.get("type") == "direct" for q in plan.get("questions", []))
@@ -428,15 +587,7 @@ async def planner_node(state: AgentState) -> AgentState:
                 state["current_agent"] = "executor"
                 
                 # Update memory tracking
-                session_id = state["session_id"]
-                tokens_in = total_input_tokens
-                tokens_out = len(content) // 4
-                total_turn_tokens = tokens_in + tokens_out
-                memory_tracker.add_usage(session_id, total_turn_tokens)
-                new_status = memory_tracker.check_status(session_id)
-                state["session_token_count"] = new_status.used_tokens
-                state["context_status"] = new_status.status
-                state["context_message"] = new_status.message
+                _track_memory(state, total_input_tokens + tokens_out)
                 return state
             
             state["execution_plan"] = None
@@ -445,15 +596,7 @@ async def planner_node(state: AgentState) -> AgentState:
             state["current_agent"] = "done"
             
             # Update memory tracking
-            session_id = state["session_id"]
-            tokens_in = total_input_tokens
-            tokens_out = len(content) // 4
-            total_turn_tokens = tokens_in + tokens_out
-            memory_tracker.add_usage(session_id, total_turn_tokens)
-            new_status = memory_tracker.check_status(session_id)
-            state["session_token_count"] = new_status.used_tokens
-            state["context_status"] = new_status.status
-            state["context_message"] = new_status.message
+            _track_memory(state, total_input_tokens + tokens_out)
             
             return state
         
@@ -462,15 +605,7 @@ async def planner_node(state: AgentState) -> AgentState:
         state["current_agent"] = "executor"
         
         # Update memory tracking (consistent with other agents)
-        session_id = state["session_id"]
-        tokens_in = total_input_tokens
-        tokens_out = len(content) // 4
-        total_turn_tokens = tokens_in + tokens_out
-        memory_tracker.add_usage(session_id, total_turn_tokens)
-        new_status = memory_tracker.check_status(session_id)
-        state["session_token_count"] = new_status.used_tokens
-        state["context_status"] = new_status.status
-        state["context_message"] = new_status.message
+        new_status = _track_memory(state, total_input_tokens + tokens_out)
         
         # Check for memory overflow
         if new_status.status == "blocked":
@@ -482,7 +617,7 @@ async def planner_node(state: AgentState) -> AgentState:
             agent="planner",
             tokens_in=0,
             tokens_out=0,
-            duration_ms=int((time.time() - start_time) * 1000),
+            duration_ms=_elapsed_ms(start_ns),
             success=False,
             error=str(e)
         ))
@@ -506,157 +641,293 @@ async def planner_node(state: AgentState) -> AgentState:
     return state
 
 
-async def parallel_executor_node(state: AgentState) -> AgentState:
+# ============================================================================
+# PARALLEL EXECUTION
+# ============================================================================
+
+# One "### Bài N" section with its ```python block per task in a batched codegen reply
+_RE_BATCH_CODE = re.compile(r'###\s*Bài\s*(\d+).*?```(?:python)?\s*\n(.*?)```', re.DOTALL)
+
+
+async def _generate_code_batched(tasks: List[str]) -> List[Optional[str]]:
     """
-    Parallel Executor: Execute multiple questions in parallel.
-    - Direct questions: Process with kimi-k2
-    - Wolfram questions: Call API in parallel
-    - Code questions: Execute code in parallel
+    Generate code for several tasks with one qwen3-32b request.
+    Returns code per task in order (None where the reply has no block for it).
     """
-    import asyncio
-    add_agent_used(state, "parallel_executor")
+    problems = "\n\n".join(f"Bài {i}: {task}" for i, task in enumerate(tasks, 1))
+    llm = get_model("qwen3-32b")
+    async with model_manager.concurrency("qwen3-32b"):
+        response = await llm.ainvoke([HumanMessage(content=build_batch_codegen_prompt(problems=problems))])
     
-    plan = state.get("execution_plan")
-    if not plan or not plan.get("questions"):
-        # No plan - planner should have handled this, go to done
-        state["current_agent"] = "done"
-        return state
-    
-    questions = plan["questions"]
-    start_time = time.time()
-    
-    async def execute_single_question(q: dict) -> dict:
-        """Execute a single question and return result."""
-        q_id = q.get("id", 0)
-        q_type = q.get("type", "direct")
-        q_content = q.get("content", "")
-        q_tool_input = q.get("tool_input", "")
-        
-        result = {
-            "id": q_id,
-            "content": q_content,
-            "type": q_type,
-            "result": None,
-            "error": None
-        }
-        
-        async def solve_with_code(task_description: str, retries: int = 3) -> dict:
-            """Helper to run code tool with retries."""
-            code_tool = CodeTool()
-            out = {"result": None, "error": None}
-            last_code = ""
-            last_error = ""
-            
-            for attempt in range(retries):
-                try:
+    codes = {int(n): code for n, code in _RE_BATCH_CODE.findall(response.content)}
+    return [codes.get(i) for i in range(1, len(tasks) + 1)]
+
+
+async def _solve_with_code(task_description: str, retries: int = 3, code: Optional[str] = None) -> dict:
+    """
+    Helper to run code tool with retries.
+    `code` (e.g. from a batched codegen request) is used for the first attempt
+    instead of generating it; failures are then fixed individually.
+    Successful outputs are cached per task, so repeated tasks skip codegen and execution.
+    """
+    out = {"result": None, "error": None}
+    cached = query_cache.get(task_description, "code")
+    if cached is not None:
+        out["result"] = cached
+        return out
+    last_code = ""
+    last_error = ""
+    llm = None  # Resolved once, on the first attempt that needs to generate code
+    
+    for attempt in range(retries):
+        try:
+            if attempt > 0 or not code:
+                if llm is None:
                     llm = get_model("qwen3-32b")
+                
+                # SMART RETRY: If we have an error, ask LLM to FIX it
+                if attempt > 0 and last_error:
+                    code_prompt = build_codegen_fix_prompt(code=last_code, error=last_error)
+                else:
+                    code_prompt = build_codegen_prompt(task=task_description)
                     
-                    # SMART RETRY: If we have an error, ask LLM to FIX it
-                    if attempt > 0 and last_error:
-                        code_prompt = CODEGEN_FIX_PROMPT.format(code=last_code, error=last_error)
-                    else:
-                        code_prompt = CODEGEN_PROMPT.format(task=task_description)
-                        
+                async with model_manager.concurrency("qwen3-32b"):
                     code_response = await llm.ainvoke([HumanMessage(content=code_prompt)])
+                
+                code = _extract_code(code_response.content)
+            
+            last_code = code # Save for next retry if needed
+            
+            # Execute (subprocess awaited on the event loop)
+            exec_result = await _CODE_TOOL.aexecute(code)
+            if exec_result.get("success"):
+                out["result"] = exec_result.get("output", "")
+                query_cache.set(task_description, out["result"], "code")
+                return out
+            else:
+                last_error = exec_result.get("error", "Unknown error")
+                if attempt == retries - 1:
+                    out["error"] = last_error
+        except Exception as e:
+            last_error = str(e)
+            if attempt == retries - 1:
+                out["error"] = str(e)
+    return out
+
+
+async def _execute_single_question(q: dict, code: Optional[str] = None) -> dict:
+    """Execute a single question and return result (`code`: pre-generated code for code questions)."""
+    q_id = q.get("id", 0)
+    q_type = q.get("type", "direct")
+    q_content = q.get("content", "")
+    q_tool_input = q.get("tool_input", "")
+    
+    result = {
+        "id": q_id,
+        "content": q_content,
+        "type": q_type,
+        "result": None,
+        "error": None
+    }
+    
+    try:
+        if q_type == "wolfram":
+            wolfram_done = False
+            # Call Wolfram Alpha (with retry logic)
+            # Call Wolfram Alpha (1 attempt only)
+            for attempt in range(1):
+                try:
+                    can_use, err = model_manager.check_rate_limit("wolfram")
+                    if not can_use:
+                        result["error"] = f"Rate limit: {err}"
+                        if attempt == 0: break 
+                        await asyncio.sleep(1)
+                        continue
                     
-                    # Extract code
-                    code = code_response.content
-                    if "```python" in code:
-                        code = code.split("```python")[1].split("```")[0]
-                    elif "```" in code:
-                        code = code.split("```")[1].split("```")[0]
-                    
-                    last_code = code # Save for next retry if needed
-                    
-                    # Execute
-                    exec_result = code_tool.execute(code)
-                    if exec_result.get("success"):
-                        out["result"] = exec_result.get("output", "")
-                        return out
+                    async with model_manager.concurrency("wolfram"):
+                        wolfram_success, wolfram_result = await query_wolfram_alpha(q_tool_input)
+                    if wolfram_success:
+                        result["result"] = wolfram_result
+                        wolfram_done = True
+                        break
                     else:
-                        last_error = exec_result.get("error", "Unknown error")
-                        if attempt == retries - 1:
-                            out["error"] = last_error
+                        # Treat logical failure as exception to trigger retry/fallback
+                        if attempt == 0: raise Exception(wolfram_result)
                 except Exception as e:
-                    last_error = str(e)
-                    if attempt == retries - 1:
-                        out["error"] = str(e)
-            return out
-        
-        try:
-            if q_type == "wolfram":
-                wolfram_done = False
-                # Call Wolfram Alpha (with retry logic)
-                # Call Wolfram Alpha (1 attempt only)
-                for attempt in range(1):
-                    try:
-                        can_use, err = model_manager.check_rate_limit("wolfram")
-                        if not can_use:
-                            if attempt == 0: break 
-                            await asyncio.sleep(1)
-                            continue
-                        
-                        wolfram_success, wolfram_result = await query_wolfram_alpha(q_tool_input)
-                        if wolfram_success:
-                            result["result"] = wolfram_result
-                            wolfram_done = True
-                            break
-                        else:
-                            # Treat logical failure as exception to trigger retry/fallback
-                            if attempt == 0: raise Exception(wolfram_result)
-                    except Exception as e:
-                        if attempt == 0:
-                            result["error"] = f"Wolfram failed: {str(e)}"
-                        await asyncio.sleep(0.5)
+                    if attempt == 0:
+                        result["error"] = f"Wolfram failed: {str(e)}"
+                    await asyncio.sleep(0.5)
+            
+            # --- FALLBACK TO CODE IF WOLFRAM FAILED ---
+            if not wolfram_done:
+                # Append status to result
+                fallback_note = f"\n(Wolfram failed, tried Code fallback)"
                 
-                # --- FALLBACK TO CODE IF WOLFRAM FAILED ---
-                if not wolfram_done:
-                    # Append status to result
-                    fallback_note = f"\n(Wolfram failed, tried Code fallback)"
-                    
-                    code_out = await solve_with_code(q_tool_input)
-                    if code_out["result"]:
-                        result["result"] = code_out["result"] + fallback_note
-                        result["error"] = None # Clear error if fallback succeeded
-                        result["type"] = "wolfram+code" # Indicate hybrid path
-                    else:
-                        result["error"] += f" | Code Fallback also failed: {code_out['error']}"
-
-            elif q_type == "code":
-                # Execute code directly
-                code_out = await solve_with_code(q_tool_input)
-                result["result"] = code_out["result"]
-                result["error"] = code_out["error"]
-
-            else:  # direct
-                # User Optimization: If planner provided answer, use it directly (Save API)
-                if q.get("answer"):
-                    result["result"] = q.get("answer")
+                code_out = await _solve_with_code(q_tool_input)
+                if code_out["result"]:
+                    result["result"] = code_out["result"] + fallback_note
+                    result["error"] = None # Clear error if fallback succeeded
+                    result["type"] = "wolfram+code" # Indicate hybrid path
                 else:
-                    # Fallback: Solve directly with kimi-k2 (if planner forgot answer)
-                    llm = get_model("kimi-k2")
-                    solve_prompt = f"Giải bài toán sau một cách chi tiết:\n{q_content}"
+                    result["error"] = f"{result['error'] or 'Wolfram failed'} | Code Fallback also failed: {code_out['error']}"
+
+        elif q_type == "code":
+            # Execute code directly
+            code_out = await _solve_with_code(q_tool_input, code=code)
+            result["result"] = code_out["result"]
+            result["error"] = code_out["error"]
+
+        else:  # direct
+            # User Optimization: If planner provided answer, use it directly (Save API)
+            if q.get("answer"):
+                result["result"] = q.get("answer")
+            else:
+                # Fallback: Solve directly with kimi-k2 (if planner forgot answer)
+                llm = get_model("kimi-k2")
+                solve_prompt = f"Giải bài toán sau một cách chi tiết:\n{q_content}"
+                async with model_manager.concurrency("kimi-k2"):
                     response = await llm.ainvoke([
-                        SystemMessage(content="Bạn là chuyên gia giải toán. Trả lời ngắn gọn, đúng trọng tâm."),
+                        _DIRECT_SOLVE_SYS,
                         HumanMessage(content=solve_prompt)
                     ])
-                    result["result"] = format_latex_for_markdown(response.content) # Direct result
-                
-        except Exception as e:
-            result["error"] = str(e)
-        
-        return result
+                result["result"] = format_latex_for_markdown(response.content) # Direct result
+                query_cache.set(q_content, result["result"], "direct")
+            
+    except Exception as e:
+        result["error"] = str(e)
     
-    # Execute all questions in parallel
-    tasks = [execute_single_question(q) for q in questions]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return result
+
+
+def _is_unanswered_direct(q: dict) -> bool:
+    """Direct question the planner did not answer (must be solved by kimi-k2)."""
+    return q.get("type", "direct") not in ("wolfram", "code") and not q.get("answer")
+
+
+def group_questions(questions: List[dict]) -> List[List[dict]]:
+    """
+    Split a plan into independent work units for the executor.
+    Unanswered direct questions share one unit (so they can be batched into a
+    single kimi-k2 request), as do code questions (one qwen3-32b codegen
+    request); every other question is its own unit.
+    Each item is {"index": position_in_plan, "question": q}.
+    """
+    direct_batch = []
+    code_batch = []
+    groups = []
+    for i, q in enumerate(questions):
+        item = {"index": i, "question": q}
+        if _is_unanswered_direct(q):
+            direct_batch.append(item)
+        elif q.get("type") == "code":
+            code_batch.append(item)
+        else:
+            groups.append([item])
+    for batch in (code_batch, direct_batch):
+        if len(batch) >= 2:
+            groups.append(batch)
+        else:
+            groups.extend([item] for item in batch)
+    return groups
+
+
+async def execute_question_group(group: List[dict], on_result=None) -> List[dict]:
+    """
+    Execute one work unit from `group_questions`.
+    Returns one output per question: {"index", "duration_ms", "result"}, in
+    completion order. `on_result(output)`, if given, is awaited as each question
+    finishes (the SSE endpoint streams it to the client).
+    """
+    # Batch direct questions the planner left unanswered: they all target
+    # kimi-k2 with the same system prompt, so one request replaces N.
+    unanswered = [item["question"] for item in group if _is_unanswered_direct(item["question"])]
+    # Self-contained direct questions repeat across users: reuse cached answers
+    for q in unanswered:
+        cached = query_cache.get(q.get("content", ""), "direct")
+        if cached is not None:
+            q["answer"] = cached
+    unanswered = [q for q in unanswered if not q.get("answer")]
+    if len(unanswered) >= 2:
+        try:
+            answers = await model_manager.ainvoke_batched(
+                "kimi-k2",
+                [q.get("content", "") for q in unanswered],
+                DIRECT_SOLVE_SYSTEM_PROMPT
+            )
+            for q, answer in zip(unanswered, answers):
+                q["answer"] = format_latex_for_markdown(answer)
+                query_cache.set(q.get("content", ""), q["answer"], "direct")
+        except Exception:
+            pass  # Fall back to solving each question individually
+    
+    # Batch codegen for code questions: one request writes code for all of
+    # them; each is then executed (and fixed on failure) individually.
+    code_items = [
+        item for item in group
+        if item["question"].get("type") == "code"
+        and query_cache.get(item["question"].get("tool_input", ""), "code") is None
+    ]
+    pregenerated = {}
+    if len(code_items) >= 2:
+        try:
+            codes = await _generate_code_batched([
+                item["question"].get("tool_input") or item["question"].get("content", "")
+                for item in code_items
+            ])
+            pregenerated = {item["index"]: code for item, code in zip(code_items, codes) if code}
+        except Exception:
+            pass  # Fall back to generating code per question
+    
+    async def run(item: dict) -> dict:
+        q = item["question"]
+        async with _EXEC_SEM:
+            start_ns = time.monotonic_ns()
+            try:
+                result = await _execute_single_question(q, code=pregenerated.get(item["index"]))
+            except Exception as e:
+                result = {
+                    "id": q.get("id", item["index"] + 1),
+                    "content": q.get("content", ""),
+                    "type": q.get("type", "direct"),
+                    "result": None,
+                    "error": str(e)
+                }
+        return {
+            "index": item["index"],
+            "duration_ms": _elapsed_ms(start_ns),
+            "result": result,
+        }
     
-    # Process results and collect metrics
+    # At most EXEC_CONCURRENCY questions run at once (across all workers);
+    # each model call is also bounded by its per-model semaphore in model_manager
+    outputs = []
+    for next_done in asyncio.as_completed([run(item) for item in group]):
+        output = await next_done
+        outputs.append(output)
+        if on_result:
+            await on_result(output)
+    return outputs
+
+
+def _friendly_executor_error(error_msg: str) -> str:
+    """Map a raw executor error to a user-facing message."""
+    if "413" in error_msg or "Request too large" in error_msg:
+        return "Nội dung quá dài, vui lòng gửi ngắn hơn."
+    elif "rate_limit" in error_msg or "TPM" in error_msg:
+        return "Rate Limit (Quá tải), vui lòng đợi giây lát."
+    return f"Lỗi kỹ thuật: {error_msg}"
+
+
+def _collect_question_results(state: AgentState, questions: List[dict], outputs: List[dict]) -> AgentState:
+    """Fan-in: turn per-question outputs (ordered by plan index) into results and traces."""
     question_results = []
     total_tokens_in = 0
     total_tokens_out = 0
+    total_duration_ms = 0
     
-    for i, r in enumerate(results):
+    for output in outputs:
+        i = output["index"]
+        r = output["result"]
         q = questions[i]
         q_type = q.get("type", "direct")
         
@@ -668,49 +939,28 @@ async def parallel_executor_node(state: AgentState) -> AgentState:
             "error": None,
             "type": q_type
         }
-
-        if isinstance(r, Exception):
-            error_msg = str(r)
-            if "413" in error_msg or "Request too large" in error_msg:
-                friendly = "Nội dung quá dài, vui lòng gửi ngắn hơn."
-            elif "rate_limit" in error_msg or "TPM" in error_msg:
-                friendly = "Rate Limit (Quá tải), vui lòng đợi giây lát."
-            else:
-                friendly = f"Lỗi kỹ thuật: {error_msg}"
-            
+        res_entry.update(r)
+        success = not bool(r.get("error"))
+        r_content = str(r.get("result", ""))
+        
+        # Use friendly error if present in result dict
+        raw_err = r.get("error")
+        if raw_err:
+            friendly = _friendly_executor_error(str(raw_err))
             res_entry["error"] = friendly
-            success = False
             r_content = friendly
-        else:
-            # r is the result dict from execute_single_question
-            res_entry.update(r)
-            success = not bool(r.get("error"))
-            r_content = str(r.get("result", ""))
-            
-            # Use friendly error if present in result dict
-            raw_err = r.get("error")
-            if raw_err:
-                error_msg = str(raw_err)
-                if "413" in error_msg or "Request too large" in error_msg:
-                    friendly = "Nội dung quá dài, vui lòng gửi ngắn hơn."
-                elif "rate_limit" in error_msg or "TPM" in error_msg:
-                    friendly = "Rate Limit (Quá tải), vui lòng đợi giây lát."
-                else:
-                    friendly = f"Lỗi kỹ thuật: {error_msg}"
-                
-                res_entry["error"] = friendly
-                r_content = friendly
 
         question_results.append(res_entry)
         
         # Add individual model call trace for each parallel task
         # This allows the frontend to show "Wolfram", "Code", "Kimi" calls clearly
         
-        # Estimate tokens for metrics (rough check)
-        t_in = len(q.get("content", "")) // 4
-        t_out = len(r_content) // 4
+        # Estimate tokens for metrics
+        t_in = estimate_tokens(q.get("content", ""))
+        t_out = estimate_tokens(r_content)
         total_tokens_in += t_in
         total_tokens_out += t_out
+        total_duration_ms = max(total_duration_ms, output["duration_ms"])
         
         model_name_trace = "unknown"
         if q_type == "wolfram": model_name_trace = "wolfram-alpha"
@@ -722,7 +972,7 @@ async def parallel_executor_node(state: AgentState) -> AgentState:
             agent=f"parallel_executor_q{res_entry['id']}",
             tokens_in=t_in,
             tokens_out=t_out,
-            duration_ms=int((time.time() - start_time) * 1000), # Approx sharing total time
+            duration_ms=output["duration_ms"],
             success=success,
             tool_calls=[{
                 "tool": q_type,
@@ -737,10 +987,8 @@ async def parallel_executor_node(state: AgentState) -> AgentState:
     # Populate legacy fields so the Tracing UI (which expects single tool per turn) shows SOMETHING.
     # We aggregate all parallel results into a single string.
     
-    start_time_ms = int(start_time * 1000)
-    
     # 1. Selected Tool
-    tool_names = list(set(r["type"] for r in question_results))
+    tool_names = list(dict.fromkeys(r["type"] for r in question_results))  # Stable, plan-ordered dedup
     state["selected_tool"] = f"parallel({','.join(tool_names)})"
     state["should_use_tools"] = True
     
@@ -754,25 +1002,27 @@ async def parallel_executor_node(state: AgentState) -> AgentState:
     
     
     # 3. Tools Called (List of ToolCall objects)
-    tools_called_list = []
-    for r in question_results:
-        tools_called_list.append({
-             "tool": r["type"],
-             "tool_input": str(questions[next((i for i, q in enumerate(questions) if q.get("id") == r["id"]), 0)].get("tool_input", "") or r.get("content")),
-             "tool_output": str(r.get("result") or r.get("error"))
-        })
-    state["tools_called"] = tools_called_list
+    # question_results is in lockstep with outputs, which carry each plan index
+    state["tools_called"] = [
+        ToolCall(
+            tool=r["type"],
+            input=str(questions[output["index"]].get("tool_input", "") or r.get("content")),
+            output=str(r.get("result") or r.get("error")),
+            success=not r.get("error"),
+            duration_ms=output["duration_ms"]
+        )
+        for r, output in zip(question_results, outputs)
+    ]
     state["tool_success"] = any(not r.get("error") for r in question_results)
     
     # ---------------------------
     
-    duration_ms = int((time.time() - start_time) * 1000)
     add_model_call(state, ModelCall(
         model="parallel_orchestrator",
         agent="parallel_executor",
         tokens_in=total_tokens_in,
         tokens_out=total_tokens_out,
-        duration_ms=duration_ms,
+        duration_ms=total_duration_ms,
         success=state["tool_success"]
     ))
     
@@ -781,6 +1031,121 @@ async def parallel_executor_node(state: AgentState) -> AgentState:
     return state
 
 
+async def parallel_executor_node(state: AgentState) -> AgentState:
+    """
+    Parallel Executor: Execute multiple questions in parallel within one node.
+    - Direct questions: Process with kimi-k2
+    - Wolfram questions: Call API in parallel
+    - Code questions: Execute code in parallel
+    The compiled graph fans out with `question_worker_node` + `collect_results_node`
+    instead; this node runs the same pipeline in-process.
+    """
+    add_agent_used(state, "parallel_executor")
+    
+    plan = state.get("execution_plan")
+    if not plan or not plan.get("questions"):
+        # No plan - planner should have handled this, go to done
+        state["current_agent"] = "done"
+        return state
+    
+    questions = plan["questions"]
+    groups = group_questions(questions)
+    outputs = []
+    for next_done in asyncio.as_completed([execute_question_group(g) for g in groups]):
+        outputs.extend(await next_done)
+    outputs.sort(key=lambda o: o["index"])
+    return _collect_question_results(state, questions, outputs)
+
+
+async def question_worker_node(payload: dict, config: RunnableConfig) -> dict:
+    """
+    Question Worker: Execute one work unit dispatched by the planner via `Send`.
+    Runs concurrently with other workers; writes only to `_question_outputs`.
+    Each outcome is also passed to the run's `on_question_result` hook, if set.
+    """
+    on_result = config.get("configurable", {}).get("on_question_result")
+    return {"_question_outputs": await execute_question_group(payload["questions"], on_result)}
+
+
+async def collect_results_node(state: AgentState) -> AgentState:
+    """
+    Executor fan-in: gather all worker outputs and build per-question results,
+    traces and legacy UI fields before synthesis.
+    """
+    add_agent_used(state, "parallel_executor")
+    
+    plan = state.get("execution_plan")
+    if not plan or not plan.get("questions"):
+        state["current_agent"] = "done"
+        return state
+    
+    outputs = sorted(state.get("_question_outputs") or [], key=lambda o: o["index"])
+    return _collect_question_results(state, plan["questions"], outputs)
+
+
+# Rolling synthesis history: the most recent messages go to the LLM verbatim,
+# everything older is folded into a short per-session summary (refreshed in
+# the background once enough messages have left the window).
+SYNTH_HISTORY_WINDOW = 6
+SUMMARY_REFRESH_MESSAGES = 10
+_SUMMARY_TASKS: Dict[str, asyncio.Task] = {}
+
+
+async def _refresh_history_summary(session_id: str, messages: list, previous: Optional[str], covered: int) -> None:
+    """Fold `messages` into the session summary, which then covers the first `covered` messages."""
+    lines = []
+    for m in messages:
+        role = "Người dùng" if isinstance(m, HumanMessage) else "Trợ lý"
+        content = m.content if isinstance(m.content, str) else str(m.content)
+        lines.append(f"[{role}]: {content}")
+    prompt = build_history_summary_prompt(
+        previous_summary=previous or "(Chưa có)",
+        history="\n".join(lines)
+    )
+    try:
+        llm = get_model("kimi-k2")
+        async with model_manager.concurrency("kimi-k2"):
+            response = await llm.ainvoke([HumanMessage(content=prompt)])
+        summary = response.content.strip()
+        if summary:
+            memory_tracker.set_summary(session_id, summary, covered)
+    except Exception:
+        pass  # Keep the previous summary; retried on a later turn
+    finally:
+        _SUMMARY_TASKS.pop(session_id, None)
+
+
+def _synthesis_history(state: AgentState) -> list:
+    """
+    History messages for the synthetic agent: the last SYNTH_HISTORY_WINDOW
+    messages, preceded by the stored summary of older turns (if any).
+    Schedules a summary refresh without waiting for it.
+    """
+    messages = state.get("messages", [])
+    recent = messages[-SYNTH_HISTORY_WINDOW:]  # Already a fresh list: returned as-is
+    older = len(messages) - len(recent)
+    if older <= 0:
+        return recent
+    
+    session_id = state["session_id"]
+    summary, covered = memory_tracker.get_summary(session_id)
+    if older - covered >= SUMMARY_REFRESH_MESSAGES and session_id not in _SUMMARY_TASKS:
+        _SUMMARY_TASKS[session_id] = asyncio.create_task(
+            _refresh_history_summary(session_id, messages[covered:older], summary, older)
+        )
+    
+    if not summary:
+        return recent
+    state["history_summary"] = summary
+    recent.insert(0, SystemMessage(content=f"Ngữ cảnh các lượt trước (tóm tắt):\n{summary}"))
+    return recent
+
+
+def _looks_like_final_answer(text: str) -> bool:
+    """Short tool output that is already delimited LaTeX (nothing left to synthesize)."""
+    return len(text) < 2000 and ("$$" in text or "\\begin" in text)
+
+
 # NOTE: reasoning_agent_node has been DEPRECATED and REMOVED.
 # The workflow now flows: OCR -> Planner -> Executor -> Synthetic
 # (See user's workflow diagram for reference)
@@ -793,7 +1158,7 @@ async def synthetic_agent_node(state: AgentState) -> AgentState:
     """
     add_agent_used(state, "synthetic_agent")
     
-    start_time = time.time()
+    start_ns = time.monotonic_ns()
     model_name = "kimi-k2"
     session_id = state["session_id"]
     
@@ -813,8 +1178,8 @@ async def synthetic_agent_node(state: AgentState) -> AgentState:
         # Multi-question mode: combine all results
         # Use LLM to synthesize a natural response instead of raw concatenation
         
-        # Prepare context for synthesis
-        results_context = []
+        # Prepare context for synthesis (one growing buffer for all results)
+        results_context = io.StringIO()
         for r in question_results:
              q_id = r.get("id", 0)
              q_content = r.get("content", "")
@@ -822,22 +1187,20 @@ async def synthetic_agent_node(state: AgentState) -> AgentState:
              q_error = r.get("error")
              
              status = "Thành công" if not q_error else f"Lỗi: {q_error}"
-             results_context.append(f"--- BÀI TOÁN {q_id} ---\nNội dung: {q_content}\nTrạng thái: {status}\nKết quả gốc:\n{q_result}\n\n")
+             results_context.write(f"--- BÀI TOÁN {q_id} ---\nNội dung: {q_content}\nTrạng thái: {status}\nKết quả gốc:\n{q_result}\n\n")
              
-        combined_context = "".join(results_context)
+        combined_context = results_context.getvalue()
         
         # Get original question text for context
         original_q_text = "Nhiều câu hỏi (xem chi tiết bên trên)"
+        user_idx = _last_user_idx(state)
         if state.get("ocr_text"):
              original_q_text = f"[OCR]: {state['ocr_text']}"
-        elif state["messages"]:
-             for m in reversed(state["messages"]):
-                  if isinstance(m, HumanMessage):
-                       original_q_text = str(m.content)
-                       break
+        elif user_idx is not None:
+             original_q_text = str(state["messages"][user_idx].content)
 
         # Use Standard SYNTHETIC_PROMPT
-        synth_prompt = SYNTHETIC_PROMPT.format(
+        synth_prompt = build_synthetic_prompt(
             tool_result=combined_context,
             original_question=original_q_text
         )
@@ -845,27 +1208,20 @@ async def synthetic_agent_node(state: AgentState) -> AgentState:
         # ========================================
         # NEW: Include recent conversation history for contextual synthesis
         # ========================================
+        # System prompt, recent conversation history (last 3 turns = 6 messages,
+        # preceded by a summary of older turns), then the synthesis prompt --
+        # assembled in a single list
         llm_messages = [
-            SystemMessage(content="""Bạn là chuyên gia toán học Việt Nam. Hãy giải thích lời giải một cách sư phạm, dễ hiểu.
-            
-VỀ BỘ NHỚ HỘI THOẠI:
-- Bạn có thể tham chiếu đến các câu hỏi trước đó trong hội thoại.
-- Nếu người dùng đề cập đến "bài trước", "câu đó", hãy hiểu ngữ cảnh.
-- Trả lời tự nhiên như một cuộc trò chuyện liên tục."""),
+            _SYNTH_SYS,
+            *_synthesis_history(state),
+            HumanMessage(content=synth_prompt),
         ]
         
-        # Add recent conversation history (last 3 turns = 6 messages)
-        recent_history = state.get("messages", [])[-6:]
-        for msg in recent_history:
-            llm_messages.append(msg)
-        
-        # Add synthesis prompt
-        llm_messages.append(HumanMessage(content=synth_prompt))
-        
         try:
              llm = get_model("kimi-k2")
-             response = await llm.ainvoke(llm_messages)
-             final_response = format_latex_for_markdown(response.content)
+             # Streamed: the SSE endpoint forwards chunks while they arrive
+             content = await _astream_content(llm, llm_messages)
+             final_response = format_latex_for_markdown(content)
         except Exception as e:
              # Fallback manual synthesis if LLM fails
              error_msg = str(e)
@@ -883,23 +1239,18 @@ VỀ BỘ NHỚ HỘI THOẠI:
         state["current_agent"] = "done"
         
         # Update memory
-        tokens_out = len(final_response) // 4
-        memory_tracker.add_usage(session_id, tokens_out)
-        new_status = memory_tracker.check_status(session_id)
-        state["session_token_count"] = new_status.used_tokens
-        state["context_status"] = new_status.status
-        state["context_message"] = new_status.message
+        tokens_out = estimate_tokens(final_response)
+        _track_memory(state, tokens_out)
         
         return state
     
     # Single-question mode: original logic
-    # Get original question
+    # Get original question (the current user message)
     original_question = ""
-    if state["messages"]:
-        for msg in state["messages"]:
-            if hasattr(msg, "content") and isinstance(msg, HumanMessage):
-                original_question = msg.content if isinstance(msg.content, str) else str(msg.content)
-                break
+    user_idx = _last_user_idx(state)
+    if user_idx is not None:
+        content = state["messages"][user_idx].content
+        original_question = content if isinstance(content, str) else str(content)
     
     # Add OCR context if available
     if state.get("ocr_text"):
@@ -909,8 +1260,18 @@ VỀ BỘ NHỚ HỘI THOẠI:
     tool_result = state.get("tool_result", "Không có kết quả")
     if not state.get("tool_success"):
         tool_result = f"[Công cụ thất bại]: {state.get('error_message', 'Unknown error')}\n\nHãy cố gắng trả lời dựa trên kiến thức của bạn."
+    elif state.get("selected_tool") == "code" and _looks_like_final_answer(tool_result):
+        # Code already printed a complete LaTeX answer: skip the synthesis hop
+        if "$" not in tool_result:
+            tool_result = f"$${tool_result}$$"  # Bare \begin{...} environment
+        final_response = format_latex_for_markdown(tool_result)
+        state["final_response"] = final_response
+        state["messages"].append(AIMessage(content=final_response))
+        state["current_agent"] = "done"
+        _track_memory(state, estimate_tokens(final_response))
+        return state
     
-    prompt = SYNTHETIC_PROMPT.format(
+    prompt = build_synthetic_prompt(
         tool_result=tool_result,
         original_question=original_question
     )
@@ -920,10 +1281,11 @@ VỀ BỘ NHỚ HỘI THOẠI:
     
     try:
         llm = get_model(model_name)
-        response = await llm.ainvoke(messages)
+        # Streamed: the SSE endpoint forwards chunks while they arrive
+        content = await _astream_content(llm, messages)
         
-        duration_ms = int((time.time() - start_time) * 1000)
-        tokens_out = len(response.content) // 4
+        duration_ms = _elapsed_ms(start_ns)
+        tokens_out = estimate_tokens(content)
         
         add_model_call(state, ModelCall(
             model=model_name,
@@ -936,14 +1298,10 @@ VỀ BỘ NHỚ HỘI THOẠI:
         
         # Update session memory tracker
         total_turn_tokens = tokens_in + tokens_out
-        memory_tracker.add_usage(session_id, total_turn_tokens)
-        new_status = memory_tracker.check_status(session_id)
-        state["session_token_count"] = new_status.used_tokens
-        state["context_status"] = new_status.status
-        state["context_message"] = new_status.message
+        new_status = _track_memory(state, total_turn_tokens)
         
         # Format the synthesis with standard helper
-        formatted_response = format_latex_for_markdown(response.content)
+        formatted_response = format_latex_for_markdown(content)
         
         state["final_response"] = formatted_response
         state["messages"].append(AIMessage(content=formatted_response))
@@ -973,9 +1331,9 @@ async def wolfram_tool_node(state: AgentState) -> AgentState:
     query = state.get("_tool_query", "")
     state["wolfram_attempts"] += 1
     
-    start_time = time.time()
+    start_ns = time.monotonic_ns()
     success, result = await query_wolfram_alpha(query)
-    duration_ms = int((time.time() - start_time) * 1000)
+    duration_ms = _elapsed_ms(start_ns)
     
     tool_call = ToolCall(
         tool="wolfram",
@@ -993,8 +1351,9 @@ async def wolfram_tool_node(state: AgentState) -> AgentState:
         state["tool_success"] = True
         state["current_agent"] = "synthetic"
     else:
-        if state["wolfram_attempts"] < 1:
-            # Retry
+        if state["wolfram_attempts"] < 3:
+            # Retry with exponential backoff + jitter
+            await asyncio.sleep(0.5 * (2 ** (state["wolfram_attempts"] - 1)) + random.uniform(0, 0.2))
             state["current_agent"] = "wolfram"
         else:
             # Fallback to code tool
@@ -1004,6 +1363,23 @@ async def wolfram_tool_node(state: AgentState) -> AgentState:
     return state
 
 
+# One concurrent fix candidate per temperature in code_tool_node's fix rounds
+CODEFIX_TEMPERATURES = (0.0, 0.3)
+
+
+async def _fix_candidate(llm, fix_messages: list) -> tuple:
+    """
+    Ask `llm` (a bound gpt-oss-120b client) to fix the code and run the result:
+    (raw reply, code, exec result, LLM ms). The request holds a rate-limit reservation.
+    """
+    start_ns = time.monotonic_ns()
+    response = await model_manager.ainvoke_reserved("gpt-oss-120b", fix_messages, llm)
+    llm_ms = _elapsed_ms(start_ns)
+    raw = response.content
+    code = _extract_code(raw)
+    return raw, code, await _CODE_TOOL.aexecute(code), llm_ms
+
+
 async def code_tool_node(state: AgentState) -> AgentState:
     """
     Code Tool: Generate and execute Python code.
@@ -1015,24 +1391,42 @@ async def code_tool_node(state: AgentState) -> AgentState:
     task = state.get("_tool_query", "")
     state["code_attempts"] += 1
     
-    code_tool = CodeTool()
+    # Same task already solved (this or another session): reuse its output
+    cached = query_cache.get(task, "code")
+    if cached is not None:
+        add_tool_call(state, ToolCall(
+            tool="code",
+            input=task,
+            output=cached,
+            success=True,
+            attempt=state["code_attempts"],
+            duration_ms=0
+        ))
+        state["tool_result"] = cached
+        state["tool_success"] = True
+        state["current_agent"] = "synthetic"
+        return state
+    
+    code_tool = _CODE_TOOL
     
-    start_time = time.time()
+    start_ns = time.monotonic_ns()
     
     # Generate code using qwen3-32b
-    codegen_start = time.time()
+    codegen_start_ns = time.monotonic_ns()
     try:
         llm = get_model("qwen3-32b")
-        prompt = CODEGEN_PROMPT.format(task=task)
-        response = await llm.ainvoke([HumanMessage(content=prompt)])
-        code = _extract_code(response.content)
+        prompt = build_codegen_prompt(task=task)
+        async with model_manager.concurrency("qwen3-32b"):
+            response = await llm.ainvoke([HumanMessage(content=prompt)])
+        raw = response.content
+        code = _extract_code(raw)
         
         add_model_call(state, ModelCall(
             model="qwen3-32b",
             agent="codegen_agent",
-            tokens_in=len(prompt) // 4,
-            tokens_out=len(response.content) // 4,
-            duration_ms=int((time.time() - codegen_start) * 1000),
+            tokens_in=estimate_tokens(prompt),
+            tokens_out=estimate_tokens(raw),
+            duration_ms=_elapsed_ms(codegen_start_ns),
             success=True
         ))
     except Exception as e:
@@ -1041,7 +1435,7 @@ async def code_tool_node(state: AgentState) -> AgentState:
             agent="codegen_agent",
             tokens_in=0,
             tokens_out=0,
-            duration_ms=int((time.time() - codegen_start) * 1000),
+            duration_ms=_elapsed_ms(codegen_start_ns),
             success=False,
             error=str(e)
         ))
@@ -1050,44 +1444,67 @@ async def code_tool_node(state: AgentState) -> AgentState:
         state["current_agent"] = "synthetic"
         return state
     
-    # Execute code with correction loop (max 2 fixes)
-    exec_result = code_tool.execute(code)
+    # Execute code with correction loop (max 2 fix rounds)
+    exec_result = await code_tool.aexecute(code)
+    fix_llms = None  # Resolved once, on the first fix round
     
     while not exec_result["success"] and state["codefix_attempts"] < 2:
         state["codefix_attempts"] += 1
         
-        # Fix code using gpt-oss-120b
-        fix_start = time.time()
+        # Fix code using gpt-oss-120b: race one candidate per temperature and
+        # keep the first whose code runs
+        if fix_llms is None:
+            fix_llm = get_model("gpt-oss-120b")
+            fix_llms = [fix_llm.bind(temperature=t) for t in CODEFIX_TEMPERATURES]
+        fix_prompt = build_codegen_fix_prompt(code=code, error=exec_result["error"])
+        fix_messages = [HumanMessage(content=fix_prompt)]
+        # Fix requests are reserved against gpt-oss-120b's limits, so this sees
+        # real usage: race every temperature only while the budget covers all
+        # of them, otherwise send the single fix request a round used to make
+        race_tokens = len(fix_llms) * estimate_message_tokens(fix_messages)
+        can_race, _ = model_manager.check_rate_limit("gpt-oss-120b", race_tokens)
+        round_llms = fix_llms if can_race else fix_llms[:1]
+        round_start_ns = time.monotonic_ns()
+        candidates = [asyncio.create_task(_fix_candidate(llm, fix_messages)) for llm in round_llms]
+        fixed = False
         try:
-            llm = get_model("gpt-oss-120b")
-            fix_prompt = CODEGEN_FIX_PROMPT.format(code=code, error=exec_result["error"])
-            response = await llm.ainvoke([HumanMessage(content=fix_prompt)])
-            code = _extract_code(response.content)
-            
-            add_model_call(state, ModelCall(
-                model="gpt-oss-120b",
-                agent="codefix_agent",
-                tokens_in=len(fix_prompt) // 4,
-                tokens_out=len(response.content) // 4,
-                duration_ms=int((time.time() - fix_start) * 1000),
-                success=True
-            ))
-            
-            exec_result = code_tool.execute(code)
-            
-        except Exception as e:
-            add_model_call(state, ModelCall(
-                model="gpt-oss-120b",
-                agent="codefix_agent",
-                tokens_in=0,
-                tokens_out=0,
-                duration_ms=int((time.time() - fix_start) * 1000),
-                success=False,
-                error=str(e)
-            ))
+            for next_done in asyncio.as_completed(candidates):
+                try:
+                    raw, candidate, candidate_result, llm_ms = await next_done
+                except Exception as e:
+                    add_model_call(state, ModelCall(
+                        model="gpt-oss-120b",
+                        agent="codefix_agent",
+                        tokens_in=0,
+                        tokens_out=0,
+                        duration_ms=_elapsed_ms(round_start_ns),
+                        success=False,
+                        error=str(e)
+                    ))
+                    continue
+                
+                add_model_call(state, ModelCall(
+                    model="gpt-oss-120b",
+                    agent="codefix_agent",
+                    tokens_in=estimate_tokens(fix_prompt),
+                    tokens_out=estimate_tokens(raw),
+                    duration_ms=llm_ms,
+                    success=True
+                ))
+                fixed = True
+                code, exec_result = candidate, candidate_result
+                if exec_result["success"]:
+                    break
+        finally:
+            # Losing candidates are cancelled (their subprocesses are killed)
+            for candidate_task in candidates:
+                candidate_task.cancel()
+            await asyncio.gather(*candidates, return_exceptions=True)
+        
+        if not fixed:
             break
     
-    duration_ms = int((time.time() - start_time) * 1000)
+    duration_ms = _elapsed_ms(start_ns)
     
     tool_call = ToolCall(
         tool="code",
@@ -1103,6 +1520,7 @@ async def code_tool_node(state: AgentState) -> AgentState:
     if exec_result["success"]:
         state["tool_result"] = exec_result["output"]
         state["tool_success"] = True
+        query_cache.set(task, exec_result["output"], "code")
     else:
         state["tool_result"] = f"Code execution failed after {state['codefix_attempts']} fixes: {exec_result.get('error')}"
         state["tool_success"] = False
@@ -1112,13 +1530,15 @@ async def code_tool_node(state: AgentState) -> AgentState:
     return state
 
 
+# Fenced code blocks (an unclosed fence runs to the end of the response)
+_RE_PYTHON_FENCE = re.compile(r'```python[ \t]*\n?([\s\S]*?)(?:```|\Z)', re.IGNORECASE)
+_RE_ANY_FENCE = re.compile(r'```([\s\S]*?)(?:```|\Z)')
+
+
 def _extract_code(response: str) -> str:
-    """Extract Python code from LLM response."""
-    if "```python" in response:
-        return response.split("```python")[1].split("```")[0].strip()
-    elif "```" in response:
-        return response.split("```")[1].split("```")[0].strip()
-    return response.strip()
+    """Extract Python code from LLM response (a ```python block is preferred over any other fence)."""
+    m = _RE_PYTHON_FENCE.search(response) or _RE_ANY_FENCE.search(response)
+    return m.group(1).strip() if m else response.strip()
 
 
 # ============================================================================
@@ -1145,3 +1565,20 @@ def route_agent(state: AgentState) -> str:
         return "done"
     else:
         return "end"
+
+
+def dispatch_questions(state: AgentState):
+    """
+    Route out of the planner. When the plan needs execution, fan out one
+    `question_worker` per work unit with `Send`; the workers run concurrently
+    and the `executor` node collects their outputs.
+    """
+    route = route_agent(state)
+    if route != "executor":
+        return route
+    
+    plan = state.get("execution_plan") or {}
+    groups = group_questions(plan.get("questions") or [])
+    if not groups:
+        return "executor"
+    return [Send("question_worker", {"questions": group}) for group in groups]
@@ -1,6 +1,8 @@
 """
 Prompts for the multi-agent algebra chatbot.
 """
+import string
+from typing import Callable
 
 GUARD_PROMPT = """
 ## QUY TẮC BẢO VỆ VÀ DANH TÍNH (GUARDRAILS & PERSONA):
@@ -133,6 +135,24 @@ Kết quả công cụ:
 {tool_result}
 """
 
+SYNTHETIC_SYSTEM_PROMPT = """Bạn là chuyên gia toán học Việt Nam. Hãy giải thích lời giải một cách sư phạm, dễ hiểu.
+
+VỀ BỘ NHỚ HỘI THOẠI:
+- Bạn có thể tham chiếu đến các câu hỏi trước đó trong hội thoại.
+- Nếu người dùng đề cập đến "bài trước", "câu đó", hãy hiểu ngữ cảnh.
+- Trả lời tự nhiên như một cuộc trò chuyện liên tục."""
+
+DIRECT_SOLVE_SYSTEM_PROMPT = "Bạn là chuyên gia giải toán. Trả lời ngắn gọn, đúng trọng tâm."
+
+BATCH_SOLVE_PROMPT = """
+Giải lần lượt từng bài toán dưới đây một cách chi tiết.
+- Nội dung lời giải viết sang dạng chuẩn LaTeX format.
+- Trả về DUY NHẤT một JSON object, key là số thứ tự bài (dạng chuỗi), value là lời giải:
+{{"1": "Lời giải bài 1", "2": "Lời giải bài 2"}}
+
+{problems}
+"""
+
 CODEGEN_PROMPT = """
 Bạn là một nhà toán học và lập trình tài giỏi, chuyên gia về toán giải tích và đại số.
 Nhiệm vụ của bạn là viết code Python để giải bài toán sau.
@@ -154,6 +174,26 @@ CHỈ TRẢ VỀ KHỐI CODE ```python ... ```.
 """
 
 
+BATCH_CODEGEN_PROMPT = """
+Bạn là một nhà toán học và lập trình tài giỏi, chuyên gia về toán giải tích và đại số.
+Nhiệm vụ của bạn là viết code Python RIÊNG cho TỪNG bài toán dưới đây.
+
+YÊU CẦU KỸ THUẬT (áp dụng cho mỗi bài):
+- Tận dụng các thư viện sẵn có (ví dụ: `sympy`, `numpy`, `scipy`, `pandas`, `mpmath`, `statsmodels`, `cvxpy`, `pulp`, etc.).
+- Mỗi khối code phải chạy độc lập, tự định nghĩa tất cả các biến, các symbols cần thiết.
+- OUTPUT CUỐI CÙNG PHẢI LÀ LATEX (in ra bằng hàm print).
+- Sử dụng `print(sympy.latex(result))` cho các đối tượng sympy.
+
+{problems}
+
+Với MỖI bài, trả về đúng định dạng sau (không thêm giải thích):
+### Bài <số thứ tự>
+```python
+...
+```
+"""
+
+
 CODEGEN_FIX_PROMPT = """
 Bạn là một chuyên gia sửa lỗi Python bậc thầy. Code toán học trước đó của bạn đã gặp lỗi.
 
@@ -176,4 +216,43 @@ YÊU CẦU:
 ---
 
 Hãy viết lại code đã sửa:
-"""
\ No newline at end of file
+"""
+
+
+HISTORY_SUMMARY_PROMPT = """
+Tóm tắt ngắn gọn (tối đa khoảng 200 token) đoạn hội thoại toán học dưới đây để làm ngữ cảnh cho các lượt sau.
+Giữ lại: các bài toán người dùng đã hỏi, các kết quả/đáp số chính (viết bằng LaTeX) và các ký hiệu, quy ước đã thống nhất.
+Bỏ qua lời chào và các giải thích dài dòng.
+
+[TÓM TẮT TRƯỚC ĐÓ]:
+{previous_summary}
+
+[HỘI THOẠI CẦN TÓM TẮT THÊM]:
+{history}
+
+Chỉ trả về bản tóm tắt mới (đã gộp cả tóm tắt trước đó, nếu có).
+"""
+
+
+def compile_prompt(template: str) -> Callable[..., str]:
+    """
+    Parse a str.format template once. The returned function fills its
+    fields by keyword without re-running the format parser on every call.
+    """
+    parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+    
+    def render(**values) -> str:
+        return "".join(
+            literal if field is None else literal + str(values[field])
+            for literal, field in parts
+        )
+    return render
+
+
+build_planner_user_prompt = compile_prompt(PLANNER_USER_PROMPT)
+build_synthetic_prompt = compile_prompt(SYNTHETIC_PROMPT)
+build_batch_solve_prompt = compile_prompt(BATCH_SOLVE_PROMPT)
+build_codegen_prompt = compile_prompt(CODEGEN_PROMPT)
+build_batch_codegen_prompt = compile_prompt(BATCH_CODEGEN_PROMPT)
+build_codegen_fix_prompt = compile_prompt(CODEGEN_FIX_PROMPT)
+build_history_summary_prompt = compile_prompt(HISTORY_SUMMARY_PROMPT)
@@ -40,6 +40,19 @@ class SimpleMessageBlocks(BaseModel):
     blocks: list[SimpleBlock] = Field(default_factory=list)
 
 
+# Every LaTeX math span recognised by parse_text_to_blocks, in one alternation
+# (earlier alternatives win at the same position, so $$ is tried before $).
+# Each named group captures the formula without its delimiters.
+_RE_MATH_TOKEN = re.compile(
+    r'\$\$(?P<block>[\s\S]*?)\$\$'
+    r'|\\\[(?P<bracket_block>[\s\S]*?)\\\]'
+    r'|\\begin\{(?P<env_name>equation|aligned|align|cases|gather)\}(?P<env>[\s\S]*?)\\end\{(?P=env_name)\}'
+    r'|\$(?P<inline>[^$\n]+)\$'
+    r'|\\\((?P<bracket_inline>[\s\S]*?)\\\)'
+)
+_INLINE_KINDS = frozenset({"inline", "bracket_inline"})
+
+
 def parse_text_to_blocks(text: str) -> list[dict]:
     """
     General parser: Convert raw text with LaTeX markers into blocks.
@@ -48,85 +61,37 @@ def parse_text_to_blocks(text: str) -> list[dict]:
     - $...$ for inline math
     - \\[...\\] for display math
     - \\(...\\) for inline math
+    - \\begin{...}...\\end{...} environments as display math
     - Plain text for everything else
     
+    Single left-to-right scan: text between math spans becomes text blocks.
     Returns list of block dicts ready for JSON serialization.
     """
     if not text or not text.strip():
         return [{"type": "text", "content": text or "", "display": None}]
     
-    # Normalize LaTeX display math notations to $$...$$
-    processed = text
-    processed = re.sub(r'\\\[([\s\S]*?)\\\]', r'$$\1$$', processed)
-    processed = re.sub(r'\\\(([\s\S]*?)\\\)', r'$\1$', processed)
-    
-    # Handle \begin{...}\end{...} environments - convert to display math
-    processed = re.sub(
-        r'\\begin\{(equation|aligned|align|cases|gather)\}([\s\S]*?)\\end\{\1\}',
-        lambda m: f'$${m.group(2)}$$',
-        processed
-    )
-    
     blocks = []
+    last = 0
+    for m in _RE_MATH_TOKEN.finditer(text):
+        # Text before this math span
+        before = text[last:m.start()].strip()
+        if before:
+            blocks.append({"type": "text", "content": before, "display": None})
+        last = m.end()
+        
+        kind = m.lastgroup
+        latex = m.group(kind).strip()
+        if latex:
+            blocks.append({
+                "type": "math",
+                "content": latex,
+                "display": "inline" if kind in _INLINE_KINDS else "block"
+            })
     
-    # Split by block math first ($$...$$)
-    # This regex captures both the math and the surrounding text
-    pattern_block = r'(\$\$[\s\S]*?\$\$)'
-    parts = re.split(pattern_block, processed)
-    
-    for part in parts:
-        if not part.strip():
-            continue
-            
-        # Check if this is block math
-        if part.startswith('$$') and part.endswith('$$'):
-            latex = part[2:-2].strip()
-            if latex:
-                blocks.append({
-                    "type": "math",
-                    "content": latex,
-                    "display": "block"
-                })
-        else:
-            # Process text with potential inline math ($...$)
-            # Split by inline math
-            pattern_inline = r'(\$[^$\n]+\$)'
-            inline_parts = re.split(pattern_inline, part)
-            
-            current_text = ""
-            for inline_part in inline_parts:
-                if not inline_part:
-                    continue
-                    
-                # Check if inline math
-                if inline_part.startswith('$') and inline_part.endswith('$') and len(inline_part) > 2:
-                    # First, add accumulated text
-                    if current_text.strip():
-                        blocks.append({
-                            "type": "text",
-                            "content": current_text.strip(),
-                            "display": None
-                        })
-                        current_text = ""
-                    
-                    # Add inline math
-                    latex = inline_part[1:-1].strip()
-                    if latex:
-                        blocks.append({
-                            "type": "math",
-                            "content": latex,
-                            "display": "inline"
-                        })
-                else:
-                    current_text += inline_part
-            
-            # Add remaining text
-            if current_text.strip():
-                blocks.append({
-                    "type": "text",
-                    "content": current_text.strip(),
-                    "display": None
-                })
+    # Add remaining text
+    rest = text[last:].strip()
+    if rest:
+        blocks.append({"type": "text", "content": rest, "display": None})
     
     return blocks if blocks else [{"type": "text", "content": text, "display": None}]
 
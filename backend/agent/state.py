@@ -8,7 +8,19 @@ from langgraph.graph.message import add_messages
 import time
 
 
-@dataclass
+def merge_question_outputs(existing: Optional[List[dict]], new: Optional[List[dict]]) -> List[dict]:
+    """
+    Reducer for executor worker outputs.
+    Merges by plan index so parallel workers can each append their share, and
+    re-submitting outputs already in state (nodes return the full state) is a no-op.
+    """
+    merged = {o["index"]: o for o in (existing or [])}
+    for o in new or []:
+        merged[o["index"]] = o
+    return [merged[i] for i in sorted(merged)]
+
+
+@dataclass(slots=True)
 class ToolCall:
     """Record of a tool invocation."""
     tool: str
@@ -20,7 +32,7 @@ class ToolCall:
     error: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ModelCall:
     model: str
     agent: str
@@ -39,6 +51,8 @@ class AgentState(TypedDict):
     """
     # Core messaging
     messages: Annotated[list, add_messages]
+    last_user_idx: Optional[int]       # Index of the current user message in `messages`
+    history_summary: Optional[str]     # Compressed summary of turns older than the synthesis window
     session_id: str
     
     # Image handling (multi-image support)
@@ -56,6 +70,7 @@ class AgentState(TypedDict):
     # Multi-question execution (NEW)
     execution_plan: Optional[dict]     # Planner output: {"questions": [...]}
     question_results: List[dict]       # Results per question: [{"id": 1, "result": "...", "error": None}]
+    _question_outputs: Annotated[List[dict], merge_question_outputs]  # Fan-out worker outputs: [{"index", "duration_ms", "result"}]
     
     # Tool state
     wolfram_attempts: int      # Max 3 (1 initial + 2 retries)
@@ -69,10 +84,10 @@ class AgentState(TypedDict):
     
     # Tracking/Tracing (for observability)
     agents_used: List[str]
-    tools_called: List[dict]   # List of ToolCall as dicts
-    model_calls: List[dict]    # List of ModelCall as dicts
+    tools_called: List[ToolCall]   # Converted to dicts only when sent to the client
+    model_calls: List[ModelCall]
     total_tokens: int
-    start_time: float
+    start_time_ns: int         # time.monotonic_ns() at turn start
     
     # Memory management
     session_token_count: int   # Cumulative tokens used in this session
@@ -83,6 +98,30 @@ class AgentState(TypedDict):
     final_response: Optional[str]
 
 
+# Immutable defaults shared by every new turn (copied, never mutated);
+# list fields and per-turn values are filled in by create_initial_state
+_INITIAL_STATE_TEMPLATE: dict = {
+    "last_user_idx": None,
+    "history_summary": None,
+    "ocr_text": None,
+    "should_use_tools": False,
+    "selected_tool": None,
+    "_tool_query": None,
+    "execution_plan": None,
+    "wolfram_attempts": 0,
+    "code_attempts": 0,
+    "codefix_attempts": 0,
+    "tool_result": None,
+    "tool_success": False,
+    "error_message": None,
+    "total_tokens": 0,
+    "session_token_count": 0,
+    "context_status": "ok",
+    "context_message": None,
+    "final_response": None,
+}
+
+
 def create_initial_state(
     session_id: str, 
     image_data: Optional[str] = None,
@@ -92,35 +131,22 @@ def create_initial_state(
     # Determine starting agent based on images
     has_images = bool(image_data) or bool(image_data_list)
     
-    return AgentState(
+    state = _INITIAL_STATE_TEMPLATE.copy()
+    state.update(
         messages=[],
         session_id=session_id,
         image_data=image_data,
         image_data_list=image_data_list or [],
-        ocr_text=None,
         ocr_results=[],
         current_agent="ocr" if has_images else "planner",
-        should_use_tools=False,
-        selected_tool=None,
-        _tool_query=None,
-        execution_plan=None,
         question_results=[],
-        wolfram_attempts=0,
-        code_attempts=0,
-        codefix_attempts=0,
-        tool_result=None,
-        tool_success=False,
-        error_message=None,
+        _question_outputs=[],
         agents_used=[],
         tools_called=[],
         model_calls=[],
-        total_tokens=0,
-        start_time=time.time(),
-        session_token_count=0,
-        context_status="ok",
-        context_message=None,
-        final_response=None,
+        start_time_ns=time.monotonic_ns(),
     )
+    return state
 
 
 def add_agent_used(state: AgentState, agent_name: str) -> None:
@@ -131,34 +157,18 @@ def add_agent_used(state: AgentState, agent_name: str) -> None:
 
 def add_tool_call(state: AgentState, tool_call: ToolCall) -> None:
     """Record a tool call."""
-    state["tools_called"].append({
-        "tool": tool_call.tool,
-        "input": tool_call.input,
-        "output": tool_call.output,
-        "success": tool_call.success,
-        "attempt": tool_call.attempt,
-        "duration_ms": tool_call.duration_ms,
-        "error": tool_call.error,
-    })
+    state["tools_called"].append(tool_call)
 
 
 def add_model_call(state: AgentState, model_call: ModelCall) -> None:
     """Record a model call."""
-    state["model_calls"].append({
-        "model": model_call.model,
-        "agent": model_call.agent,
-        "tokens_in": model_call.tokens_in,
-        "tokens_out": model_call.tokens_out,
-        "duration_ms": model_call.duration_ms,
-        "success": model_call.success,
-        "error": model_call.error,
-    })
+    state["model_calls"].append(model_call)
     state["total_tokens"] += model_call.tokens_in + model_call.tokens_out
 
 
 def get_total_duration_ms(state: AgentState) -> int:
     """Get total duration since start."""
-    start_time = state.get("start_time")
-    if start_time is None:
+    start_ns = state.get("start_time_ns")
+    if start_ns is None:
         return 0
-    return int((time.time() - start_time) * 1000)
+    return (time.monotonic_ns() - start_ns) // 1_000_000
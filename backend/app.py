@@ -2,38 +2,141 @@
 FastAPI main application with SSE streaming support.
 """
 import os
+import asyncio
 import uuid
 import base64
 import json
+from collections import Counter, OrderedDict
+from datetime import datetime
 from typing import Optional, List
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
+from dataclasses import asdict
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from langchain_core.messages import HumanMessage, AIMessage
+try:
+    import orjson  # Installed with langsmith; C serializer for SSE frames
+except ImportError:
+    orjson = None
 
-from backend.database.models import init_db, AsyncSessionLocal, Conversation, Message
+from backend.database.models import init_db, AsyncSessionLocal, Conversation, Message, MessageImage
 from backend.agent.graph import agent_graph
-from backend.agent.state import AgentState
-from backend.utils.rate_limit import rate_limiter
+from backend.agent.nodes import route_agent
+from backend.agent.models import model_manager
+from backend.agent.state import AgentState, create_initial_state, get_total_duration_ms
+from backend.utils.memory import memory_tracker, KIMI_K2_CONTEXT_LENGTH
+from backend.utils.rate_limit import rate_limiter, RATE_LIMITS
+from backend.tools.wolfram import get_wolfram_status as _wolfram_status
 from backend.utils.tracing import setup_langsmith, create_run_config, get_tracing_status
 
 
+# Token events dominate the stream: their frame prefix is fixed, so only the
+# content string is serialized
+_TOKEN_FRAME_PREFIX = b'data: {"type":"token","content":'
+
+
+def _sse_frame(item: dict) -> bytes:
+    """Encode one queue item as an SSE `data:` frame."""
+    if orjson is None:
+        return f"data: {json.dumps(item)}\n\n".encode()
+    if item.get("type") == "token" and len(item) == 2:
+        return _TOKEN_FRAME_PREFIX + orjson.dumps(item["content"]) + b"}\n\n"
+    return b"data: " + orjson.dumps(item) + b"\n\n"
+
+
+async def _b64encode(content: bytes) -> str:
+    """Base64-encode image bytes off the event loop."""
+    return await asyncio.to_thread(lambda: base64.b64encode(content).decode("ascii"))
+
+
+def _image_url(message_id: str, idx: int) -> str:
+    """URL served by get_message_image for one stored image."""
+    return f"/api/messages/{message_id}/images/{idx}"
+
+
+# Agent runs in flight per process; further chats wait for a slot
+_CHAT_SLOTS = asyncio.Semaphore(int(os.getenv("CHAT_CONCURRENCY", "32")))
+# Events buffered per SSE stream before the agent waits for a slow client
+SSE_QUEUE_SIZE = 256
+# Stop the agent when its client disconnects. Off by default: the frontend
+# polls for answers that finish in the background after a page reload
+CANCEL_ON_DISCONNECT = os.getenv("CANCEL_ON_DISCONNECT", "false").lower() == "true"
+# Graph nodes that return the (delta) agent state; question_worker only
+# returns its `_question_outputs` (streamed via the on_question_result hook)
+_STATE_NODES = frozenset({
+    "ocr_agent", "planner", "executor", "synthetic_agent", "wolfram_tool", "code_tool",
+})
+
+
+# Completed turns of recently active sessions as LangChain messages (mirrors
+# their DB rows), so a follow-up message doesn't reload and rebuild the whole
+# history. LRU-bounded; rebuilt from the DB on a miss.
+HISTORY_CACHE_SIZE = 512
+_HISTORY_CACHE: "OrderedDict[str, list]" = OrderedDict()
+_TURNS_IN_FLIGHT: Counter = Counter()  # Running turns per session
+_TURNS_STARTED: Counter = Counter()    # Turns started per session while any is running
+
+
+def _store_history(session_id: str, messages: list) -> None:
+    """Cache a session's history, evicting the least recently used session."""
+    _HISTORY_CACHE[session_id] = messages
+    _HISTORY_CACHE.move_to_end(session_id)
+    if len(_HISTORY_CACHE) > HISTORY_CACHE_SIZE:
+        _HISTORY_CACHE.popitem(last=False)
+
+
+def _begin_turn(session_id: str) -> Optional[int]:
+    """Register a running turn; returns a ticket if no other turn of the session is running."""
+    solo = not _TURNS_IN_FLIGHT[session_id]
+    _TURNS_IN_FLIGHT[session_id] += 1
+    _TURNS_STARTED[session_id] += 1
+    return _TURNS_STARTED[session_id] if solo else None
+
+
+def _end_turn(session_id: str, ticket: Optional[int], history: Optional[list]) -> None:
+    """Unregister a turn, caching its resulting history unless another turn overlapped it."""
+    if ticket is not None and history is not None and _TURNS_STARTED[session_id] == ticket:
+        _store_history(session_id, history)
+    _TURNS_IN_FLIGHT[session_id] -= 1
+    if not _TURNS_IN_FLIGHT[session_id]:
+        del _TURNS_IN_FLIGHT[session_id]
+        del _TURNS_STARTED[session_id]
+
+
+class _EventStreamResponse(StreamingResponse):
+    """
+    StreamingResponse that calls `on_close()` once the stream is over, whether
+    it ran to the end or the client disconnected (the body generator itself
+    is abandoned, not closed, on disconnect).
+    """
+    def __init__(self, *args, on_close, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Initialize database and LangSmith on startup."""
+    """Initialize database and LangSmith on startup; close shared HTTP client on shutdown."""
     await init_db()
     setup_langsmith()  # Initialize LangSmith tracing
     yield
+    await model_manager.aclose()
 
 
 app = FastAPI(
@@ -75,7 +178,8 @@ class MessageResponse(BaseModel):
     id: str
     role: str
     content: str
-    image_data: Optional[str] = None  # Add this field
+    image_data: Optional[str] = None  # Legacy: JSON list of base64 images
+    image_urls: List[str] = []         # Images stored in message_images
     created_at: str
 
 
@@ -88,6 +192,16 @@ class SearchResult(BaseModel):
     created_at: str
 
 
+def _conversation_response(c: Conversation) -> ConversationResponse:
+    """Build the response for a conversation row (trusted DB values: no validation)."""
+    return ConversationResponse.model_construct(
+        id=c.id,
+        title=c.title,
+        created_at=c.created_at.isoformat(),
+        updated_at=c.updated_at.isoformat(),
+    )
+
+
 # Database dependency
 async def get_db():
     async with AsyncSessionLocal() as session:
@@ -96,27 +210,34 @@ async def get_db():
 
 # API Routes
 @app.get("/api/health")
-async def health_check():
+async def health_check() -> dict:
     """Health check endpoint."""
     return {"status": "healthy", "service": "algebra-chatbot"}
 
 
+# Page size cap for the paginated list endpoints
+MAX_PAGE_SIZE = 200
+
+
 @app.get("/api/conversations", response_model=list[ConversationResponse])
-async def list_conversations(db: AsyncSession = Depends(get_db)):
-    """List all conversations."""
-    result = await db.execute(
-        select(Conversation).order_by(Conversation.updated_at.desc())
-    )
+async def list_conversations(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    List conversations, most recently updated first.
+    Optional keyset pagination: `limit` rows updated before `before`
+    (pass the last row's `updated_at` to get the next page).
+    """
+    stmt = select(Conversation).order_by(Conversation.updated_at.desc())
+    if before is not None:
+        stmt = stmt.where(Conversation.updated_at < before)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    result = await db.execute(stmt)
     conversations = result.scalars().all()
-    return [
-        ConversationResponse(
-            id=c.id,
-            title=c.title,
-            created_at=c.created_at.isoformat(),
-            updated_at=c.updated_at.isoformat(),
-        )
-        for c in conversations
-    ]
+    return [_conversation_response(c) for c in conversations]
 
 
 @app.post("/api/conversations", response_model=ConversationResponse)
@@ -126,21 +247,21 @@ async def create_conversation(db: AsyncSession = Depends(get_db)):
     db.add(conversation)
     await db.commit()
     await db.refresh(conversation)
-    return ConversationResponse(
-        id=conversation.id,
-        title=conversation.title,
-        created_at=conversation.created_at.isoformat(),
-        updated_at=conversation.updated_at.isoformat(),
-    )
+    return _conversation_response(conversation)
 
 
 @app.delete("/api/conversations/{conversation_id}")
-async def delete_conversation(conversation_id: str, db: AsyncSession = Depends(get_db)):
+async def delete_conversation(conversation_id: str, db: AsyncSession = Depends(get_db)) -> dict:
     """Delete a conversation and reset its memory tracker."""
     # Reset memory tracker for this session
-    from backend.utils.memory import memory_tracker
     memory_tracker.reset_usage(conversation_id)
+    _HISTORY_CACHE.pop(conversation_id, None)
     
+    await db.execute(
+        delete(MessageImage).where(MessageImage.message_id.in_(
+            select(Message.id).where(Message.conversation_id == conversation_id)
+        ))
+    )
     await db.execute(
         delete(Conversation).where(Conversation.id == conversation_id)
     )
@@ -166,35 +287,73 @@ async def update_conversation(
     await db.commit()
     await db.refresh(conversation)
     
-    return ConversationResponse(
-        id=conversation.id,
-        title=conversation.title,
-        created_at=conversation.created_at.isoformat(),
-        updated_at=conversation.updated_at.isoformat(),
-    )
+    return _conversation_response(conversation)
 
 
 @app.get("/api/conversations/{conversation_id}/messages", response_model=list[MessageResponse])
-async def get_messages(conversation_id: str, db: AsyncSession = Depends(get_db)):
-    """Get all messages in a conversation."""
-    result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == conversation_id)
-        .order_by(Message.created_at)
-    )
-    messages = result.scalars().all()
+async def get_messages(
+    conversation_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get the messages of a conversation, oldest first.
+    Optional keyset pagination: the latest `limit` messages created before
+    `before` (pass the first message's `created_at` to page backwards).
+    """
+    stmt = select(Message).where(Message.conversation_id == conversation_id)
+    if before is not None:
+        stmt = stmt.where(Message.created_at < before)
+    if limit is None:
+        result = await db.execute(stmt.order_by(Message.created_at))
+        messages = result.scalars().all()
+    else:
+        # Newest page first via ix_messages_conv_created, then back to chronological
+        result = await db.execute(stmt.order_by(Message.created_at.desc()).limit(limit))
+        messages = result.scalars().all()[::-1]
+    
+    # Image positions only: the bytes are served by get_message_image
+    image_urls: dict[str, list[str]] = {}
+    if messages:
+        image_result = await db.execute(
+            select(MessageImage.message_id, MessageImage.idx)
+            .where(MessageImage.message_id.in_([m.id for m in messages]))
+            .order_by(MessageImage.idx)
+        )
+        for message_id, idx in image_result:
+            image_urls.setdefault(message_id, []).append(_image_url(message_id, idx))
+    
     return [
-        MessageResponse(
+        MessageResponse.model_construct(
             id=m.id,
             role=m.role,
             content=m.content,
-            image_data=m.image_data,  # Populate this field
+            image_data=m.image_data,
+            image_urls=image_urls.get(m.id, []),
             created_at=m.created_at.isoformat(),
         )
         for m in messages
     ]
 
 
+@app.get("/api/messages/{message_id}/images/{idx}")
+async def get_message_image(message_id: str, idx: int, db: AsyncSession = Depends(get_db)):
+    """Serve one uploaded image of a message as raw bytes."""
+    result = await db.execute(
+        select(MessageImage.data, MessageImage.content_type)
+        .where(MessageImage.message_id == message_id, MessageImage.idx == idx)
+    )
+    row = result.first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(
+        content=row.data,
+        media_type=row.content_type or "image/jpeg",
+        headers={"Cache-Control": "private, max-age=31536000, immutable"},
+    )
+
+
 @app.get("/api/search", response_model=list[SearchResult])
 async def search(q: str, db: AsyncSession = Depends(get_db)):
     """
@@ -216,7 +375,7 @@ async def search(q: str, db: AsyncSession = Depends(get_db)):
     )
     conversations = conv_result.scalars().all()
     for c in conversations:
-        results.append(SearchResult(
+        results.append(SearchResult.model_construct(
             type="conversation",
             id=c.id,
             title=c.title,
@@ -225,41 +384,42 @@ async def search(q: str, db: AsyncSession = Depends(get_db)):
             created_at=c.created_at.isoformat()
         ))
 
-    # 2. Search Messages
+    # 2. Search Messages (only the columns the results need: legacy rows
+    # carry their images inline in image_data)
     msg_result = await db.execute(
-        select(Message, Conversation.title)
+        select(Message.id, Message.conversation_id, Message.content, Message.created_at, Conversation.title)
         .join(Conversation)
         .where(Message.content.ilike(query))
         .order_by(Message.created_at.desc())
         .limit(20)
     )
-    messages = msg_result.all() # returns (Message, title) tuples
+    q_low = q.lower()
     
-    for msg, title in messages:
+    for msg_id, conversation_id, full_content, created_at, title in msg_result:
         # Avoid duplicates if conversation is already found? 
         # Actually showing specific message matches is good even if conversation matches.
         
         # Smarter snippet generation to ensure the match is visible
-        content = msg.content
-        idx = content.lower().find(q.lower())
+        content = full_content
+        idx = full_content.lower().find(q_low)
         if idx != -1:
             # If the match is beyond the first 40 chars, center it
             if idx > 40:
-                start = max(0, idx - 40)
-                end = min(len(content), idx + 60)
-                content = "..." + content[start:end] + ("..." if end < len(msg.content) else "")
-            elif len(content) > 100: # If match is found within first 40 chars, but content is still long
-                content = content[:100] + "..."
-        elif len(content) > 100: # If no match is found, just truncate if long
-            content = content[:100] + "..."
-
-        results.append(SearchResult(
+                start = idx - 40
+                end = min(len(full_content), idx + 60)
+                content = "..." + full_content[start:end] + ("..." if end < len(full_content) else "")
+            elif len(full_content) > 100: # If match is found within first 40 chars, but content is still long
+                content = full_content[:100] + "..."
+        elif len(full_content) > 100: # If no match is found, just truncate if long
+            content = full_content[:100] + "..."
+
+        results.append(SearchResult.model_construct(
              type="message",
-             id=msg.id,
+             id=msg_id,
              title=title,
              content=content,
-             conversation_id=msg.conversation_id,
-             created_at=msg.created_at.isoformat()
+             conversation_id=conversation_id,
+             created_at=created_at.isoformat()
         ))
 
     # Sort combined results by date (newest first)
@@ -269,10 +429,8 @@ async def search(q: str, db: AsyncSession = Depends(get_db)):
 
 
 @app.get("/api/conversations/{conversation_id}/memory")
-async def get_session_memory(conversation_id: str):
+async def get_session_memory(conversation_id: str) -> dict:
     """Get memory usage status for a session."""
-    from backend.utils.memory import memory_tracker, KIMI_K2_CONTEXT_LENGTH
-    
     status = memory_tracker.check_status(conversation_id)
     return {
         "session_id": status.session_id,
@@ -308,13 +466,11 @@ async def chat(
     if not message:
         message = "Giải bài toán trong ảnh này"
     
-    # Get or create session
-    if not session_id:
-        conversation = Conversation(title=message[:50] if message else "Ảnh")
-        db.add(conversation)
-        await db.commit()
-        await db.refresh(conversation)
-        session_id = conversation.id
+    # Get or create session (a new one is committed with the messages below)
+    new_session = not session_id
+    if new_session:
+        session_id = str(uuid.uuid4())
+        db.add(Conversation(id=session_id, title=message[:50] if message else "Ảnh"))
     else:
         result = await db.execute(
             select(Conversation).where(Conversation.id == session_id)
@@ -327,117 +483,150 @@ async def chat(
     image_data = None
     image_data_list = []
     if images:
-        for img in images:
-            content = await img.read()
-            encoded = base64.b64encode(content).decode("utf-8")
-            image_data_list.append(encoded)
+        # Read and encode uploads concurrently; base64 of multi-MB images
+        # runs in worker threads so the event loop keeps serving other streams.
+        # The agent needs base64; the database keeps the raw bytes.
+        contents = await asyncio.gather(*(img.read() for img in images))
+        image_data_list = list(await asyncio.gather(*(_b64encode(c) for c in contents)))
         # Keep first image for backward compatibility (in memory only)
         image_data = image_data_list[0] if image_data_list else None
     
-    # Prepare data for storage: save ALL images as JSON list string
-    storage_image_data = None
-    if image_data_list:
-        storage_image_data = json.dumps(image_data_list)
-
-    # Save user message
-    user_msg = Message(
-        conversation_id=session_id,
-        role="user",
-        content=message,
-        image_data=storage_image_data,  # Store ALL images
-    )
-    db.add(user_msg)
-    await db.commit()
-    
-    # Load conversation history
-    result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == session_id)
-        .order_by(Message.created_at)
-    )
-    history = result.scalars().all()
+    # Earlier turns: taken out of the cache while this turn runs (put back
+    # with it on success), else loaded from the DB (text only; a new session
+    # has none)
+    history = _HISTORY_CACHE.pop(session_id, None)
+    if history is None:
+        history = []
+        if not new_session:
+            result = await db.execute(
+                select(Message.role, Message.content)
+                .where(Message.conversation_id == session_id)
+                .order_by(Message.created_at)
+            )
+            history = [
+                HumanMessage(content=content) if role == "user" else AIMessage(content=content)
+                for role, content in result
+            ]
     
-    # Build messages list
-    messages = []
-    for msg in history:
-        if msg.role == "user":
-            messages.append(HumanMessage(content=msg.content))
-        else:
-            messages.append(AIMessage(content=msg.content))
+    # Messages list: earlier turns, then this message
+    last_user_idx = len(history)
+    messages = [*history, HumanMessage(content=message)]
     
     # Create initial state for new multi-agent system
-    import time
-    from backend.agent.state import create_initial_state
-    
     initial_state = create_initial_state(session_id, image_data, image_data_list)
     initial_state["messages"] = messages
+    initial_state["last_user_idx"] = last_user_idx
 
 
-    # Create Assistant Placeholder message (pending)
+    # Save user message (one raw-bytes row per image) and the assistant
+    # placeholder in a single transaction; ids are generated here, so no refresh
+    user_msg = Message(
+        conversation_id=session_id,
+        role="user",
+        content=message,
+    )
+    if images:
+        user_msg.images = [
+            MessageImage(idx=i, content_type=img.content_type, data=content)
+            for i, (img, content) in enumerate(zip(images, contents))
+        ]
+    assistant_msg_id = str(uuid.uuid4())
     assistant_msg = Message(
+        id=assistant_msg_id,
         conversation_id=session_id,
         role="assistant",
         content="", # Empty content marks it as "generating" or "pending"
     )
-    db.add(assistant_msg)
+    db.add_all([user_msg, assistant_msg])
     await db.commit()
-    await db.refresh(assistant_msg)
-    assistant_msg_id = assistant_msg.id
 
-    import asyncio
-    queue = asyncio.Queue()
+    queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+    client_connected = True
+
+    async def emit(item: Optional[dict]) -> None:
+        """Queue an event for the client (backpressured); dropped once the client has left."""
+        if client_connected:
+            await queue.put(item)
+
+    async def emit_tool_result(q_out: dict) -> None:
+        """Report one finished question (see question_worker_node)."""
+        r = q_out["result"]
+        await emit({
+            "type": "tool_result",
+            "id": r.get("id"),
+            "question_type": r.get("type"),
+            "success": not r.get("error"),
+            "duration_ms": q_out["duration_ms"],
+        })
 
     async def run_agent_in_background():
         """Background task that drives the agent and pushes to queue/DB."""
+        slot_held = False
+        turn_history = None  # History including this turn, once saved
+        streamed_parts = []  # Kept for the partial answer if the run is cancelled
         try:
             # 1. Initial status
-            await queue.put({"type": "status", "status": "thinking"})
+            await emit({"type": "status", "status": "thinking"})
+            await _CHAT_SLOTS.acquire()
+            slot_held = True
             
             run_config = create_run_config(session_id)
+            # Workers stream each question's outcome as soon as it finishes
+            run_config["configurable"] = {"on_question_result": emit_tool_result}
             final_state = None
+            streamed = False  # Synthesis tokens already forwarded live
             
             # Use astream_events to capture intermediate steps
-            async for event in agent_graph.astream_events(initial_state, config=run_config, version="v1"):
-                kind = event["event"]
+            events = agent_graph.astream_events(initial_state, config=run_config, version="v1")
+            async with aclosing(events):
+                async for event in events:
+                    kind = event["event"]
                 
-                # Capture final_state from any node that returns a valid state
-                if kind == "on_chain_end":
-                    output = event["data"].get("output")
-                    if isinstance(output, dict) and "messages" in output:
-                        final_state = output
+                    if kind == "on_chain_end":
+                        name = event["name"]
+                        if name in _STATE_NODES:
+                            # Capture final_state from the node outputs (nodes return
+                            # all plain fields; `messages` holds only new ones) and
+                            # stop once a node routes to END: nothing else is streamed
+                            output = event["data"].get("output")
+                            if output and "current_agent" in output:
+                                final_state = output
+                                if route_agent(output) in ("done", "end"):
+                                    break
+                              
+                    elif kind == "on_chat_model_stream" and event["metadata"].get("langgraph_node") == "synthetic_agent":
+                        # Forward the synthesis as it is generated
+                        chunk = event["data"]["chunk"].content
+                        if chunk:
+                            if not streamed:
+                                streamed = True
+                                await emit({"type": "status", "status": "responding"})
+                            streamed_parts.append(chunk)
+                            await emit({"type": "token", "content": chunk})
                               
-                elif kind == "on_tool_end":
-                    pass
+                    elif kind == "on_tool_end":
+                        pass
 
             if not final_state:
                 final_state = await agent_graph.ainvoke(initial_state, config=run_config)
 
-            # Extract final response
-            full_response = final_state.get("final_response", "")
-            if not full_response:
-                for msg in reversed(final_state.get("messages", [])):
-                    if hasattr(msg, 'content') and isinstance(msg, AIMessage):
-                        content = str(msg.content)
-                        if content.strip().startswith('{') and '"questions"' in content:
-                            continue
-                        full_response = content
-                        break
-            
-            if not full_response:
-                 full_response = "Xin lỗi, tôi không thể xử lý yêu cầu này."
+            # Every path that ends the graph sets final_response
+            full_response = final_state.get("final_response") or "Xin lỗi, tôi không thể xử lý yêu cầu này."
 
-            # 2. Responding status
-            await queue.put({"type": "status", "status": "responding"})
+            if streamed:
+                # 2-3. Tokens were streamed raw: send the formatted response
+                # (LaTeX normalisation, fallbacks) to replace them
+                await emit({"type": "final", "content": full_response})
+            else:
+                # 2. Responding status
+                await emit({"type": "status", "status": "responding"})
 
-            # 3. Stream tokens to queue individually 
-            chunk_size = 5
-            for i in range(0, len(full_response), chunk_size):
-                chunk = full_response[i:i+chunk_size]
-                await queue.put({"type": "token", "content": chunk})
+                # 3. Nothing was generated live (planner answer, cache hit,
+                # fallback): the response is already complete, send it at once
+                await emit({"type": "token", "content": full_response})
             
             # 4. Save FINAL response to database immediately (resilience!)
             async with AsyncSessionLocal() as save_db:
-                from sqlalchemy import update
                 await save_db.execute(
                     update(Message)
                     .where(Message.id == assistant_msg_id)
@@ -445,7 +634,7 @@ async def chat(
                 )
                 
                 # Update conversation title if needed
-                if len(history) <= 1:
+                if not history:
                     result = await save_db.execute(
                         select(Conversation).where(Conversation.id == session_id)
                     )
@@ -454,16 +643,16 @@ async def chat(
                         conv.title = message[:50] if message else "New Conversation"
                 
                 await save_db.commit()
+            turn_history = [*history, HumanMessage(content=message), AIMessage(content=full_response)]
 
             # 5. Done status and metadata
-            from backend.agent.state import get_total_duration_ms
             tracking_data = {
                 'type': 'done',
                 'metadata': {
                     'session_id': session_id,
                     'agents_used': final_state.get('agents_used', []),
-                    'tools_called': final_state.get('tools_called', []),
-                    'model_calls': final_state.get('model_calls', []),
+                    'tools_called': [asdict(c) for c in final_state.get('tools_called', [])],
+                    'model_calls': [asdict(c) for c in final_state.get('model_calls', [])],
                     'total_tokens': final_state.get('total_tokens', 0),
                     'total_duration_ms': get_total_duration_ms(final_state),
                     'error': final_state.get('error_message'),
@@ -474,16 +663,27 @@ async def chat(
                     'context_message': final_state.get('context_message'),
                 }
             }
-            await queue.put(tracking_data)
+            await emit(tracking_data)
 
+        except asyncio.CancelledError:
+            # Client disconnected (CANCEL_ON_DISCONNECT): keep what was
+            # generated so the placeholder message doesn't stay pending
+            partial = "".join(streamed_parts) or "(Đã dừng: người dùng đã rời khỏi cuộc trò chuyện)"
+            async with AsyncSessionLocal() as save_db:
+                await save_db.execute(
+                    update(Message)
+                    .where(Message.id == assistant_msg_id)
+                    .values(content=partial)
+                )
+                await save_db.commit()
+            raise
         except Exception as e:
             error_msg = f"Xin lỗi, đã có lỗi xảy ra: {str(e)}"
-            await queue.put({"type": "token", "content": error_msg})
-            await queue.put({"type": "done", "error": str(e)})
+            await emit({"type": "token", "content": error_msg})
+            await emit({"type": "done", "error": str(e)})
             
             # Save error as partially result if needed
             async with AsyncSessionLocal() as save_db:
-                from sqlalchemy import update
                 await save_db.execute(
                     update(Message)
                     .where(Message.id == assistant_msg_id)
@@ -491,22 +691,41 @@ async def chat(
                 )
                 await save_db.commit()
         finally:
+            if slot_held:
+                _CHAT_SLOTS.release()
+            _end_turn(session_id, turn_ticket, turn_history)
             # Signal end of stream
-            await queue.put(None)
+            await emit(None)
 
-    # Start the agent task in the background (will continue even if client leaves)
-    asyncio.create_task(run_agent_in_background())
+    # Start the agent task in the background (continues after the client
+    # leaves unless CANCEL_ON_DISCONNECT is set)
+    turn_ticket = _begin_turn(session_id)
+    agent_task = asyncio.create_task(run_agent_in_background())
+    finished = False
 
     async def stream_from_queue():
         """Generator that reads from the queue and yields to StreamingResponse."""
+        nonlocal finished
         while True:
             item = await queue.get()
             if item is None:
+                finished = True
                 break
-            yield f"data: {json.dumps(item)}\n\n"
-
-    return StreamingResponse(
+            yield _sse_frame(item)
+
+    def stream_closed():
+        """Stream finished or client disconnected: stop queueing events and
+        unblock the agent if it is waiting on a full queue."""
+        nonlocal client_connected
+        client_connected = False
+        while not queue.empty():
+            queue.get_nowait()
+        if not finished and CANCEL_ON_DISCONNECT:
+            agent_task.cancel()
+
+    return _EventStreamResponse(
         stream_from_queue(),
+        on_close=stream_closed,
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -517,7 +736,7 @@ async def chat(
 
 
 @app.get("/api/rate-limit/{session_id}")
-async def get_rate_limit_status(session_id: str):
+async def get_rate_limit_status(session_id: str) -> dict:
     """Get current rate limit status for a session."""
     tracker = rate_limiter.get_tracker(session_id)
     tracker.reset_if_needed()
@@ -527,24 +746,18 @@ async def get_rate_limit_status(session_id: str):
         "requests_today": tracker.requests_today,
         "tokens_this_minute": tracker.tokens_this_minute,
         "tokens_today": tracker.tokens_today,
-        "limits": {
-            "rpm": 30,
-            "rpd": 1000,
-            "tpm": 8000,
-            "tpd": 200000,
-        }
+        "limits": RATE_LIMITS,  # Constant: the configured limits, shared across responses
     }
 
 
 @app.get("/api/wolfram-status")
-async def get_wolfram_status():
+async def get_wolfram_status() -> dict:
     """Get Wolfram Alpha API usage status (2000 req/month limit)."""
-    from backend.tools.wolfram import get_wolfram_status
-    return get_wolfram_status()
+    return _wolfram_status()
 
 
 @app.get("/api/tracing-status")
-async def tracing_status():
+async def tracing_status() -> dict:
     """Get LangSmith tracing status."""
     return get_tracing_status()
 
@@ -4,7 +4,7 @@ Database models and session management.
 import os
 from datetime import datetime
 from typing import Optional, List
-from sqlalchemy import create_engine, Column, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
@@ -37,14 +37,69 @@ class Message(Base):
     conversation_id = Column(String(36), ForeignKey("conversations.id"), nullable=False)
     role = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
-    image_data = Column(Text, nullable=True)  # Base64 encoded image
+    image_data = Column(Text, nullable=True)  # Legacy: JSON list of base64 images (new uploads use MessageImage)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     conversation = relationship("Conversation", back_populates="messages")
+    images = relationship(
+        "MessageImage", back_populates="message", cascade="all, delete-orphan",
+        order_by="MessageImage.idx", lazy="noload"
+    )
+    
+    __table_args__ = (
+        # History loads: WHERE conversation_id = ? ORDER BY created_at
+        Index("ix_messages_conv_created", "conversation_id", "created_at"),
+        # Search: newest matches first (ORDER BY created_at DESC LIMIT n)
+        Index("ix_messages_created", "created_at"),
+    )
+
+
+class MessageImage(Base):
+    """Uploaded image attached to a message, stored as raw bytes."""
+    __tablename__ = "message_images"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(String(36), ForeignKey("messages.id"), nullable=False)
+    idx = Column(Integer, nullable=False)  # Position in the upload
+    content_type = Column(String(100), nullable=True)
+    data = Column(LargeBinary, nullable=False)
+    
+    message = relationship("Message", back_populates="images")
+    
+    __table_args__ = (
+        Index("ix_message_images_message_idx", "message_id", "idx", unique=True),
+    )
 
 
 # Async engine and session
-engine = create_async_engine(DATABASE_URL, echo=False)
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+IS_SQLITE_MEMORY = IS_SQLITE and (":memory:" in DATABASE_URL or DATABASE_URL.rstrip("/").endswith(":"))
+
+_engine_kwargs = {}
+if not IS_SQLITE_MEMORY:  # In-memory SQLite uses a single static connection
+    _engine_kwargs.update(pool_size=10, max_overflow=20)
+if IS_SQLITE:
+    # Wait on a locked database instead of failing immediately
+    _engine_kwargs["connect_args"] = {"timeout": 30}
+
+engine = create_async_engine(DATABASE_URL, echo=False, **_engine_kwargs)
+
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """
+        WAL lets readers run during a write, and with synchronous=NORMAL a
+        commit no longer fsyncs (the WAL is synced at checkpoints). The other
+        pragmas are per connection, so they are set on every new one.
+        """
+        cursor = dbapi_connection.cursor()
+        if not IS_SQLITE_MEMORY:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
 AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
@@ -63,6 +118,15 @@ async def init_db():
 
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips indexes on tables that already exist
+        await conn.run_sync(_create_missing_indexes)
+
+
+def _create_missing_indexes(sync_conn) -> None:
+    """Add model indexes missing from an existing database."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
 
 
 async def get_db():
@@ -0,0 +1,38 @@
+"""
+Shared pytest fixtures.
+"""
+import httpx
+import pytest
+import pytest_asyncio
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One TestClient for the whole run: the app lifespan (DB init) runs once."""
+    from fastapi.testclient import TestClient
+    from backend.app import app
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture(scope="session")
+def sandbox():
+    """
+    The warm snippet worker, started once per test process (so once per
+    pytest-xdist worker when run with -n) and stopped at the end.
+    """
+    from backend.tools.sandbox_worker import sandbox_worker
+    sandbox_worker.start()
+    yield sandbox_worker
+    sandbox_worker.close()
+
+
+@pytest_asyncio.fixture
+async def aclient():
+    """Async client calling the app in-process (no worker thread per request)."""
+    from backend.app import app
+    from backend.database.models import init_db
+    await init_db()  # ASGITransport does not run the lifespan
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
@@ -3,19 +3,32 @@ Test cases for FastAPI endpoints.
 Tests health, conversations, and rate limit APIs.
 """
 import pytest
-from fastapi.testclient import TestClient
-from backend.app import app
+import pytest_asyncio
 
 
-client = TestClient(app)
+@pytest.fixture
+def conv_id(client):
+    """A fresh conversation, deleted after the test."""
+    conv_id = client.post("/api/conversations").json()["id"]
+    yield conv_id
+    client.delete(f"/api/conversations/{conv_id}")
+
+
+@pytest_asyncio.fixture
+async def aconv_id(aclient):
+    """A fresh conversation, deleted after the test (async client)."""
+    conv_id = (await aclient.post("/api/conversations")).json()["id"]
+    yield conv_id
+    await aclient.delete(f"/api/conversations/{conv_id}")
 
 
 class TestHealthEndpoint:
     """Test suite for health check endpoint."""
 
-    def test_health_check(self):
+    @pytest.mark.asyncio
+    async def test_health_check(self, aclient):
         """TC-API-001: Health endpoint should return healthy status."""
-        response = client.get("/api/health")
+        response = await aclient.get("/api/health")
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "healthy"
@@ -25,62 +38,60 @@ class TestHealthEndpoint:
 class TestConversationEndpoints:
     """Test suite for conversation CRUD endpoints."""
 
-    def test_list_conversations_empty(self):
+    @pytest.mark.asyncio
+    async def test_list_conversations_empty(self, aclient):
         """TC-API-002: List conversations should return array."""
-        response = client.get("/api/conversations")
+        response = await aclient.get("/api/conversations")
         assert response.status_code == 200
         assert isinstance(response.json(), list)
 
-    def test_create_conversation(self):
+    @pytest.mark.asyncio
+    async def test_create_conversation(self, aclient):
         """TC-API-003: Create conversation should return new conversation."""
-        response = client.post("/api/conversations")
+        response = await aclient.post("/api/conversations")
         assert response.status_code == 200
         data = response.json()
         assert "id" in data
         assert "created_at" in data
         return data["id"]
 
-    def test_delete_conversation(self):
+    @pytest.mark.asyncio
+    async def test_delete_conversation(self, aclient):
         """TC-API-004: Delete conversation should succeed."""
         # First create
-        create_response = client.post("/api/conversations")
+        create_response = await aclient.post("/api/conversations")
         conv_id = create_response.json()["id"]
         
         # Then delete
-        delete_response = client.delete(f"/api/conversations/{conv_id}")
+        delete_response = await aclient.delete(f"/api/conversations/{conv_id}")
         assert delete_response.status_code == 200
         assert delete_response.json()["status"] == "deleted"
 
-    def test_get_messages_empty(self):
+    @pytest.mark.asyncio
+    async def test_get_messages_empty(self, aclient, aconv_id):
         """TC-API-005: New conversation should have no messages."""
-        # Create conversation
-        create_response = client.post("/api/conversations")
-        conv_id = create_response.json()["id"]
-        
-        # Get messages
-        messages_response = client.get(f"/api/conversations/{conv_id}/messages")
+        messages_response = await aclient.get(f"/api/conversations/{aconv_id}/messages")
         assert messages_response.status_code == 200
         assert messages_response.json() == []
-        
-        # Cleanup
-        client.delete(f"/api/conversations/{conv_id}")
 
 
 class TestRateLimitEndpoints:
     """Test suite for rate limit status endpoints."""
 
-    def test_get_rate_limit_status(self):
+    @pytest.mark.asyncio
+    async def test_get_rate_limit_status(self, aclient):
         """TC-API-006: Rate limit status should return valid structure."""
-        response = client.get("/api/rate-limit/test_session")
+        response = await aclient.get("/api/rate-limit/test_session")
         assert response.status_code == 200
         data = response.json()
         assert "requests_this_minute" in data
         assert "tokens_today" in data
         assert "limits" in data
 
-    def test_rate_limit_limits_structure(self):
+    @pytest.mark.asyncio
+    async def test_rate_limit_limits_structure(self, aclient):
         """TC-API-007: Rate limit should have correct limit values."""
-        response = client.get("/api/rate-limit/test_session")
+        response = await aclient.get("/api/rate-limit/test_session")
         data = response.json()
         limits = data["limits"]
         assert limits["rpm"] == 30
@@ -92,9 +103,10 @@ class TestRateLimitEndpoints:
 class TestWolframStatusEndpoint:
     """Test suite for Wolfram API status endpoint."""
 
-    def test_wolfram_status(self):
+    @pytest.mark.asyncio
+    async def test_wolfram_status(self, aclient):
         """TC-API-008: Wolfram status should return usage info."""
-        response = client.get("/api/wolfram-status")
+        response = await aclient.get("/api/wolfram-status")
         assert response.status_code == 200
         data = response.json()
         assert "used" in data
@@ -103,9 +115,10 @@ class TestWolframStatusEndpoint:
         assert "month" in data
         assert data["limit"] == 2000
 
-    def test_wolfram_remaining_calculation(self):
+    @pytest.mark.asyncio
+    async def test_wolfram_remaining_calculation(self, aclient):
         """TC-API-009: Remaining should equal limit minus used."""
-        response = client.get("/api/wolfram-status")
+        response = await aclient.get("/api/wolfram-status")
         data = response.json()
         assert data["remaining"] == data["limit"] - data["used"]
 
@@ -113,7 +126,7 @@ class TestWolframStatusEndpoint:
 class TestChatEndpoint:
     """Test suite for chat endpoint."""
 
-    def test_chat_creates_session(self):
+    def test_chat_creates_session(self, client):
         """TC-API-010: Chat without session_id should create new session."""
         response = client.post(
             "/api/chat",
@@ -123,25 +136,57 @@ class TestChatEndpoint:
         # Should have session ID in header
         assert "X-Session-Id" in response.headers or response.status_code == 200
 
-    def test_chat_with_session(self):
+    def test_chat_with_session(self, client, conv_id):
         """TC-API-011: Chat with existing session_id should work."""
-        # Create conversation first
-        create_response = client.post("/api/conversations")
-        conv_id = create_response.json()["id"]
-        
         response = client.post(
             "/api/chat",
             data={"message": "Test message", "session_id": conv_id},
         )
         assert response.status_code == 200
-        
-        # Cleanup
-        client.delete(f"/api/conversations/{conv_id}")
 
-    def test_chat_invalid_session(self):
+    @pytest.mark.asyncio
+    async def test_chat_invalid_session(self, aclient):
         """TC-API-012: Chat with invalid session_id should return 404."""
-        response = client.post(
+        response = await aclient.post(
             "/api/chat",
             data={"message": "Test", "session_id": "invalid-uuid-12345"},
         )
         assert response.status_code == 404
+
+
+class TestSseFrames:
+    """Test suite for SSE frame encoding."""
+
+    def test_frames_are_valid_json_events(self):
+        """TC-API-013: Token and other events encode to `data:` frames with the same JSON."""
+        import json
+        from backend.app import _sse_frame
+        for item in (
+            {"type": "token", "content": 'Đạo hàm "f\'(x)" = $$2x$$\n'},
+            {"type": "done", "metadata": {"tools_called": [], "error": None}},
+        ):
+            frame = _sse_frame(item)
+            assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+            assert json.loads(frame[6:-2]) == item
+
+
+class TestHistoryCache:
+    """Test suite for the per-session chat history cache."""
+
+    def test_overlapping_turns_are_not_cached(self):
+        """TC-API-014: Only a turn that ran alone caches its history."""
+        from backend import app as app_module
+        app_module._HISTORY_CACHE.clear()
+
+        solo = app_module._begin_turn("s1")
+        app_module._end_turn("s1", solo, ["turn 1"])
+        assert app_module._HISTORY_CACHE["s1"] == ["turn 1"]
+
+        first = app_module._begin_turn("s2")
+        second = app_module._begin_turn("s2")
+        assert second is None
+        app_module._end_turn("s2", first, ["first"])
+        app_module._end_turn("s2", second, ["second"])
+        assert "s2" not in app_module._HISTORY_CACHE
+        assert not app_module._TURNS_IN_FLIGHT and not app_module._TURNS_STARTED
+        app_module._HISTORY_CACHE.clear()
@@ -3,9 +3,12 @@ Test cases for Code Executor tool.
 Tests sandbox execution, SymPy integration, and correction loop.
 """
 import pytest
-from backend.tools.code_executor import execute_python_code
+from backend.tools.code_executor import (
+    CodeTool, execute_python_code, run_snippet, _fresh_globals, _sandbox_globals,
+)
 
 
+@pytest.mark.usefixtures("sandbox")
 class TestCodeExecutor:
     """Test suite for code executor sandbox."""
 
@@ -176,6 +179,7 @@ print(latex(expr))
         assert "x^{2}" in result or "x**2" in result
 
 
+@pytest.mark.usefixtures("sandbox")
 class TestCodeExecutorAdvanced:
     """Advanced algebra test cases."""
 
@@ -187,6 +191,17 @@ class TestCodeExecutorAdvanced:
 elements = [(1 * i) % 5 for i in range(5)]
 print("Generated elements:", set(elements))
 print("Is cyclic:", len(set(elements)) == 5)
+"""
+        success, result = execute_python_code(code)
+        assert success is True
+        assert "Is cyclic: True" in result
+
+    def test_group_theory_cyclic_numpy(self):
+        """TC-CE-024: The same cyclic check, vectorised with the pre-loaded NumPy."""
+        pytest.importorskip("numpy")
+        code = """
+elements = set(((np.arange(5) * 1) % 5).tolist())
+print("Is cyclic:", len(elements) == 5)
 """
         success, result = execute_python_code(code)
         assert success is True
@@ -213,3 +228,82 @@ print("LCM(4, 6):", lcm(4, 6))
         assert success is True
         assert "6" in result  # GCD = 6
         assert "12" in result  # LCM = 12
+
+
+@pytest.mark.usefixtures("sandbox")
+class TestSandboxWorker:
+    """Test suite for the persistent worker behind execute_python_code."""
+
+    def test_timeout_stops_run_and_worker_keeps_serving(self):
+        """TC-CE-023: A hung snippet times out and the next run still works."""
+        success, result = execute_python_code("while True: pass", timeout=1)
+        assert success is False
+        assert "timed out" in result
+        success, result = execute_python_code("print(gcd(12, 18))")
+        assert success is True
+        assert result == "6"
+
+    def test_state_does_not_carry_over_between_runs(self):
+        """TC-CE-028: Names and patched SymPy objects from one run are gone in the next."""
+        success, _ = execute_python_code("x = 1\nMatrix.det = lambda self: 42\nlen = None")
+        assert success is True
+        success, result = execute_python_code("print(x)")
+        assert success is False
+        assert "NameError" in result
+        success, result = execute_python_code("print(Matrix([[1, 2], [3, 4]]).det(), len([1, 2, 3]))")
+        assert success is True
+        assert result == "-2 3"
+
+
+class TestSnippetRestrictions:
+    """Test suite for the namespace restrictions of run_snippet."""
+
+    @pytest.mark.parametrize("code", [
+        # sympify is not pre-loaded
+        "print(sympify(\"__import__('os').getcwd()\"))",
+        # Objects that sympify their arguments don't reach the real builtins
+        "print(Matrix([\"__import__('os').getcwd()\"]))",
+        "print(simplify(\"open('/etc/hostname').read()\"))",
+        # Dunder attribute walks are refused
+        "print(().__class__.__base__.__subclasses__())",
+    ])
+    def test_string_evaluation_escape_blocked(self, code):
+        """TC-CE-025: Strings and dunders can't reach the real builtins."""
+        success, result = run_snippet(code)
+        assert success is False
+        assert "/root" not in result
+
+    def test_builtins_do_not_leak_between_runs(self):
+        """TC-CE-026: Builtins rebound by one run are restored for the next."""
+        run_snippet("len = lambda x: 42\nprint(len([1, 2, 3]))")
+        success, result = run_snippet("print(len([1, 2, 3]))")
+        assert success is True
+        assert result == "3"
+        assert _fresh_globals()["__builtins__"] is not _sandbox_globals()["__builtins__"]
+
+    def test_string_arguments_still_parse(self):
+        """TC-CE-027: Plain math strings are still sympified."""
+        success, result = run_snippet('print(solve("x**2 - 4"))')
+        assert success is True
+        assert result == "[-2, 2]"
+
+
+class TestCodeToolAsync:
+    """Test suite for the non-blocking CodeTool.aexecute."""
+
+    @pytest.mark.asyncio
+    async def test_aexecute_matches_execute(self):
+        """TC-CE-021: aexecute should return the same result shape as execute."""
+        tool = CodeTool()
+        assert await tool.aexecute("print(6 * 7)") == {"success": True, "output": "42", "error": None}
+        failed = await tool.aexecute("1 / 0")
+        assert failed["success"] is False
+        assert "ZeroDivisionError" in failed["error"]
+
+    @pytest.mark.asyncio
+    async def test_aexecute_timeout(self):
+        """TC-CE-022: Code running past the timeout should be killed and reported."""
+        tool = CodeTool(timeout=1)
+        result = await tool.aexecute("import time\ntime.sleep(5)")
+        assert result["success"] is False
+        assert "timed out" in result["error"]
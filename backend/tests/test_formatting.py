@@ -0,0 +1,73 @@
+"""
+Test cases for output formatting helpers.
+Tests LaTeX block normalization for Markdown rendering and block parsing.
+"""
+import pytest
+from backend.agent.nodes import format_latex_for_markdown
+from backend.agent.schemas import parse_text_to_blocks
+
+
+class TestFormatLatexForMarkdown:
+    """Test suite for format_latex_for_markdown."""
+
+    def test_empty_text(self):
+        """TC-FMT-001: Empty input should be returned unchanged."""
+        assert format_latex_for_markdown("") == ""
+        assert format_latex_for_markdown(None) is None
+
+    def test_plain_text_unchanged(self):
+        """TC-FMT-002: Text without math should only be stripped."""
+        assert format_latex_for_markdown("  Xin chào  ") == "Xin chào"
+
+    def test_block_math_on_own_lines(self):
+        """TC-FMT-003: $$...$$ should be placed on its own lines."""
+        result = format_latex_for_markdown("Ta có $$ x^2 + 1 $$ suy ra")
+        assert result == "Ta có \n$$\nx^2 + 1\n$$\n suy ra"
+
+    def test_math_content_preserved(self):
+        """TC-FMT-004: Content inside $$ blocks should not be altered."""
+        math = r"\begin{aligned} a &= b \\ c &= d \end{aligned}"
+        result = format_latex_for_markdown(f"$${math}$$")
+        assert math in result
+
+    def test_collapses_excess_newlines(self):
+        """TC-FMT-005: 3+ consecutive newlines should collapse to a paragraph break."""
+        assert format_latex_for_markdown("a\n\n\n\nb") == "a\n\nb"
+
+    def test_multiple_blocks(self):
+        """TC-FMT-006: Multiple math blocks should all be formatted."""
+        result = format_latex_for_markdown("A $$x$$ B $$y$$ C")
+        assert result.count("\n$$\n") == 4
+        assert result.startswith("A") and result.endswith("C")
+
+    def test_unclosed_block_runs_to_end(self):
+        """TC-FMT-007: An unclosed $$ should be treated as math until the end."""
+        assert format_latex_for_markdown("Kết quả $$x + 1") == "Kết quả \n$$\nx + 1\n$$"
+
+
+class TestParseTextToBlocks:
+    """Test suite for parse_text_to_blocks."""
+
+    def test_all_delimiters(self):
+        """TC-FMT-008: Every supported LaTeX delimiter should become a math block."""
+        blocks = parse_text_to_blocks(r"Ta có \[x^2\] và \(y\), $z$ \begin{cases}a\end{cases} $$w$$")
+        assert [(b["type"], b["content"], b["display"]) for b in blocks] == [
+            ("text", "Ta có", None),
+            ("math", "x^2", "block"),
+            ("text", "và", None),
+            ("math", "y", "inline"),
+            ("text", ",", None),
+            ("math", "z", "inline"),
+            ("math", "a", "block"),
+            ("math", "w", "block"),
+        ]
+
+    def test_plain_text_single_block(self):
+        """TC-FMT-009: Text without math should stay one text block."""
+        assert parse_text_to_blocks("Xin chào") == [{"type": "text", "content": "Xin chào", "display": None}]
+
+    def test_environment_inside_block_math(self):
+        """TC-FMT-010: An environment wrapped in $$ should stay one math block."""
+        blocks = parse_text_to_blocks(r"$$\begin{aligned}a &= b\end{aligned}$$ xong")
+        assert blocks[0] == {"type": "math", "content": r"\begin{aligned}a &= b\end{aligned}", "display": "block"}
+        assert blocks[1] == {"type": "text", "content": "xong", "display": None}
@@ -56,6 +56,11 @@ class TestGraphCompilation:
         """TC-LG-004: Pre-compiled agent_graph should exist."""
         assert agent_graph is not None
 
+    def test_agent_graph_compiled_once(self):
+        """TC-LG-009: Compiled graph should be cached and shared."""
+        from backend.agent import graph
+        assert graph.agent_graph is graph.get_agent_graph()
+
 
 class TestRoutingLogic:
     """Test suite for graph routing decisions."""
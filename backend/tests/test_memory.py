@@ -0,0 +1,99 @@
+"""
+Test cases for session memory token estimation.
+Tests the tokenizer/heuristic switch, memoization and history truncation.
+"""
+import sys
+from collections import OrderedDict
+from unittest.mock import MagicMock
+from langchain_core.messages import HumanMessage, AIMessage
+from backend.utils import memory
+from backend.utils.memory import estimate_tokens, estimate_message_tokens, truncate_history_to_fit
+
+
+class TestEstimateTokens:
+    """Test suite for token estimation."""
+
+    def test_heuristic_without_encoder(self, monkeypatch):
+        """TC-MEM-001: Without a BPE encoder, ~4 characters count as one token."""
+        monkeypatch.setattr(memory, "_ENCODER", None)
+        assert estimate_tokens("x" * 400) == 100
+        assert estimate_tokens("") == 0
+
+    def test_encoder_results_are_memoized(self, monkeypatch):
+        """TC-MEM-002: The same text should only be tokenized once."""
+        encoder = MagicMock()
+        encoder.encode.side_effect = lambda text: text.split()
+        monkeypatch.setattr(memory, "_ENCODER", encoder)
+        memory._TOKEN_COUNTS.clear()
+        try:
+            assert estimate_tokens("tính tích phân kép") == 4
+            assert estimate_tokens("tính tích phân kép") == 4
+            assert encoder.encode.call_count == 1
+        finally:
+            memory._TOKEN_COUNTS.clear()
+
+    def test_encoder_is_loaded_on_first_use(self, monkeypatch):
+        """TC-MEM-007: The encoder is loaded by the first estimate, once, not at import."""
+        tiktoken = MagicMock()
+        tiktoken.get_encoding.return_value.encode.side_effect = lambda text: text.split()
+        monkeypatch.setitem(sys.modules, "tiktoken", tiktoken)
+        monkeypatch.setattr(memory, "_ENCODER", memory._UNLOADED)
+        monkeypatch.setattr(memory, "_TOKEN_COUNTS", OrderedDict())
+        assert estimate_tokens("a b") == 2
+        assert estimate_tokens("c d e") == 3
+        tiktoken.get_encoding.assert_called_once_with("cl100k_base")
+
+    def test_memo_is_bounded_and_keyed_by_digest(self, monkeypatch):
+        """TC-MEM-008: Memoized counts don't hold the texts and are capped."""
+        encoder = MagicMock()
+        encoder.encode.side_effect = lambda text: text.split()
+        monkeypatch.setattr(memory, "_ENCODER", encoder)
+        monkeypatch.setattr(memory, "_TOKEN_COUNTS", OrderedDict())
+        monkeypatch.setattr(memory, "TOKEN_COUNT_CACHE_SIZE", 2)
+        for text in ("một", "hai ba", "bốn năm sáu"):
+            estimate_tokens(text)
+        assert len(memory._TOKEN_COUNTS) == 2
+        assert all(isinstance(key, bytes) and len(key) == 16 for key in memory._TOKEN_COUNTS)
+
+    def test_message_tokens_include_images(self, monkeypatch):
+        """TC-MEM-003: Image parts should add a fixed estimate."""
+        monkeypatch.setattr(memory, "_ENCODER", None)
+        msg = HumanMessage(content=[
+            {"type": "text", "text": "x" * 40},
+            {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,AAAA"}},
+        ])
+        assert estimate_message_tokens([msg, AIMessage(content="y" * 8)]) == 10 + 500 + 2
+
+
+class TestTruncateHistory:
+    """Test suite for history truncation."""
+
+    def test_keeps_most_recent_messages(self, monkeypatch):
+        """TC-MEM-004: Oldest messages are dropped first when over budget."""
+        monkeypatch.setattr(memory, "_ENCODER", None)
+        history = [HumanMessage(content="a" * 400), AIMessage(content="b" * 400), HumanMessage(content="c" * 400)]
+        kept = truncate_history_to_fit(
+            history, system_tokens=0, current_tokens=0,
+            max_context_tokens=250, reserve_for_response=0
+        )
+        assert [m.content[0] for m in kept] == ["b", "c"]
+
+    def test_end_excludes_current_message(self, monkeypatch):
+        """TC-MEM-005: `end` should limit the window without slicing the history."""
+        monkeypatch.setattr(memory, "_ENCODER", None)
+        history = [HumanMessage(content="a"), AIMessage(content="b"), HumanMessage(content="c")]
+        kept = truncate_history_to_fit(history, end=2)
+        assert [m.content for m in kept] == ["a", "b"]
+
+
+class TestHistorySummary:
+    """Test suite for the stored per-session history summary."""
+
+    def test_summary_roundtrip_and_reset(self, tmp_path):
+        """TC-MEM-006: A stored summary is returned with its coverage and cleared on reset."""
+        tracker = memory.SessionMemoryTracker(cache_dir=str(tmp_path))
+        assert tracker.get_summary("s1") == (None, 0)
+        tracker.set_summary("s1", "Đã tính $\\int x\\,dx$", 12)
+        assert tracker.get_summary("s1") == ("Đã tính $\\int x\\,dx$", 12)
+        tracker.reset_usage("s1")
+        assert tracker.get_summary("s1") == (None, 0)
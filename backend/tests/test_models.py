@@ -0,0 +1,282 @@
+"""
+Test cases for model management.
+Tests ChatGroq instance caching, hedged fallback and per-model rate limit tracking.
+"""
+import asyncio
+import pytest
+from unittest.mock import MagicMock, AsyncMock
+from langchain_core.messages import AIMessage
+from backend.agent import models
+from backend.utils import memory
+from backend.agent.models import ModelManager, ModelRateLimitTracker, MODEL_CONFIGS, get_usage_tokens
+
+
+@pytest.fixture
+def api_key(monkeypatch):
+    """Provide a dummy Groq key so ChatGroq can be constructed offline."""
+    monkeypatch.setattr(models, "_RESOLVED", {
+        name: (config, "test-key") for name, (config, _) in models._RESOLVED.items()
+    })
+
+
+class TestModelManager:
+    """Test suite for ModelManager."""
+
+    def test_get_model_is_cached(self, api_key):
+        """TC-MM-001: Same model name should return the same ChatGroq instance."""
+        manager = ModelManager()
+        assert manager.get_model("kimi-k2") is manager.get_model("kimi-k2")
+
+    def test_get_model_per_model_instances(self, api_key):
+        """TC-MM-002: Different models should get different instances."""
+        manager = ModelManager()
+        assert manager.get_model("kimi-k2") is not manager.get_model("qwen3-32b")
+
+    def test_models_share_http_client(self, api_key):
+        """TC-MM-024: All models should reuse one async HTTP connection pool."""
+        manager = ModelManager()
+        kimi = manager.get_model("kimi-k2")
+        qwen = manager.get_model("qwen3-32b")
+        assert kimi.http_async_client is qwen.http_async_client is manager._http
+
+    def test_concurrency_sized_from_rpm(self):
+        """TC-MM-018: Per-model semaphore should allow rpm // 10 in-flight calls."""
+        manager = ModelManager()
+        assert manager.concurrency("kimi-k2")._value == MODEL_CONFIGS["kimi-k2"].rpm // 10
+        assert manager.concurrency("kimi-k2") is manager.concurrency("kimi-k2")
+        with pytest.raises(ValueError):
+            manager.concurrency("not-a-model")
+
+    def test_get_model_unknown(self):
+        """TC-MM-003: Unknown model should raise ValueError."""
+        manager = ModelManager()
+        with pytest.raises(ValueError):
+            manager.get_model("not-a-model")
+
+
+class TestUsageTokens:
+    """Test suite for response token accounting."""
+
+    def test_uses_usage_metadata(self):
+        """TC-MM-013: Provider usage metadata should be preferred."""
+        response = AIMessage(
+            content="x" * 400,
+            usage_metadata={"input_tokens": 30, "output_tokens": 12, "total_tokens": 42},
+        )
+        assert get_usage_tokens(response) == 42
+
+    def test_falls_back_to_length(self, monkeypatch):
+        """TC-MM-014: Missing metadata should fall back to the local token estimate."""
+        monkeypatch.setattr(memory, "_ENCODER", None)
+        assert get_usage_tokens(AIMessage(content="x" * 400)) == 100
+
+
+@pytest.mark.asyncio
+class TestInvokeWithFallback:
+    """Test suite for hedged primary/fallback invocation."""
+
+    @staticmethod
+    def _manager_with(responses: dict) -> ModelManager:
+        """Build a manager whose models sleep then answer (or raise) per name."""
+        manager = ModelManager()
+
+        def fake_model(name):
+            delay, outcome = responses[name]
+            llm = MagicMock()
+
+            async def ainvoke(messages):
+                await asyncio.sleep(delay)
+                if isinstance(outcome, Exception):
+                    raise outcome
+                return AIMessage(content=outcome)
+
+            llm.ainvoke = ainvoke
+            return llm
+
+        manager.get_model = fake_model
+        return manager
+
+    async def test_fast_primary_wins(self):
+        """TC-MM-004: Primary answering before the hedge delay is used."""
+        manager = self._manager_with({"kimi-k2": (0, "primary"), "qwen3-32b": (0, "fallback")})
+        content, model, _ = await manager.invoke_with_fallback(
+            "kimi-k2", "qwen3-32b", [], hedge_delay=0.5
+        )
+        assert (content, model) == ("primary", "kimi-k2")
+        assert manager.trackers["kimi-k2"].curr_day_requests == 1
+        assert "qwen3-32b" not in manager.trackers or manager.trackers["qwen3-32b"].curr_day_requests == 0
+
+    async def test_slow_primary_is_hedged(self):
+        """TC-MM-005: Slow primary should lose the race to the fallback."""
+        manager = self._manager_with({"kimi-k2": (2, "primary"), "qwen3-32b": (0, "fallback")})
+        content, model, _ = await manager.invoke_with_fallback(
+            "kimi-k2", "qwen3-32b", [], hedge_delay=0.01
+        )
+        assert (content, model) == ("fallback", "qwen3-32b")
+        # The cancelled primary was already sent: it stays counted
+        assert manager.trackers["kimi-k2"].curr_day_requests == 1
+
+    async def test_hedging_is_opt_in(self):
+        """TC-MM-026: Without a hedge delay a slow primary is waited for, not doubled."""
+        manager = self._manager_with({"kimi-k2": (0.05, "primary"), "qwen3-32b": (0, "fallback")})
+        content, model, _ = await manager.invoke_with_fallback("kimi-k2", "qwen3-32b", [])
+        assert (content, model) == ("primary", "kimi-k2")
+        assert "qwen3-32b" not in manager.trackers or manager.trackers["qwen3-32b"].curr_day_requests == 0
+
+    async def test_failed_primary_uses_fallback(self):
+        """TC-MM-006: Primary error should fall through to the fallback."""
+        manager = self._manager_with({"kimi-k2": (0, Exception("boom")), "qwen3-32b": (0, "fallback")})
+        content, model, _ = await manager.invoke_with_fallback(
+            "kimi-k2", "qwen3-32b", [], hedge_delay=0.5
+        )
+        assert model == "qwen3-32b"
+
+    async def test_rate_limited_primary_hands_over(self):
+        """TC-MM-023: Rate-limited primary should go straight to the fallback."""
+        manager = self._manager_with({"kimi-k2": (0, "primary"), "qwen3-32b": (0, "fallback")})
+        manager._get_tracker("kimi-k2").request_bucket = 0
+        content, model, _ = await asyncio.wait_for(
+            manager.invoke_with_fallback("kimi-k2", "qwen3-32b", [], hedge_delay=10),
+            timeout=1,
+        )
+        assert model == "qwen3-32b"
+
+    async def test_no_fallback_raises(self):
+        """TC-MM-007: Primary error without fallback should propagate."""
+        manager = self._manager_with({"kimi-k2": (0, Exception("boom"))})
+        with pytest.raises(Exception, match="boom"):
+            await manager.invoke_with_fallback("kimi-k2", None, [])
+
+
+class TestModelRateLimitTracker:
+    """Test suite for per-model token-bucket rate limiting."""
+
+    def test_initial_buckets_full(self):
+        """TC-MM-008: New tracker should allow requests up to capacity."""
+        tracker = ModelRateLimitTracker("kimi-k2", MODEL_CONFIGS["kimi-k2"])
+        assert tracker.can_request() == (True, "")
+        assert tracker.request_bucket == MODEL_CONFIGS["kimi-k2"].rpm
+
+    def test_rpm_exhausted(self):
+        """TC-MM-009: Draining the request bucket should block."""
+        config = MODEL_CONFIGS["gpt-oss-120b"]
+        tracker = ModelRateLimitTracker("gpt-oss-120b", config)
+        for _ in range(config.rpm):
+            tracker.record_request(1)
+        can_use, msg = tracker.can_request(estimated_tokens=1)
+        assert can_use is False
+        assert "RPM" in msg
+
+    def test_bucket_refills_over_time(self):
+        """TC-MM-010: Bucket should refill proportionally to elapsed time."""
+        config = MODEL_CONFIGS["gpt-oss-120b"]  # 30 RPM -> 1 request per 2s
+        tracker = ModelRateLimitTracker("gpt-oss-120b", config)
+        for _ in range(config.rpm):
+            tracker.record_request(1)
+        tracker.last_refill -= 2.5
+        can_use, _ = tracker.can_request(estimated_tokens=1)
+        assert can_use is True
+
+    def test_tpm_exceeded(self):
+        """TC-MM-011: Estimate larger than available tokens should block."""
+        config = MODEL_CONFIGS["qwen3-32b"]
+        tracker = ModelRateLimitTracker("qwen3-32b", config)
+        can_use, msg = tracker.can_request(estimated_tokens=config.tpm + 1)
+        assert can_use is False
+        assert "TPM" in msg
+
+    def test_daily_sliding_window_weights_previous_day(self):
+        """TC-MM-012: Previous day usage should count proportionally to overlap."""
+        config = MODEL_CONFIGS["kimi-k2"]
+        tracker = ModelRateLimitTracker("kimi-k2", config)
+        tracker.curr_day_requests = config.rpd
+        # Roll into the next window, 10% of the way through it
+        tracker.curr_day_start -= 86400 * 1.1
+        can_use, _ = tracker.can_request(estimated_tokens=1)
+        assert can_use is True  # Only 90% of yesterday still counts
+        assert tracker.prev_day_requests == config.rpd
+        assert tracker.curr_day_requests == 0
+
+        tracker.curr_day_requests = int(config.rpd * 0.15)
+        can_use, msg = tracker.can_request(estimated_tokens=1)
+        assert can_use is False
+        assert "RPD" in msg
+
+    def test_reservation_debits_immediately(self):
+        """TC-MM-019: Reserving should block the next caller before the call completes."""
+        config = MODEL_CONFIGS["gpt-oss-120b"]
+        tracker = ModelRateLimitTracker("gpt-oss-120b", config)
+        admitted = [tracker.try_reserve(1)[0] for _ in range(config.rpm + 5)]
+        assert admitted.count(True) == config.rpm
+
+    def test_settle_and_release(self):
+        """TC-MM-020: Settling corrects token usage; releasing refunds the reservation."""
+        tracker = ModelRateLimitTracker("kimi-k2", MODEL_CONFIGS["kimi-k2"])
+        tracker.try_reserve(100)
+        tracker.settle(100, 40)
+        assert (tracker.curr_day_requests, tracker.curr_day_tokens) == (1, 40)
+        tracker.try_reserve(100)
+        tracker.release(100)
+        assert (tracker.curr_day_requests, tracker.curr_day_tokens) == (1, 40)
+
+
+@pytest.mark.asyncio
+class TestConcurrentAdmission:
+    """Test suite for rate-limit admission under concurrent calls."""
+
+    async def test_concurrent_calls_cannot_overshoot_rpm(self):
+        """TC-MM-021: Calls racing past the check should not exceed the RPM bucket."""
+        config = MODEL_CONFIGS["gpt-oss-120b"]
+        manager = TestInvokeWithFallback._manager_with({"gpt-oss-120b": (0.01, "ok")})
+        results = await asyncio.gather(
+            *(manager.invoke_with_fallback("gpt-oss-120b", None, [], estimated_tokens=1)
+              for _ in range(config.rpm + 10)),
+            return_exceptions=True,
+        )
+        assert sum(r == ("ok", "gpt-oss-120b", 0) for r in results) == config.rpm
+        assert manager.trackers["gpt-oss-120b"].curr_day_requests == config.rpm
+
+    async def test_failed_call_releases_reservation(self):
+        """TC-MM-022: A failed call should not consume rate-limit budget."""
+        manager = TestInvokeWithFallback._manager_with({"kimi-k2": (0, Exception("boom"))})
+        with pytest.raises(Exception, match="boom"):
+            await manager.invoke_with_fallback("kimi-k2", None, [])
+        assert manager.trackers["kimi-k2"].curr_day_requests == 0
+
+
+@pytest.mark.asyncio
+class TestInvokeBatched:
+    """Test suite for batching several prompts into one request."""
+
+    @staticmethod
+    def _manager_returning(content: str) -> ModelManager:
+        manager = ModelManager()
+        llm = MagicMock()
+        llm.ainvoke = AsyncMock(return_value=AIMessage(content=content))
+        manager.get_model = lambda name: llm
+        return manager
+
+    async def test_answers_in_order(self):
+        """TC-MM-015: JSON answers should map back to prompts by index."""
+        manager = self._manager_returning('```json\n{"2": "b", "1": "a"}\n```')
+        answers = await manager.ainvoke_batched("kimi-k2", ["p1", "p2"], "sys")
+        assert answers == ["a", "b"]
+        assert manager.trackers["kimi-k2"].curr_day_requests == 1
+
+    async def test_latex_backslashes_repaired(self):
+        """TC-MM-016: Unescaped LaTeX in answers should still parse."""
+        manager = self._manager_returning(r'{"1": "$\iint f$", "2": "$\sqrt{2}$"}')
+        answers = await manager.ainvoke_batched("kimi-k2", ["p1", "p2"], "sys")
+        assert answers == [r"$\iint f$", r"$\sqrt{2}$"]
+
+    async def test_mixed_escapes_not_doubled(self):
+        """TC-MM-025: Already escaped backslashes should survive the repair."""
+        manager = self._manager_returning(r'{"1": "$\frac{1}{2}$", "2": "$\\frac{1}{2}$"}')
+        answers = await manager.ainvoke_batched("kimi-k2", ["p1", "p2"], "sys")
+        assert answers == [r"$\frac{1}{2}$", r"$\frac{1}{2}$"]
+
+    async def test_missing_answer_raises(self):
+        """TC-MM-017: Incomplete batched response should raise ValueError."""
+        manager = self._manager_returning('{"1": "a"}')
+        with pytest.raises(ValueError):
+            await manager.ainvoke_batched("kimi-k2", ["p1", "p2"], "sys")
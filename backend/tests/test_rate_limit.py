@@ -152,3 +152,10 @@ class TestQueryCache:
         cache.set("key1", "value1")
         cache.clear()
         assert cache.get("key1") is None
+
+    def test_cache_key_normalizes_whitespace_only(self, tmp_path):
+        """TC-RL-016: Whitespace variants share an entry; case variants don't."""
+        cache = QueryCache(cache_dir=str(tmp_path / "cache"))
+        cache.set("Solve  x^2 = E", "response_E")
+        assert cache.get(" Solve x^2\n= E ") == "response_E"
+        assert cache.get("Solve x^2 = e") is None
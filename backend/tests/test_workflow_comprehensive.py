@@ -14,6 +14,7 @@ import pytest
 import asyncio
 import json
 from unittest.mock import AsyncMock, MagicMock, patch
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
 
 # Test utilities
 def create_mock_state(session_id="test-session", messages=None, image_data_list=None):
@@ -51,6 +52,25 @@ def create_mock_state(session_id="test-session", messages=None, image_data_list=
     }
 
 
+@pytest.fixture(autouse=True)
+def isolated_query_cache(tmp_path, monkeypatch):
+    """Use a fresh response cache per test so cached plans don't leak between tests."""
+    from backend.agent import nodes
+    from backend.utils.rate_limit import QueryCache
+    monkeypatch.setattr(nodes, "query_cache", QueryCache(str(tmp_path / "query_cache")))
+
+
+def streaming_llm(content, chunk_size=16):
+    """Create a mock LLM whose astream yields `content` in chunks."""
+    async def astream(messages):
+        for i in range(0, len(content), chunk_size):
+            yield AIMessageChunk(content=content[i:i + chunk_size])
+    
+    mock_llm = MagicMock()
+    mock_llm.astream = astream
+    return mock_llm
+
+
 class TestPlannerNode:
     """Tests for planner_node routing logic."""
     
@@ -67,9 +87,7 @@ class TestPlannerNode:
         
         with patch("backend.agent.nodes.get_model") as mock_get_model, \
              patch("backend.agent.nodes.memory_tracker") as mock_memory:
-            mock_llm = AsyncMock()
-            mock_llm.ainvoke.return_value = mock_response
-            mock_get_model.return_value = mock_llm
+            mock_get_model.return_value = streaming_llm(mock_response.content)
             
             mock_status = MagicMock()
             mock_status.status = "normal"
@@ -103,9 +121,7 @@ class TestPlannerNode:
         
         with patch("backend.agent.nodes.get_model") as mock_get_model, \
              patch("backend.agent.nodes.memory_tracker") as mock_memory:
-            mock_llm = AsyncMock()
-            mock_llm.ainvoke.return_value = mock_response
-            mock_get_model.return_value = mock_llm
+            mock_get_model.return_value = streaming_llm(mock_response.content)
             
             mock_status = MagicMock()
             mock_status.status = "normal"
@@ -120,6 +136,69 @@ class TestPlannerNode:
         assert len(result["execution_plan"]["questions"]) == 2, "Plan should have 2 questions"
         print("✅ Test Case 2 PASSED: Mixed -> JSON -> Executor")
     
+    @pytest.mark.asyncio
+    async def test_repeated_first_turn_uses_cache(self):
+        """Test: A repeated standalone request should reuse the cached plan."""
+        from backend.agent.nodes import planner_node
+        
+        calls = []
+        async def astream(messages):
+            calls.append(messages)
+            yield AIMessageChunk(content="## Bài 1:\nĐạo hàm của x^2 là 2x.")
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = astream
+        
+        with patch("backend.agent.nodes.get_model", return_value=mock_llm), \
+             patch("backend.agent.nodes.memory_tracker") as mock_memory:
+            mock_status = MagicMock()
+            mock_status.status = "normal"
+            mock_status.used_tokens = 100
+            mock_status.message = ""
+            mock_memory.check_status.return_value = mock_status
+            
+            first = await planner_node(create_mock_state(messages=[HumanMessage(content="Đạo hàm x^2?")]))
+            second = await planner_node(create_mock_state(messages=[HumanMessage(content="  Đạo hàm   x^2? ")]))
+        
+        assert len(calls) == 1, "Second request should be served from cache"
+        assert first["final_response"] == second["final_response"]
+        assert second["model_calls"][0].model == "query-cache"
+        print("✅ Test: Planner Cache -> Repeated Request Skips LLM")
+    
+    @pytest.mark.asyncio
+    async def test_short_history_skips_truncation(self):
+        """Test: History that fits the context budget is passed through untruncated."""
+        from backend.agent.nodes import planner_node
+        from langchain_core.messages import AIMessage
+        
+        calls = []
+        async def astream(messages):
+            calls.append(messages)
+            yield AIMessageChunk(content="## Bài 1:\nKết quả là 3x^2.")
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = astream
+        history = [
+            HumanMessage(content="Đạo hàm x^2?"),
+            AIMessage(content="2x"),
+            HumanMessage(content="Còn x^3?")
+        ]
+        
+        with patch("backend.agent.nodes.get_model", return_value=mock_llm), \
+             patch("backend.agent.nodes.truncate_history_to_fit") as mock_truncate, \
+             patch("backend.agent.nodes.memory_tracker") as mock_memory:
+            mock_status = MagicMock()
+            mock_status.status = "normal"
+            mock_status.used_tokens = 100
+            mock_status.message = ""
+            mock_memory.check_status.return_value = mock_status
+            
+            await planner_node(create_mock_state(messages=history))
+        
+        mock_truncate.assert_not_called()
+        assert calls[0][1:3] == history[:2], "Earlier turns should be sent as-is"
+        print("✅ Test: Short History -> No Truncation")
+    
     @pytest.mark.asyncio
     async def test_memory_overflow_blocks_execution(self):
         """Test Case 5: Memory overflow should stop execution."""
@@ -132,9 +211,7 @@ class TestPlannerNode:
         
         with patch("backend.agent.nodes.get_model") as mock_get_model, \
              patch("backend.agent.nodes.memory_tracker") as mock_memory:
-            mock_llm = AsyncMock()
-            mock_llm.ainvoke.return_value = mock_response
-            mock_get_model.return_value = mock_llm
+            mock_get_model.return_value = streaming_llm(mock_response.content)
             
             # Simulate memory overflow
             mock_status = MagicMock()
@@ -163,9 +240,7 @@ class TestPlannerNode:
         
         with patch("backend.agent.nodes.get_model") as mock_get_model, \
              patch("backend.agent.nodes.memory_tracker") as mock_memory:
-            mock_llm = AsyncMock()
-            mock_llm.ainvoke.return_value = mock_response
-            mock_get_model.return_value = mock_llm
+            mock_get_model.return_value = streaming_llm(mock_response.content)
             
             mock_status = MagicMock()
             mock_status.status = "normal"
@@ -181,6 +256,257 @@ class TestPlannerNode:
         print("✅ Test Case 6 PASSED: JSON Repair (LaTeX)")
 
 
+class TestMemoryTracking:
+    """Tests for the shared session memory bookkeeping helper."""
+    
+    def test_track_memory_updates_state(self):
+        """Test: Usage is recorded and status changes are mirrored into state."""
+        from backend.agent import nodes
+        
+        state = create_mock_state()
+        status = MagicMock(used_tokens=1234, status="warning", message="Session sắp đầy bộ nhớ.")
+        with patch("backend.agent.nodes.memory_tracker") as mock_memory:
+            mock_memory.check_status.return_value = status
+            result = nodes._track_memory(state, 200)
+        
+        mock_memory.add_usage.assert_called_once_with(state["session_id"], 200)
+        assert result is status
+        assert state["session_token_count"] == 1234
+        assert state["context_status"] == "warning"
+        assert state["context_message"] == "Session sắp đầy bộ nhớ."
+        print("✅ Test: Memory Tracking -> State Updated")
+
+
+class TestSyntheticAgent:
+    """Tests for the synthetic agent: rolling history window and synthesis shortcuts."""
+    
+    @pytest.mark.asyncio
+    async def test_long_history_uses_summary_and_refreshes(self):
+        """Test: Older turns are replaced by the stored summary and a refresh is scheduled."""
+        from backend.agent import nodes
+        from langchain_core.messages import AIMessage, SystemMessage
+        
+        messages = [HumanMessage(content=f"Câu {i}") if i % 2 == 0 else AIMessage(content=f"Đáp {i}") for i in range(20)]
+        state = create_mock_state(messages=messages)
+        
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="Tóm tắt mới"))
+        with patch("backend.agent.nodes.memory_tracker") as mock_memory, \
+             patch("backend.agent.nodes.get_model", return_value=mock_llm):
+            mock_memory.get_summary.return_value = ("Tóm tắt cũ", 2)
+            history = nodes._synthesis_history(state)
+            await nodes._SUMMARY_TASKS[state["session_id"]]
+        
+        assert isinstance(history[0], SystemMessage) and "Tóm tắt cũ" in history[0].content
+        assert history[1:] == messages[-nodes.SYNTH_HISTORY_WINDOW:]
+        assert state["history_summary"] == "Tóm tắt cũ"
+        # Messages 2..13 are folded into the new summary, which now covers 14
+        mock_memory.set_summary.assert_called_once_with(state["session_id"], "Tóm tắt mới", 14)
+        assert "Câu 2" in mock_llm.ainvoke.call_args[0][0][0].content
+        assert state["session_id"] not in nodes._SUMMARY_TASKS
+        print("✅ Test: Synthesis History -> Summary + Recent Window")
+    
+    @pytest.mark.asyncio
+    async def test_final_latex_code_result_skips_llm(self):
+        """Test: A successful code result that is already LaTeX is returned without synthesis."""
+        from backend.agent.nodes import synthetic_agent_node
+        
+        state = create_mock_state(messages=[HumanMessage(content="Giải hệ phương trình")])
+        state["selected_tool"] = "code"
+        state["tool_success"] = True
+        state["tool_result"] = "\\begin{cases} x = 1 \\\\ y = 2 \\end{cases}"
+        
+        with patch("backend.agent.nodes.get_model") as mock_get_model, \
+             patch("backend.agent.nodes.memory_tracker") as mock_memory:
+            mock_memory.check_status.return_value = MagicMock(status="ok", used_tokens=10, message=None)
+            result = await synthetic_agent_node(state)
+        
+        mock_get_model.assert_not_called()
+        assert result["current_agent"] == "done"
+        assert result["final_response"] == "$$\n\\begin{cases} x = 1 \\\\ y = 2 \\end{cases}\n$$"
+        print("✅ Test: Synthetic -> Final LaTeX Skips LLM")
+    
+    @pytest.mark.asyncio
+    async def test_multi_question_synthesis_is_streamed(self):
+        """Test: Multi-question synthesis reads the streamed completion and formats it."""
+        from backend.agent.nodes import synthetic_agent_node
+        
+        state = create_mock_state(messages=[HumanMessage(content="Giải 2 bài")])
+        state["question_results"] = [
+            {"id": 1, "content": "Bài 1", "result": "2x", "error": None},
+            {"id": 2, "content": "Bài 2", "result": "3x^2", "error": None}
+        ]
+        
+        with patch("backend.agent.nodes.get_model", return_value=streaming_llm("## Bài 1: $$2x$$ ## Bài 2: $$3x^2$$", chunk_size=5)), \
+             patch("backend.agent.nodes.memory_tracker") as mock_memory:
+            mock_memory.check_status.return_value = MagicMock(status="ok", used_tokens=10, message=None)
+            result = await synthetic_agent_node(state)
+        
+        assert result["final_response"] == "## Bài 1: \n$$\n2x\n$$\n ## Bài 2: \n$$\n3x^2\n$$"
+        print("✅ Test: Synthetic -> Streamed Synthesis")
+    
+    def test_short_history_passed_verbatim(self):
+        """Test: Histories within the window skip the summary entirely."""
+        from backend.agent import nodes
+        
+        messages = [HumanMessage(content="Đạo hàm x^2?")]
+        with patch("backend.agent.nodes.memory_tracker") as mock_memory:
+            assert nodes._synthesis_history(create_mock_state(messages=messages)) == messages
+        mock_memory.get_summary.assert_not_called()
+        print("✅ Test: Synthesis History -> Short History Verbatim")
+
+
+class TestStreamedContent:
+    """Tests for streaming LLM responses."""
+    
+    @pytest.mark.asyncio
+    async def test_stops_after_json_block(self):
+        """Test: Planner stream should stop reading once the JSON block closes."""
+        from backend.agent.nodes import _astream_content
+        
+        closed = []
+        async def astream(messages):
+            try:
+                for part in ["Kế hoạch:\n```js", 'on\n{"questions": []}\n`', "``", "\nGiải thích", " dài..."]:
+                    yield AIMessageChunk(content=part)
+            finally:
+                closed.append(True)
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = astream
+        text = await _astream_content(mock_llm, [], stop_after_json_block=True)
+        
+        assert text.endswith("```")
+        assert "Giải thích" not in text
+        assert closed, "Stream should be closed when reading stops early"
+        print("✅ Test: Streamed Content -> Stops After JSON Block")
+    
+    @pytest.mark.asyncio
+    async def test_fences_found_when_streamed_char_by_char(self):
+        """Test: Fences split at any point are found by the incremental scan."""
+        from backend.agent.nodes import _astream_content
+        
+        reply = "Kế hoạch `x` ``y``:\n```json\n{\"questions\": [\"`a`\"]}\n```\nGiải thích"
+        async def astream(messages):
+            for char in reply:
+                yield AIMessageChunk(content=char)
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = astream
+        text = await _astream_content(mock_llm, [], stop_after_json_block=True)
+        
+        assert text == reply[:reply.index("```\nGiải") + 3]
+        print("✅ Test: Streamed Content -> Char-by-Char Fences")
+
+
+class TestPlannerJsonRecovery:
+    """Tests for the single-pass planner JSON sanitizer."""
+    
+    def test_raw_latex_escapes_repaired(self):
+        """Test: Unescaped LaTeX inside strings should parse to the original text."""
+        from backend.agent.nodes import _recover_json
+        
+        latex = r"$\iint\limits_{D} \frac{x}{y} \, dxdy$"
+        plan = _recover_json('{"questions":[{"id":1,"type":"code","content":"' + latex + '"}]}')
+        
+        assert plan["questions"][0]["content"] == latex
+        print("✅ Test: JSON Recovery -> Raw LaTeX")
+    
+    def test_fenced_object_with_surrounding_text(self):
+        """Test: Fence and trailing text should be ignored, braces in strings respected."""
+        from backend.agent.nodes import _recover_json, _strip_code_fence
+        
+        raw = 'Kế hoạch:\n```json\n{"questions": [{"id": 1, "content": "f(x) = {x}"}]}\n```\nHết.'
+        plan = _recover_json(_strip_code_fence(raw))
+        
+        assert plan == {"questions": [{"id": 1, "content": "f(x) = {x}"}]}
+        print("✅ Test: JSON Recovery -> Fenced Object")
+    
+    def test_raw_newlines_in_strings_parse(self):
+        """Test: Raw newlines inside strings (rejected by orjson) still parse."""
+        from backend.agent.nodes import _recover_json
+        
+        plan = _recover_json('{"questions": [{"id": 1, "content": "Dòng 1\nDòng 2"}]}')
+        
+        assert plan["questions"][0]["content"] == "Dòng 1\nDòng 2"
+        print("✅ Test: JSON Recovery -> Raw Newlines")
+    
+    def test_text_and_truncated_json_return_none(self):
+        """Test: Plain text or an unbalanced object should not parse."""
+        from backend.agent.nodes import _recover_json
+        
+        assert _recover_json("Đáp án: x = 2") is None
+        assert _recover_json('{"questions": [{"id": 1, "content": "abc"') is None
+        print("✅ Test: JSON Recovery -> None for Text/Truncated")
+
+
+class TestOcrCache:
+    """Tests for content-addressed OCR memoization."""
+    
+    @pytest.mark.asyncio
+    async def test_same_image_is_not_re_ocred(self):
+        """Test: Re-entering OCR with the same image should reuse the cached text."""
+        from backend.agent import nodes
+        
+        calls = []
+        async def astream(messages):
+            calls.append(messages)
+            yield AIMessageChunk(content="x^2 + 1 = 0")
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = astream
+        
+        with patch.dict(nodes._OCR_CACHE, clear=True), \
+             patch("backend.agent.nodes.get_model", return_value=mock_llm):
+            first = await nodes.ocr_agent_node(create_mock_state(image_data_list=["aW1hZ2U="]))
+            second = await nodes.ocr_agent_node(create_mock_state(image_data_list=["aW1hZ2U="]))
+        
+        assert len(calls) == 1, "Second pass should hit the cache"
+        assert first["ocr_text"] == second["ocr_text"] == "x^2 + 1 = 0"
+        assert second["model_calls"] == [], "Cache hit should not be logged as a model call"
+        print("✅ Test: OCR Cache -> Same Image Skips Vision Model")
+    
+    @pytest.mark.asyncio
+    async def test_multi_image_aggregation(self):
+        """Test: Combined text, errors and metrics should come from one pass over results."""
+        from backend.agent import nodes
+        
+        async def ocr(messages):
+            image_url = messages[0].content[1]["image_url"]["url"]
+            if image_url.endswith("YmFk"):
+                raise Exception("vision down")
+            yield AIMessageChunk(content="y = 2x")
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = ocr
+        
+        with patch.dict(nodes._OCR_CACHE, clear=True), \
+             patch("backend.agent.nodes.get_model", return_value=mock_llm):
+            nodes._ocr_cache_put(nodes._ocr_cache_key("Y2FjaGVk"), "x = 1")
+            result = await nodes.ocr_agent_node(
+                create_mock_state(image_data_list=["Y2FjaGVk", "bmV3", "YmFk"])
+            )
+        
+        assert result["ocr_text"] == "[Ảnh 1]:\nx = 1\n\n[Ảnh 2]:\ny = 2x"
+        assert result["model_calls"][0].tokens_in == 500 * 2, "Cache hit should not be billed"
+        assert result["model_calls"][0].success is True
+        assert result.get("error_message") is None, "Partial failure should not set an error"
+        print("✅ Test: OCR Aggregation -> Multi Image")
+    
+    def test_cache_evicts_least_recently_used(self):
+        """Test: Cache should stay bounded and drop the oldest entry."""
+        from backend.agent import nodes
+        
+        with patch.dict(nodes._OCR_CACHE, clear=True), \
+             patch("backend.agent.nodes.OCR_CACHE_SIZE", 2):
+            nodes._ocr_cache_put("a", "A")
+            nodes._ocr_cache_put("b", "B")
+            nodes._ocr_cache_get("a")
+            nodes._ocr_cache_put("c", "C")
+            assert list(nodes._OCR_CACHE) == ["a", "c"]
+        print("✅ Test: OCR Cache -> LRU Eviction")
+
+
 class TestParallelExecutor:
     """Tests for parallel_executor_node."""
     
@@ -212,6 +538,373 @@ class TestParallelExecutor:
         assert result["question_results"][0]["result"] == "Đáp án sẵn có", "Should use pre-generated answer"
         print("✅ Test: Direct with Answer Field -> Uses Cached Answer")
 
+    @pytest.mark.asyncio
+    async def test_unanswered_direct_questions_are_batched(self):
+        """Test: Multiple unanswered direct questions should share one LLM request."""
+        from backend.agent.nodes import parallel_executor_node
+        
+        state = create_mock_state()
+        state["execution_plan"] = {
+            "questions": [
+                {"id": 1, "type": "direct", "content": "Câu 1"},
+                {"id": 2, "type": "direct", "content": "Câu 2"}
+            ]
+        }
+        
+        with patch("backend.agent.nodes.model_manager.ainvoke_batched", new_callable=AsyncMock) as mock_batched, \
+             patch("backend.agent.nodes.get_model") as mock_get_model:
+            mock_batched.return_value = ["Đáp án 1", "Đáp án 2"]
+            
+            result = await parallel_executor_node(state)
+        
+        mock_batched.assert_awaited_once()
+        mock_get_model.assert_not_called()
+        assert [r["result"] for r in result["question_results"]] == ["Đáp án 1", "Đáp án 2"]
+        print("✅ Test: Unanswered Direct Questions -> Single Batched Request")
+    
+    @pytest.mark.asyncio
+    async def test_cached_direct_answers_skip_llm(self):
+        """Test: Direct questions answered before should be served from cache."""
+        from backend.agent import nodes
+        
+        nodes.query_cache.set("Câu 1", "Đáp án 1", "direct")
+        nodes.query_cache.set("Câu 2", "Đáp án 2", "direct")
+        state = create_mock_state()
+        state["execution_plan"] = {
+            "questions": [
+                {"id": 1, "type": "direct", "content": "Câu 1"},
+                {"id": 2, "type": "direct", "content": "Câu 2"}
+            ]
+        }
+        
+        with patch("backend.agent.nodes.model_manager.ainvoke_batched", new_callable=AsyncMock) as mock_batched, \
+             patch("backend.agent.nodes.get_model") as mock_get_model:
+            result = await nodes.parallel_executor_node(state)
+        
+        mock_batched.assert_not_awaited()
+        mock_get_model.assert_not_called()
+        assert [r["result"] for r in result["question_results"]] == ["Đáp án 1", "Đáp án 2"]
+        print("✅ Test: Cached Direct Answers -> No LLM Call")
+
+
+class TestCodeExecution:
+    """Tests for code generation and non-blocking code execution."""
+    
+    @pytest.mark.asyncio
+    async def test_code_runs_without_blocking_loop(self):
+        """Test: The code subprocess is awaited, so other tasks keep running meanwhile."""
+        from backend.agent import nodes
+        
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(
+            content="```python\nimport time\ntime.sleep(0.3)\nprint(42)\n```"
+        ))
+        
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+        
+        ticker_task = asyncio.create_task(ticker())
+        try:
+            with patch("backend.agent.nodes.get_model", return_value=mock_llm):
+                out = await nodes._solve_with_code("Tính 6*7")
+        finally:
+            ticker_task.cancel()
+        
+        assert out["result"] == "42"
+        assert ticks >= 10, "Event loop was blocked while the code ran"
+        print("✅ Test: Code Execution -> Off Event Loop")
+    
+    @pytest.mark.asyncio
+    async def test_code_questions_share_one_codegen_call(self):
+        """Test: Several code questions should get their code from a single LLM request."""
+        from backend.agent import nodes
+        
+        reply = (
+            "### Bài 1\n```python\nprint(1)\n```\n"
+            "### Bài 2\n```python\nprint(2)\n```"
+        )
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=reply))
+        executed = []
+        async def fake_aexecute(code):
+            executed.append(code.strip())
+            return {"success": True, "output": code.strip()[6:-1]}
+        
+        questions = [
+            {"id": 1, "type": "code", "content": "Câu 1", "tool_input": "Tính 1"},
+            {"id": 2, "type": "code", "content": "Câu 2", "tool_input": "Tính 2"}
+        ]
+        groups = nodes.group_questions(questions)
+        assert len(groups) == 1
+        
+        with patch.object(nodes._CODE_TOOL, "aexecute", fake_aexecute), \
+             patch("backend.agent.nodes.get_model", return_value=mock_llm):
+            outputs = await nodes.execute_question_group(groups[0])
+        
+        assert mock_llm.ainvoke.call_count == 1
+        assert sorted(executed) == ["print(1)", "print(2)"]
+        assert [o["result"]["result"] for o in sorted(outputs, key=lambda o: o["index"])] == ["1", "2"]
+        print("✅ Test: Code Questions -> One Codegen Request")
+    
+    @pytest.mark.asyncio
+    async def test_repeated_code_task_uses_cache(self):
+        """Test: A task that already ran successfully is answered without codegen or execution."""
+        from backend.agent import nodes
+        
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content="```python\nprint(5)\n```"))
+        fake_aexecute = AsyncMock(return_value={"success": True, "output": "5"})
+        
+        with patch.object(nodes._CODE_TOOL, "aexecute", fake_aexecute), \
+             patch("backend.agent.nodes.get_model", return_value=mock_llm):
+            first = await nodes._solve_with_code("Tính 2+3")
+            second = await nodes._solve_with_code("Tính 2+3")
+        
+        assert first["result"] == second["result"] == "5"
+        assert mock_llm.ainvoke.call_count == 1
+        assert fake_aexecute.call_count == 1
+        print("✅ Test: Repeated Code Task -> Cached Output")
+    
+    @pytest.mark.asyncio
+    async def test_code_fixes_race_and_first_working_fix_wins(self):
+        """Test: Fix candidates run concurrently; a fast working fix doesn't wait for a slow one."""
+        from backend.agent import nodes
+        
+        codegen_llm = MagicMock()
+        codegen_llm.ainvoke = AsyncMock(return_value=MagicMock(content="```python\nbroken(\n```"))
+        
+        def fix_reply(delay, code):
+            async def ainvoke(messages):
+                await asyncio.sleep(delay)
+                return AIMessage(content=f"```python\n{code}\n```")
+            return MagicMock(ainvoke=ainvoke)
+        
+        fix_llm = MagicMock()
+        fix_llm.bind.side_effect = lambda temperature: (
+            fix_reply(5.0, "print(0)") if temperature == 0.0 else fix_reply(0.01, "print(1)")
+        )
+        
+        async def fake_aexecute(code):
+            if code == "print(1)":
+                return {"success": True, "output": "1"}
+            return {"success": False, "error": "SyntaxError"}
+        
+        state = create_mock_state()
+        state.update(_tool_query="Sửa lỗi rồi tính 1", code_attempts=0, codefix_attempts=0)
+        models = {"qwen3-32b": codegen_llm, "gpt-oss-120b": fix_llm}
+        with patch.object(nodes._CODE_TOOL, "aexecute", fake_aexecute), \
+             patch("backend.agent.nodes.get_model", side_effect=models.get):
+            state = await asyncio.wait_for(nodes.code_tool_node(state), timeout=2.0)
+        
+        assert state["tool_success"] is True
+        assert state["tool_result"] == "1"
+        assert state["codefix_attempts"] == 1
+        print("✅ Test: Code Fix -> Concurrent Candidates")
+    
+    @pytest.mark.asyncio
+    async def test_code_fix_runs_single_candidate_when_rate_limited(self):
+        """Test: Without budget for the whole race, a fix round sends one reserved request."""
+        from backend.agent import nodes
+        from backend.agent.models import ModelManager
+        
+        codegen_llm = MagicMock()
+        codegen_llm.ainvoke = AsyncMock(return_value=AIMessage(content="```python\nbroken(\n```"))
+        fix_candidates = {t: MagicMock(ainvoke=AsyncMock(return_value=AIMessage(content="```python\nprint(1)\n```")))
+                          for t in nodes.CODEFIX_TEMPERATURES}
+        fix_llm = MagicMock()
+        fix_llm.bind.side_effect = lambda temperature: fix_candidates[temperature]
+        
+        async def fake_aexecute(code):
+            if code == "print(1)":
+                return {"success": True, "output": "1"}
+            return {"success": False, "error": "SyntaxError"}
+        
+        # Earlier usage left budget for one fix request, not for the race
+        manager = ModelManager()
+        fix_tokens = nodes.estimate_message_tokens([HumanMessage(content=nodes.build_codegen_fix_prompt(
+            code="broken(", error="SyntaxError"))])
+        manager._get_tracker("gpt-oss-120b").token_bucket = 1.5 * fix_tokens
+        
+        state = create_mock_state()
+        state.update(_tool_query="Sửa lỗi rồi tính 1", code_attempts=0, codefix_attempts=0)
+        models = {"qwen3-32b": codegen_llm, "gpt-oss-120b": fix_llm}
+        with patch.object(nodes._CODE_TOOL, "aexecute", fake_aexecute), \
+             patch("backend.agent.nodes.get_model", side_effect=models.get), \
+             patch.object(nodes, "model_manager", manager):
+            state = await nodes.code_tool_node(state)
+        
+        assert state["tool_result"] == "1"
+        assert [c.ainvoke.call_count for c in fix_candidates.values()] == [1, 0]
+        assert manager._get_tracker("gpt-oss-120b").curr_day_requests == 1, "The fix request is reserved"
+        fix_calls = [c for c in state["model_calls"] if c.agent == "codefix_agent"]
+        assert [c.success for c in fix_calls] == [True], "No rate-limited second candidate is launched"
+        print("✅ Test: Code Fix -> Single Candidate Under Rate Limit")
+    
+    def test_extract_code_prefers_python_fence(self):
+        """Test: A ```python block wins over earlier fences; unclosed fences run to the end."""
+        from backend.agent.nodes import _extract_code
+        
+        assert _extract_code("```text\nhi\n```\n```python\nprint(1)\n```") == "print(1)"
+        assert _extract_code("Code:\n```\nprint(2)\n```") == "print(2)"
+        assert _extract_code("```python\nprint(3)") == "print(3)"
+        assert _extract_code("  print(4)  ") == "print(4)"
+        print("✅ Test: Code Extraction -> Fenced Block")
+
+
+class TestExecutorFanOut:
+    """Tests for Send-based fan-out of executor work units."""
+    
+    def test_dispatch_sends_one_worker_per_unit(self):
+        """Test: Tool questions get their own worker, unanswered directs share one."""
+        from backend.agent.nodes import dispatch_questions
+        
+        state = create_mock_state()
+        state["current_agent"] = "executor"
+        state["execution_plan"] = {
+            "questions": [
+                {"id": 1, "type": "wolfram", "content": "Câu 1"},
+                {"id": 2, "type": "direct", "content": "Câu 2"},
+                {"id": 3, "type": "code", "content": "Câu 3"},
+                {"id": 4, "type": "direct", "content": "Câu 4"}
+            ]
+        }
+        
+        sends = dispatch_questions(state)
+        
+        assert all(s.node == "question_worker" for s in sends)
+        assert [[item["index"] for item in s.arg["questions"]] for s in sends] == [[0], [2], [1, 3]]
+        print("✅ Test: dispatch_questions -> Send per work unit")
+    
+    def test_dispatch_passes_through_other_routes(self):
+        """Test: Non-executor routes are returned unchanged."""
+        from backend.agent.nodes import dispatch_questions
+        
+        assert dispatch_questions({"current_agent": "done"}) == "done"
+        print("✅ Test: dispatch_questions('done') -> 'done'")
+    
+    @pytest.mark.asyncio
+    async def test_graph_collects_worker_results_in_plan_order(self):
+        """Test: Workers run through the graph and the executor collects them in order."""
+        from backend.agent.graph import build_graph
+        
+        async def fake_planner(state):
+            state["execution_plan"] = {
+                "questions": [
+                    {"id": 1, "type": "code", "content": "Câu 1", "tool_input": "slow"},
+                    {"id": 2, "type": "code", "content": "Câu 2", "tool_input": "fast"}
+                ]
+            }
+            state["current_agent"] = "executor"
+            return state
+        
+        async def fake_synthetic(state):
+            state["current_agent"] = "done"
+            return state
+        
+        async def fake_solve(task, retries=3, code=None):
+            await asyncio.sleep(0.05 if task == "slow" else 0)
+            return {"result": f"kết quả {task}", "error": None}
+        
+        with patch("backend.agent.graph.planner_node", fake_planner), \
+             patch("backend.agent.graph.synthetic_agent_node", fake_synthetic), \
+             patch("backend.agent.nodes._generate_code_batched", AsyncMock(return_value=[None, None])), \
+             patch("backend.agent.nodes._solve_with_code", fake_solve):
+            graph = build_graph()
+            seen = []
+            
+            async def on_question_result(output):
+                seen.append(output["result"]["id"])
+            
+            config = {"configurable": {"on_question_result": on_question_result}}
+            result = await graph.ainvoke(create_mock_state(), config=config)
+        
+        assert [r["result"] for r in result["question_results"]] == ["kết quả slow", "kết quả fast"]
+        assert seen == [2, 1], "Each question is reported as it finishes"
+        assert "parallel_executor" in result["agents_used"]
+        print("✅ Test: Graph fan-out -> Results collected in plan order")
+    
+    @pytest.mark.asyncio
+    async def test_group_reports_results_as_they_finish(self):
+        """Test: on_result fires in completion order, not plan order."""
+        from backend.agent import nodes
+        
+        async def fake_solve(task, retries=3, code=None):
+            await asyncio.sleep(0.05 if task == "slow" else 0)
+            return {"result": task, "error": None}
+        
+        group = [
+            {"index": 0, "question": {"id": 1, "type": "code", "content": "Câu 1", "tool_input": "slow"}},
+            {"index": 1, "question": {"id": 2, "type": "code", "content": "Câu 2", "tool_input": "fast"}}
+        ]
+        seen = []
+        
+        async def on_result(output):
+            seen.append(output["index"])
+        
+        with patch("backend.agent.nodes._generate_code_batched", AsyncMock(return_value=[None, None])), \
+             patch("backend.agent.nodes._solve_with_code", fake_solve):
+            outputs = await nodes.execute_question_group(group, on_result=on_result)
+        
+        assert seen == [1, 0]
+        assert [o["index"] for o in outputs] == [1, 0]
+        print("✅ Test: Question Group -> Results Reported As Completed")
+
+
+class TestGraphStateUpdates:
+    """Tests for the state updates graph nodes hand back to LangGraph."""
+    
+    @pytest.mark.asyncio
+    async def test_nodes_return_only_reducer_deltas(self):
+        """Test: Wrapped nodes send only new messages and omit untouched reducer channels."""
+        from langchain_core.messages import AIMessage
+        from backend.agent.graph import _returns_delta
+        
+        async def node(state):
+            state["messages"].append(AIMessage(content="done"))
+            state["current_agent"] = "done"
+            return state
+        
+        state = create_mock_state()
+        state["_question_outputs"] = []
+        update = await _returns_delta(node)(state)
+        
+        assert [m.content for m in update["messages"]] == ["done"]
+        assert "_question_outputs" not in update
+        assert update["current_agent"] == "done"
+        print("✅ Test: Node Update -> Reducer Deltas Only")
+
+
+class TestWolframRetry:
+    """Tests for wolfram_tool_node retries and code fallback."""
+    
+    @pytest.mark.asyncio
+    async def test_retries_with_backoff_then_falls_back_to_code(self):
+        """Test: A failing query is retried with growing delays, then handed to the code tool."""
+        from backend.agent.nodes import wolfram_tool_node
+        
+        state = create_mock_state()
+        state["_tool_query"] = "integrate x^2"
+        delays = []
+        async def fake_sleep(delay):
+            delays.append(delay)
+        
+        with patch("backend.agent.nodes.query_wolfram_alpha", AsyncMock(return_value=(False, "timeout"))), \
+             patch("backend.agent.nodes.asyncio.sleep", fake_sleep):
+            routes = []
+            for _ in range(3):
+                state = await wolfram_tool_node(state)
+                routes.append(state["current_agent"])
+        
+        assert routes == ["wolfram", "wolfram", "code"]
+        assert state["selected_tool"] == "code"
+        assert len(delays) == 2
+        assert 0.5 <= delays[0] <= 0.7 and 1.0 <= delays[1] <= 1.2
+        print("✅ Test: Wolfram Failure -> Backoff Retries -> Code")
+
 
 class TestRouteAgent:
     """Tests for route_agent function."""
@@ -244,16 +937,80 @@ if __name__ == "__main__":
     print("=" * 60)
     
     async def run_all():
-        # Planner tests
+        import tempfile
+        from backend.agent import nodes
+        from backend.utils.rate_limit import QueryCache
+        nodes.query_cache = QueryCache(tempfile.mkdtemp())
+        
+        # Planner tests (fresh response cache per test, like the pytest fixture)
         planner_tests = TestPlannerNode()
-        await planner_tests.test_all_direct_returns_text()
-        await planner_tests.test_mixed_questions_returns_json()
-        await planner_tests.test_memory_overflow_blocks_execution()
-        await planner_tests.test_json_repair_latex_backslashes()
+        for test in (
+            planner_tests.test_all_direct_returns_text,
+            planner_tests.test_mixed_questions_returns_json,
+            planner_tests.test_repeated_first_turn_uses_cache,
+            planner_tests.test_short_history_skips_truncation,
+            planner_tests.test_memory_overflow_blocks_execution,
+            planner_tests.test_json_repair_latex_backslashes,
+        ):
+            nodes.query_cache.clear()
+            await test()
+        
+        # Memory tracking tests
+        TestMemoryTracking().test_track_memory_updates_state()
+        
+        # Synthetic agent tests
+        history_tests = TestSyntheticAgent()
+        await history_tests.test_long_history_uses_summary_and_refreshes()
+        await history_tests.test_final_latex_code_result_skips_llm()
+        await history_tests.test_multi_question_synthesis_is_streamed()
+        history_tests.test_short_history_passed_verbatim()
+        
+        # Streaming tests
+        await TestStreamedContent().test_stops_after_json_block()
+        await TestStreamedContent().test_fences_found_when_streamed_char_by_char()
+        
+        # JSON recovery tests
+        recovery_tests = TestPlannerJsonRecovery()
+        recovery_tests.test_raw_latex_escapes_repaired()
+        recovery_tests.test_fenced_object_with_surrounding_text()
+        recovery_tests.test_raw_newlines_in_strings_parse()
+        recovery_tests.test_text_and_truncated_json_return_none()
+        
+        # OCR cache tests
+        ocr_tests = TestOcrCache()
+        await ocr_tests.test_same_image_is_not_re_ocred()
+        await ocr_tests.test_multi_image_aggregation()
+        ocr_tests.test_cache_evicts_least_recently_used()
         
         # Executor tests
         executor_tests = TestParallelExecutor()
         await executor_tests.test_direct_uses_answer_field()
+        nodes.query_cache.clear()
+        await executor_tests.test_unanswered_direct_questions_are_batched()
+        nodes.query_cache.clear()
+        await executor_tests.test_cached_direct_answers_skip_llm()
+        
+        # Code execution tests
+        code_tests = TestCodeExecution()
+        await code_tests.test_code_runs_without_blocking_loop()
+        await code_tests.test_code_questions_share_one_codegen_call()
+        await code_tests.test_repeated_code_task_uses_cache()
+        await code_tests.test_code_fixes_race_and_first_working_fix_wins()
+        await code_tests.test_code_fix_runs_single_candidate_when_rate_limited()
+        code_tests.test_extract_code_prefers_python_fence()
+        
+        # Fan-out tests
+        fan_out_tests = TestExecutorFanOut()
+        fan_out_tests.test_dispatch_sends_one_worker_per_unit()
+        fan_out_tests.test_dispatch_passes_through_other_routes()
+        await fan_out_tests.test_graph_collects_worker_results_in_plan_order()
+        await fan_out_tests.test_group_reports_results_as_they_finish()
+        
+        # Graph state update tests
+        await TestGraphStateUpdates().test_nodes_return_only_reducer_deltas()
+        
+        # Wolfram retry tests
+        await TestWolframRetry().test_retries_with_backoff_then_falls_back_to_code()
         
         # Route tests
         route_tests = TestRouteAgent()
@@ -2,11 +2,18 @@
 Code execution tool with sandbox isolation.
 Provides CodeTool class for safe Python code execution.
 """
+import ast
+import asyncio
+import builtins
+import contextlib
+import io
 import subprocess
 import sys
 import tempfile
 import os
-from typing import Dict, Any
+from functools import lru_cache
+from types import CodeType
+from typing import Dict, Any, Tuple
 
 
 class CodeTool:
@@ -43,25 +50,58 @@ class CodeTool:
                 env={**os.environ, "PYTHONPATH": ""}
             )
             
-            if result.returncode == 0:
-                return {
-                    "success": True,
-                    "output": result.stdout.strip(),
-                    "error": None
-                }
-            else:
-                return {
-                    "success": False,
-                    "output": result.stdout.strip() if result.stdout else None,
-                    "error": result.stderr.strip() if result.stderr else "Unknown error"
-                }
+            return self._result(result.returncode, result.stdout, result.stderr)
                 
         except subprocess.TimeoutExpired:
+            return self._timeout_result()
+        except Exception as e:
             return {
                 "success": False,
                 "output": None,
-                "error": f"Code execution timed out after {self.timeout} seconds"
+                "error": str(e)
             }
+        finally:
+            # Cleanup
+            try:
+                os.unlink(temp_path)
+            except:
+                pass
+    
+    async def aexecute(self, code: str) -> Dict[str, Any]:
+        """
+        Execute Python code in isolated subprocess without blocking the event loop.
+        The subprocess is awaited directly, so no worker thread is held while it runs.
+        
+        Args:
+            code: Python code to execute
+            
+        Returns:
+            Dict with keys: success, output, error
+        """
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as f:
+            f.write(code)
+            temp_path = f.name
+        
+        proc = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, temp_path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=tempfile.gettempdir(),
+                env={**os.environ, "PYTHONPATH": ""}
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                return self._timeout_result()
+            return self._result(
+                proc.returncode,
+                stdout.decode(errors="replace"),
+                stderr.decode(errors="replace")
+            )
         except Exception as e:
             return {
                 "success": False,
@@ -69,18 +109,206 @@ class CodeTool:
                 "error": str(e)
             }
         finally:
-            # Cleanup
+            # Cancelled: don't leave the process running
+            if proc is not None and proc.returncode is None:
+                proc.kill()
             try:
                 os.unlink(temp_path)
             except:
                 pass
+    
+    def _result(self, returncode: int, stdout: str, stderr: str) -> Dict[str, Any]:
+        """Build the result dict from a finished process."""
+        if returncode == 0:
+            return {
+                "success": True,
+                "output": stdout.strip(),
+                "error": None
+            }
+        return {
+            "success": False,
+            "output": stdout.strip() if stdout else None,
+            "error": stderr.strip() if stderr else "Unknown error"
+        }
+    
+    def _timeout_result(self) -> Dict[str, Any]:
+        return {
+            "success": False,
+            "output": None,
+            "error": timeout_message(self.timeout)
+        }
+
+
+# Builtins left to in-process snippets: no open/__import__/eval/exec/getattr
+_SAFE_BUILTINS = (
+    "abs", "all", "any", "bool", "complex", "dict", "divmod", "enumerate",
+    "filter", "float", "frozenset", "int", "isinstance", "len", "list", "map",
+    "max", "min", "pow", "print", "range", "repr", "reversed", "round", "set",
+    "sorted", "str", "sum", "tuple", "zip", "__build_class__",
+    "Exception", "ArithmeticError", "ValueError", "TypeError", "ZeroDivisionError",
+)
+
+# SymPy names pre-loaded for snippets. Explicit on purpose: sympify, S,
+# parse_expr, lambdify and friends evaluate strings with the real builtins
+_SYMPY_NAMES = (
+    # Symbols and numbers
+    "Symbol", "symbols", "Function", "Integer", "Rational", "Float",
+    "pi", "E", "I", "oo", "zoo", "nan",
+    # Elementary functions
+    "sqrt", "root", "cbrt", "exp", "log", "ln", "Abs", "sign", "floor", "ceiling",
+    "sin", "cos", "tan", "cot", "sec", "csc", "asin", "acos", "atan", "atan2", "acot",
+    "sinh", "cosh", "tanh", "asinh", "acosh", "atanh",
+    "factorial", "binomial", "gamma", "re", "im", "conjugate", "arg", "Piecewise",
+    # Algebra
+    "simplify", "expand", "factor", "collect", "cancel", "apart", "together",
+    "trigsimp", "expand_trig", "powsimp", "radsimp", "nsimplify", "N",
+    "Poly", "roots", "real_roots", "degree", "div", "gcd", "lcm", "factorint",
+    "isprime", "primefactors", "divisors", "Min", "Max",
+    # Equations and inequalities
+    "Eq", "Ne", "Lt", "Le", "Gt", "Ge", "solve", "solveset", "linsolve", "nonlinsolve",
+    "nsolve", "dsolve", "reduce_inequalities", "Interval", "Union", "FiniteSet",
+    # Calculus
+    "diff", "Derivative", "integrate", "Integral", "limit", "Limit", "series",
+    "summation", "Sum", "product", "Product",
+    # Linear algebra
+    "Matrix", "eye", "zeros", "ones", "diag",
+    # Output
+    "latex", "pretty",
+)
+
+
+class _StripImports(ast.NodeTransformer):
+    """
+    Turn import statements (at any depth) into `pass`: the SymPy names are pre-loaded.
+    Dunder names/attributes are rejected: they are the way out of a restricted namespace.
+    """
+    
+    def visit_Import(self, node: ast.AST) -> ast.AST:
+        return ast.copy_location(ast.Pass(), node)
+    
+    visit_ImportFrom = visit_Import
+    
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id.startswith("__"):
+            raise SyntaxError(f"name '{node.id}' is not allowed")
+        return node
+    
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        if node.attr.startswith("__"):
+            raise SyntaxError(f"attribute '{node.attr}' is not allowed")
+        return self.generic_visit(node)
+
+
+@lru_cache(maxsize=1)
+def _sandbox_globals() -> Dict[str, Any]:
+    """
+    Template namespace for in-process snippets, built on first use: importing
+    SymPy/NumPy is the expensive part, so it happens once and each run gets a copy.
+    """
+    import sympy
+    namespace = {name: getattr(sympy, name) for name in _SYMPY_NAMES}
+    try:
+        import numpy
+        namespace["np"] = numpy  # Vectorised numerics, as in generated code
+    except ImportError:
+        pass
+    namespace["__builtins__"] = {name: getattr(builtins, name) for name in _SAFE_BUILTINS}
+    namespace["__name__"] = "__sandbox__"
+    return namespace
+
+
+def _fresh_globals() -> Dict[str, Any]:
+    """Per-run copy of the template; builtins too, so a run can't rebind them for the next."""
+    namespace = dict(_sandbox_globals())
+    namespace["__builtins__"] = dict(namespace["__builtins__"])
+    return namespace
+
+
+# Left out of strings SymPy parses on a snippet's behalf: they compile code or shell out
+_PARSER_EXCLUDED = frozenset({"lambdify", "preview", "init_session", "init_printing"})
+
+
+@lru_cache(maxsize=1)
+def _parser_globals() -> Dict[str, Any]:
+    """Globals for string parsing during a run: SymPy names, and no builtins at all."""
+    import sympy
+    namespace = {name: getattr(sympy, name) for name in sympy.__all__ if name not in _PARSER_EXCLUDED}
+    namespace.update(max=sympy.Max, min=sympy.Min, __builtins__={})
+    return namespace
+
+
+@contextlib.contextmanager
+def _guarded_string_parsing():
+    """
+    Route SymPy's string parser through a namespace without builtins while a
+    snippet runs. Matrix, solve, subs, ... sympify string arguments, and the
+    stock parser evals them with the real builtins (SymPy also parses its own
+    internal strings, so parsing can't simply be turned off).
+    """
+    from sympy.parsing import sympy_parser
+    parse_expr = sympy_parser.parse_expr
+    
+    def guarded(s, local_dict=None, transformations=sympy_parser.standard_transformations,
+                global_dict=None, evaluate=True):
+        if "__" in s:
+            raise ValueError("dunder names are not allowed in parsed strings")
+        if global_dict is None:
+            global_dict = dict(_parser_globals())
+        return parse_expr(s, local_dict, transformations, global_dict, evaluate)
+    
+    sympy_parser.parse_expr = guarded
+    try:
+        yield
+    finally:
+        sympy_parser.parse_expr = parse_expr
+
+
+@lru_cache(maxsize=256)
+def _compile_snippet(code: str) -> CodeType:
+    """Parse, strip imports and compile the tree (cached: identical snippets skip the parser)."""
+    tree = _StripImports().visit(ast.parse(code, "<sandbox>"))
+    return compile(tree, "<sandbox>", "exec")
+
+
+def timeout_message(timeout: float) -> str:
+    """Error text for a run that exceeded its timeout."""
+    return f"Code execution timed out after {timeout} seconds"
+
+
+def run_snippet(code: str) -> Tuple[bool, str]:
+    """
+    Execute a trusted SymPy snippet in the current process.
+    An allowlist of SymPy names and NumPy (as `np`) are pre-loaded, imports are stripped,
+    dunder access is refused, strings SymPy parses get no builtins and only safe builtins
+    are available.
+    Each run starts from a fresh namespace.
+    """
+    try:
+        compiled = _compile_snippet(code)
+    except SyntaxError as e:
+        return False, f"SyntaxError: {e}"
+    
+    stdout = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout), _guarded_string_parsing():
+            exec(compiled, _fresh_globals())
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+    return True, stdout.getvalue().strip()
 
 
 # Legacy function for backwards compatibility
-def execute_python_code(code: str, timeout: int = 30) -> Dict[str, Any]:
-    """Execute Python code (legacy wrapper)."""
-    tool = CodeTool(timeout=timeout)
-    return tool.execute(code)
+def execute_python_code(code: str, timeout: int = 30) -> Tuple[bool, str]:
+    """
+    Execute a trusted SymPy snippet (legacy helper) via `run_snippet` in a process
+    forked from the warm worker, which enforces `timeout` and a memory cap.
+    Generated code goes through CodeTool's subprocess instead.
+    
+    Returns:
+        Tuple of (success, printed output or error message)
+    """
+    from backend.tools.sandbox_worker import sandbox_worker
+    return sandbox_worker.run(code, timeout)
 
 
 async def execute_with_correction(
@@ -106,7 +334,7 @@ async def execute_with_correction(
     attempts = 0
     
     while attempts <= max_corrections:
-        result = tool.execute(current_code)
+        result = await tool.aexecute(current_code)
         
         if result["success"]:
             return True, result["output"], attempts
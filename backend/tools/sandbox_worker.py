@@ -0,0 +1,169 @@
+"""
+Persistent worker process for snippet execution.
+The worker is started once (on first use) with resource limits applied and keeps
+SymPy loaded; every run is forked from it, so nothing a snippet does (names,
+builtins, patched SymPy objects) carries over to the next run. This limits
+resources and state, not access: there is no filesystem or network isolation,
+so snippets must still come from trusted code.
+"""
+import multiprocessing
+import os
+import pickle
+import resource
+import select
+import signal
+import threading
+import time
+from typing import Optional, Tuple
+
+
+# Address space cap for the worker (SymPy itself needs a few hundred MB)
+MEMORY_LIMIT_BYTES = 2 * 1024 ** 3
+# Extra time the parent waits past the worker's own deadline before killing it
+KILL_GRACE_SECONDS = 2.0
+
+_PR_SET_NO_NEW_PRIVS = 38
+
+
+def _apply_limits() -> None:
+    """Cap the worker's memory and forbid privilege gains (best effort)."""
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_BYTES, MEMORY_LIMIT_BYTES))
+    except (ValueError, OSError):
+        pass
+    try:
+        import ctypes
+        ctypes.CDLL(None, use_errno=True).prctl(_PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _run_child(code: str, write_fd: int) -> None:
+    """Forked child: run the snippet, pickle the result to the pipe and exit."""
+    from backend.tools.code_executor import run_snippet
+    try:
+        try:
+            resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))  # No file writes
+        except (ValueError, OSError):
+            pass
+        try:
+            result = run_snippet(code)
+        except MemoryError:
+            result = (False, "MemoryError: sandbox memory limit exceeded")
+        with os.fdopen(write_fd, "wb") as pipe:
+            pipe.write(pickle.dumps(result))
+    finally:
+        os._exit(0)
+
+
+def _run_forked(code: str, timeout: float) -> Tuple[bool, str]:
+    """Run `code` in a child forked from the warm worker; kill it after `timeout`."""
+    from backend.tools.code_executor import timeout_message
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        _run_child(code, write_fd)
+    os.close(write_fd)
+
+    chunks = []
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([read_fd], [], [], remaining)[0]:
+                os.kill(pid, signal.SIGKILL)
+                return False, timeout_message(timeout)
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    if not chunks:
+        return False, "Snippet process exited without a result"
+    return pickle.loads(b"".join(chunks))
+
+
+def _serve(conn) -> None:
+    """Worker loop: receive (code, timeout), reply (success, output)."""
+    _apply_limits()
+    from backend.tools.code_executor import _parser_globals, _sandbox_globals
+    # Import SymPy once here; forked runs inherit it
+    _sandbox_globals()
+    _parser_globals()
+    conn.send("ready")
+
+    while True:
+        try:
+            code, timeout = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        conn.send(_run_forked(code, timeout))
+
+
+class SandboxWorker:
+    """
+    Parent-side handle to the worker process.
+    Runs are serialized; the worker kills a run that outlives its timeout, and
+    if the worker itself stops answering (timeout plus grace) it is killed and
+    the next run starts a fresh one.
+    """
+
+    def __init__(self):
+        # spawn: forking a process with running threads/event loops is unsafe
+        self._ctx = multiprocessing.get_context("spawn")
+        self._process: Optional[multiprocessing.Process] = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(target=_serve, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self._conn.recv()  # Worker has SymPy loaded
+
+    def _stop(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def _ensure_started(self) -> None:
+        if self._process is None or not self._process.is_alive():
+            self._stop()
+            self._start()
+
+    def start(self) -> None:
+        """Start the worker now (it is otherwise started by the first run)."""
+        with self._lock:
+            self._ensure_started()
+
+    def close(self) -> None:
+        """Stop the worker; a later run starts a new one."""
+        with self._lock:
+            self._stop()
+
+    def run(self, code: str, timeout: float) -> Tuple[bool, str]:
+        """Execute `code` in the worker and return (success, output or error)."""
+        from backend.tools.code_executor import timeout_message
+        with self._lock:
+            try:
+                self._ensure_started()
+                self._conn.send((code, timeout))
+                if self._conn.poll(timeout + KILL_GRACE_SECONDS):
+                    return self._conn.recv()
+            except (EOFError, OSError):
+                self._stop()
+                return False, "Sandbox worker exited unexpectedly"
+            self._stop()
+            return False, timeout_message(timeout)
+
+
+sandbox_worker = SandboxWorker()
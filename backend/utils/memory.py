@@ -4,10 +4,23 @@ Tracks token usage per session and enforces context length limits.
 """
 import os
 import time
+import hashlib
+from collections import OrderedDict
 from typing import Literal, Tuple, Optional
 from dataclasses import dataclass
 import diskcache
 
+# Optional BPE tokenizer: much closer to real counts than the chars/4 heuristic.
+# cl100k_base is not the Groq models' own vocabulary, but tracks it far better.
+# Loaded on first use: get_encoding may download the encoding data.
+_UNLOADED = object()
+_ENCODER = _UNLOADED
+
+# Token counts memoized by text digest, so cached entries don't keep
+# conversation text alive
+TOKEN_COUNT_CACHE_SIZE = 4096
+_TOKEN_COUNTS: "OrderedDict[bytes, int]" = OrderedDict()
+
 # Context length for kimi-k2-instruct-0905
 KIMI_K2_CONTEXT_LENGTH = 262144  # 256K tokens
 
@@ -31,32 +44,66 @@ class MemoryStatus:
     message: Optional[str] = None
 
 
+def _get_encoder():
+    """Load the BPE encoder on first call (None if tiktoken or its data is unavailable)."""
+    global _ENCODER
+    if _ENCODER is _UNLOADED:
+        try:
+            import tiktoken
+            _ENCODER = tiktoken.get_encoding("cl100k_base")
+        except Exception:  # Not installed, or encoding data unavailable offline
+            _ENCODER = None
+    return _ENCODER
+
+
+def _count_tokens(encoder, text: str) -> int:
+    """BPE token count, memoized (LRU) by a digest of the text."""
+    key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    count = _TOKEN_COUNTS.get(key)
+    if count is None:
+        count = _TOKEN_COUNTS[key] = len(encoder.encode(text))
+        while len(_TOKEN_COUNTS) > TOKEN_COUNT_CACHE_SIZE:
+            _TOKEN_COUNTS.popitem(last=False)
+    else:
+        _TOKEN_COUNTS.move_to_end(key)
+    return count
+
+
 def estimate_tokens(text: str) -> int:
     """
     Estimate number of tokens from text.
-    Uses simple heuristic: ~4 characters per token for mixed Vietnamese/English.
+    Uses the BPE encoder when available (memoized per text, so history
+    re-counted every turn is only tokenized once); otherwise a simple
+    heuristic: ~4 characters per token for mixed Vietnamese/English.
     """
     if not text:
         return 0
-    return len(text) // 4
+    encoder = _get_encoder()
+    if encoder is None:
+        return len(text) // 4
+    return _count_tokens(encoder, text)
+
+
+def _message_tokens(msg) -> int:
+    """Estimate tokens for one LangChain message (None if it has no usable content)."""
+    content = getattr(msg, 'content', None)
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if isinstance(content, list):
+        # For multimodal messages (text + image)
+        total = 0
+        for item in content:
+            if isinstance(item, dict) and item.get("type") == "text":
+                total += estimate_tokens(item.get("text", ""))
+            elif isinstance(item, dict) and item.get("type") == "image_url":
+                total += 500  # Estimate for image tokens
+        return total
+    return None
 
 
 def estimate_message_tokens(messages: list) -> int:
     """Estimate total tokens from a list of LangChain messages."""
-    total = 0
-    for msg in messages:
-        if hasattr(msg, 'content'):
-            content = msg.content
-            if isinstance(content, str):
-                total += estimate_tokens(content)
-            elif isinstance(content, list):
-                # For multimodal messages (text + image)
-                for item in content:
-                    if isinstance(item, dict) and item.get("type") == "text":
-                        total += estimate_tokens(item.get("text", ""))
-                    elif isinstance(item, dict) and item.get("type") == "image_url":
-                        total += 500  # Estimate for image tokens
-    return total
+    return sum(_message_tokens(msg) or 0 for msg in messages)
 
 
 def truncate_history_to_fit(
@@ -64,7 +111,8 @@ def truncate_history_to_fit(
     system_tokens: int = 2000,
     current_tokens: int = 500,
     max_context_tokens: int = 200000,  # Leave room within 256K limit
-    reserve_for_response: int = 4096
+    reserve_for_response: int = 4096,
+    end: Optional[int] = None
 ) -> list:
     """
     Truncate conversation history to fit within token limits.
@@ -76,6 +124,7 @@ def truncate_history_to_fit(
         current_tokens: Estimated tokens for current user request
         max_context_tokens: Maximum tokens available for context
         reserve_for_response: Tokens reserved for LLM response
+        end: Only consider messages[:end] (avoids copying the history to slice it)
         
     Returns:
         Truncated list of messages that fits within limits
@@ -93,27 +142,20 @@ def truncate_history_to_fit(
     total = 0
     
     # Process from most recent to oldest (reversed iteration)
-    for msg in reversed(messages):
-        if hasattr(msg, 'content'):
-            content = msg.content
-            if isinstance(content, str):
-                msg_tokens = estimate_tokens(content)
-            elif isinstance(content, list):
-                msg_tokens = sum(
-                    estimate_tokens(item.get("text", "")) if item.get("type") == "text" else 500
-                    for item in content if isinstance(item, dict)
-                )
-            else:
-                msg_tokens = 100  # Fallback estimate
-        else:
-            msg_tokens = 100
+    end = len(messages) if end is None else min(end, len(messages))
+    for i in range(end - 1, -1, -1):
+        msg = messages[i]
+        msg_tokens = _message_tokens(msg)
+        if msg_tokens is None:
+            msg_tokens = 100  # Fallback estimate
         
         if total + msg_tokens <= available_tokens:
-            truncated.insert(0, msg)  # Insert at beginning to maintain order
+            truncated.append(msg)
             total += msg_tokens
         else:
             break  # No more room
     
+    truncated.reverse()  # Restore chronological order
     return truncated
 
 
@@ -184,6 +226,19 @@ class SessionMemoryTracker:
         """Reset token usage for a session (when session is deleted)."""
         key = self._get_key(session_id)
         self.cache.delete(key)
+        self.cache.delete(self._get_summary_key(session_id))
+    
+    def _get_summary_key(self, session_id: str) -> str:
+        """Generate cache key for a session's history summary."""
+        return f"session_summary:{session_id}"
+    
+    def get_summary(self, session_id: str) -> Tuple[Optional[str], int]:
+        """Get (summary, number of leading messages it covers) for a session."""
+        return self.cache.get(self._get_summary_key(session_id), (None, 0))
+    
+    def set_summary(self, session_id: str, summary: str, covered: int):
+        """Store the summary of the first `covered` messages of a session."""
+        self.cache.set(self._get_summary_key(session_id), (summary, covered))
     
     def check_status(self, session_id: str, additional_tokens: int = 0) -> MemoryStatus:
         """
@@ -164,8 +164,12 @@ class QueryCache:
         self.ttl = 3600 * 24 * 7  # 7 days TTL for math queries
     
     def _make_key(self, query: str, context: str = "") -> str:
-        """Create cache key from query and context."""
-        content = f"{query}:{context}"
+        """
+        Create cache key from query and context.
+        Whitespace is normalized so near-verbatim repeats share a key; case is
+        kept, since it is significant in math input (E vs e, matrix A vs a).
+        """
+        content = f"{' '.join(query.split())}:{context}"
         return hashlib.sha256(content.encode()).hexdigest()
     
     def get(self, query: str, context: str = "") -> Optional[str]:
@@ -4,7 +4,7 @@ Provides full tracking of all agent and tool calls.
 """
 import os
 from typing import Optional
-from functools import wraps
+from functools import wraps, lru_cache
 import asyncio
 
 # LangSmith environment variables
@@ -45,21 +45,23 @@ def get_langsmith_client():
         return None
 
 
-def get_tracer_callbacks():
+@lru_cache(maxsize=1)
+def get_tracer_callbacks() -> tuple:
     """
     Get LangSmith tracer callbacks for use with LangChain/LangGraph.
-    Returns empty list if LangSmith not configured.
+    Returns an empty tuple if LangSmith not configured.
+    Built once: the tracer keys its state by run id, so all runs share it.
     """
     if not LANGSMITH_API_KEY or not LANGSMITH_TRACING:
-        return []
+        return ()
     
     try:
         from langchain_core.tracers import LangChainTracer
         tracer = LangChainTracer(project_name=LANGSMITH_PROJECT)
-        return [tracer]
+        return (tracer,)
     except Exception as e:
         print(f"⚠️ Could not create LangSmith tracer: {e}")
-        return []
+        return ()
 
 
 def create_run_config(session_id: str, user_id: Optional[str] = None):
@@ -73,10 +75,8 @@ def create_run_config(session_id: str, user_id: Optional[str] = None):
     Returns:
         Dict with callbacks and metadata for agent invocation
     """
-    callbacks = get_tracer_callbacks()
-    
     config = {
-        "callbacks": callbacks,
+        "callbacks": list(get_tracer_callbacks()),
         "metadata": {
             "session_id": session_id,
             "user_id": user_id or "anonymous",
@@ -90,8 +90,9 @@ def create_run_config(session_id: str, user_id: Optional[str] = None):
     return config
 
 
+@lru_cache(maxsize=1)
 def get_tracing_status() -> dict:
-    """Get current LangSmith tracing status."""
+    """Get current LangSmith tracing status (settings are read at import, so computed once; don't mutate)."""
     return {
         "enabled": LANGSMITH_TRACING and bool(LANGSMITH_API_KEY),
         "project": LANGSMITH_PROJECT,
@@ -362,7 +362,9 @@ function App() {
 
         return data.map((m, idx) => {
             let images = []
-            if (m.image_data) {
+            if (m.image_urls && m.image_urls.length > 0) {
+                images = m.image_urls
+            } else if (m.image_data) {
                 try {
                     const parsed = JSON.parse(m.image_data)
                     if (Array.isArray(parsed)) {
@@ -568,12 +570,15 @@ function App() {
 
             setMessages(prev => [...prev, { role: 'assistant', content: '', isStreaming: true }])
 
+            let pendingLine = '' // Frame split across reads, completed by the next one
+
             while (true) {
                 const { done, value } = await reader.read()
-                if (done) break
 
-                const chunk = decoder.decode(value, { stream: true })
-                const lines = chunk.split('\n').filter(l => l.trim().length > 0)
+                const chunk = pendingLine + (done ? decoder.decode() + '\n' : decoder.decode(value, { stream: true }))
+                const parts = chunk.split('\n')
+                pendingLine = parts.pop()
+                const lines = parts.filter(l => l.trim().length > 0)
                 let batchTokens = 0
                 const BATCH_SIZE = 8 // Update UI every 8 tokens if they arrive at once
 
@@ -591,6 +596,10 @@ function App() {
                             if (parsed.type === 'token') {
                                 assistantMessage += parsed.content
                                 batchTokens++
+                            } else if (parsed.type === 'final') {
+                                // Formatted response replaces the raw streamed tokens
+                                assistantMessage = parsed.content
+                                batchTokens++
                             } else if (parsed.type === 'status') {
                                 setMessages(prev => {
                                     const newMessages = [...prev]
@@ -621,6 +630,8 @@ function App() {
                         }
                     }
                 }
+
+                if (done) break
             }
 
             // Finish Streaming